@@ -0,0 +1,283 @@
+"""
+aggregator provides the Aggregator class, an optional stage between the
+enrichment of a websocket message (EndPoint.handle_ws) and its publication
+(Deconz2acp.send_output_message) which reduces the messages published for
+chatty endpoints:
+
+  - exact duplicates (same "state" and "config" as the endpoint's previous
+    message, deCONZ re-sends these with the same "lastupdated") are dropped,
+  - per-field rules, by endpoint modelid or type, drop messages whose values
+    have moved less than a 'deadband', or arrive within 'min_interval' seconds
+    of the last one published, unless 'max_interval' seconds have passed,
+  - optionally, the min/max/mean of the fields over each 'window' seconds is
+    published as an "aggregate" message when the window ends.
+
+Messages with an "acp_event" are always published immediately.
+
+Configured by the settings.json "aggregation" property, e.g.
+
+    "aggregation": { "dedup": true,
+                     "rules": { "ZHALightLevel": { "fields": { "acp_lux": { "deadband": 10,
+                                                                            "min_interval": 5,
+                                                                            "max_interval": 300 } },
+                                                   "window": 60 } } }
+
+Rule fields are top-level message properties (e.g. "acp_lux") or
+"section.property" (e.g. "state.lightlevel").
+"""
+
+import asyncio
+import logging
+import time
+
+import metrics
+
+LOG = logging.getLogger("aggregator")
+
+# Interval (seconds) between checks for ended windows of quiet endpoints
+WINDOW_CHECK_INTERVAL = 1.0
+
+class FieldRule(object):
+    """ Deadband and interval limits for one field """
+    __slots__ = ("field", "section", "prop", "deadband", "min_interval", "max_interval")
+
+    def __init__(self, field, rule_settings):
+        self.field = field
+        if "." in field:
+            self.section, self.prop = field.split(".", 1)
+        else:
+            self.section, self.prop = None, field
+        self.deadband = rule_settings.get("deadband", 0)
+        self.min_interval = rule_settings.get("min_interval", 0)
+        self.max_interval = rule_settings.get("max_interval")
+
+    # Return the field value from msg_dict, or None
+    def value(self, msg_dict):
+        if self.section is None:
+            return msg_dict.get(self.prop)
+        section = msg_dict.get(self.section)
+        return section.get(self.prop) if isinstance(section, dict) else None
+
+class Rule(object):
+    """ The FieldRules and aggregation window for one modelid or type """
+    __slots__ = ("name", "fields", "window")
+
+    def __init__(self, name, rule_settings):
+        self.name = name
+        self.fields = tuple(FieldRule(field, field_settings)
+                            for field, field_settings in rule_settings.get("fields", {}).items())
+        self.window = rule_settings.get("window")
+
+# No rule for this modelid/type, only dedup applies
+NO_RULE = Rule("none", {})
+
+class EndpointState(object):
+    """ What the Aggregator remembers about one endpoint """
+    __slots__ = ("rule", "rule_key", "state", "config", "sent", "window_start", "window",
+                 "count", "header")
+
+    def __init__(self):
+        self.rule = NO_RULE
+        self.rule_key = None # (modelid, type) the rule was looked up for
+        self.state = None # "state" and "config" of the previous message, for dedup
+        self.config = None
+        self.sent = {} # field -> (value, time) last published
+        self.window_start = None
+        self.window = {} # field -> [ min, max, sum, count ]
+        self.count = 0 # messages in the window
+        self.header = None # r, id, acp_id (and acp_gateway) for the aggregate message
+
+class Aggregator(object):
+    """ Per-endpoint dedup, deadband/interval filtering and windowed aggregates.
+    'filter()' returns whether a message should be published, aggregates are
+    passed to 'self.output(msg_dict)' (set by Deconz2acp).
+    """
+    def __init__(self, settings):
+        aggregation_settings = settings["aggregation"]
+        self.dedup = aggregation_settings.get("dedup", True)
+        self.rules = { name: Rule(name, rule_settings)
+                       for name, rule_settings in aggregation_settings.get("rules", {}).items() }
+        self.endpoints = {} # EndPoint -> EndpointState
+        self.output = None
+        # Windows are in message time ("acp_ts"), which for a replay is not the
+        # wall clock: the latest acp_ts, and the time.monotonic() it arrived
+        self.message_ts = None
+        self.message_seen = None
+
+    # The rule by "modelid", else by "type"
+    def lookup(self, endpoint):
+        rule = self.rules.get(endpoint.modelid)
+        if rule is None:
+            rule = self.rules.get(endpoint.type, NO_RULE)
+        return rule
+
+    # Return True if msg_dict (enriched, from endpoint) should be published
+    def filter(self, endpoint, msg_dict):
+        try:
+            endpoint_state = self.endpoints[endpoint]
+        except KeyError:
+            endpoint_state = self.endpoints[endpoint] = EndpointState()
+        rule_key = (endpoint.modelid, endpoint.type)
+        if endpoint_state.rule_key != rule_key:
+            endpoint_state.rule = self.lookup(endpoint)
+            endpoint_state.rule_key = rule_key
+        rule = endpoint_state.rule
+        now = float(msg_dict["acp_ts"])
+        if self.message_ts is None or now > self.message_ts:
+            self.message_ts = now
+            self.message_seen = time.monotonic()
+        event = "acp_event" in msg_dict
+
+        if not event and self.dedup and self.is_duplicate(endpoint_state, msg_dict):
+            metrics.AGGREGATION.inc("duplicate")
+            return False
+        self.remember(endpoint_state, msg_dict)
+
+        if rule.window is not None:
+            self.add_to_window(endpoint_state, rule, msg_dict, now)
+
+        if event:
+            self.mark_sent(endpoint_state, rule, msg_dict, now)
+            metrics.AGGREGATION.inc("event")
+            return True
+
+        if rule.fields and not self.any_field_due(endpoint_state, rule, msg_dict, now):
+            metrics.AGGREGATION.inc("suppressed")
+            return False
+        self.mark_sent(endpoint_state, rule, msg_dict, now)
+        metrics.AGGREGATION.inc("published")
+        return True
+
+    def is_duplicate(self, endpoint_state, msg_dict):
+        state = msg_dict.get("state")
+        config = msg_dict.get("config")
+        if state is None and config is None:
+            return False
+        return ((state is None or state == endpoint_state.state) and
+                (config is None or config == endpoint_state.config))
+
+    def remember(self, endpoint_state, msg_dict):
+        if "state" in msg_dict:
+            endpoint_state.state = msg_dict["state"]
+        if "config" in msg_dict:
+            endpoint_state.config = msg_dict["config"]
+
+    # True if the message has no rule fields, or any of them has moved by at
+    # least its deadband (or is due by max_interval) and is past its min_interval
+    def any_field_due(self, endpoint_state, rule, msg_dict, now):
+        found = False
+        sent = endpoint_state.sent
+        for field_rule in rule.fields:
+            value = field_rule.value(msg_dict)
+            if value is None:
+                continue
+            found = True
+            try:
+                sent_value, sent_time = sent[field_rule.field]
+            except KeyError:
+                return True
+            elapsed = now - sent_time
+            if field_rule.max_interval is not None and elapsed >= field_rule.max_interval:
+                return True
+            if elapsed < field_rule.min_interval:
+                continue
+            try:
+                if abs(value - sent_value) >= field_rule.deadband:
+                    return True
+            except TypeError:
+                # not numeric
+                if value != sent_value:
+                    return True
+        return not found
+
+    def mark_sent(self, endpoint_state, rule, msg_dict, now):
+        for field_rule in rule.fields:
+            value = field_rule.value(msg_dict)
+            if value is not None:
+                endpoint_state.sent[field_rule.field] = (value, now)
+
+    #####################################
+    # Windowed aggregates
+    #####################################
+
+    def add_to_window(self, endpoint_state, rule, msg_dict, now):
+        window_start = now - now % rule.window
+        if endpoint_state.window_start != window_start:
+            if endpoint_state.count:
+                self.emit_window(endpoint_state, rule)
+            endpoint_state.window_start = window_start
+        # from the latest message, the endpoint may have been renamed
+        endpoint_state.header = { key: msg_dict[key]
+                                  for key in ("r", "id", "acp_id", "acp_gateway")
+                                  if key in msg_dict }
+        endpoint_state.count += 1
+        window = endpoint_state.window
+        for field_rule in rule.fields:
+            value = field_rule.value(msg_dict)
+            if value is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            try:
+                values = window[field_rule.field]
+            except KeyError:
+                window[field_rule.field] = [ value, value, value, 1 ]
+                continue
+            if value < values[0]:
+                values[0] = value
+            if value > values[1]:
+                values[1] = value
+            values[2] += value
+            values[3] += 1
+
+    # Send the aggregate message for the endpoint's current window, and reset it
+    def emit_window(self, endpoint_state, rule):
+        window_end = endpoint_state.window_start + rule.window
+        aggregate = { "start": '{:.6f}'.format(endpoint_state.window_start),
+                      "end": '{:.6f}'.format(window_end),
+                      "count": endpoint_state.count }
+        for field, (minimum, maximum, total, count) in endpoint_state.window.items():
+            aggregate[field] = { "min": minimum, "max": maximum, "mean": total / count }
+        msg_dict = dict(endpoint_state.header)
+        msg_dict["e"] = "aggregate"
+        msg_dict["acp_ts"] = aggregate["end"]
+        msg_dict["acp_aggregate"] = aggregate
+        endpoint_state.window = {}
+        endpoint_state.count = 0
+        metrics.AGGREGATION.inc("aggregate")
+        if self.output is not None:
+            self.output(msg_dict)
+
+    # The current message time: the latest acp_ts plus the time since it
+    # arrived, or None before the first message
+    def message_time(self):
+        if self.message_ts is None:
+            return None
+        return self.message_ts + (time.monotonic() - self.message_seen)
+
+    # Send the aggregates of windows which have ended by message time 'now'
+    # (default message_time()), for endpoints that have gone quiet, others are
+    # sent by the next message
+    def emit_ended_windows(self, now=None):
+        if now is None:
+            now = self.message_time()
+            if now is None:
+                return
+        for endpoint_state in self.endpoints.values():
+            rule = endpoint_state.rule
+            if (endpoint_state.count and rule.window is not None and
+                    now >= endpoint_state.window_start + rule.window):
+                self.emit_window(endpoint_state, rule)
+
+    # Forget an endpoint removed by ZigBeeData, sending its open window
+    def remove(self, endpoint):
+        endpoint_state = self.endpoints.pop(endpoint, None)
+        if endpoint_state is not None and endpoint_state.count and endpoint_state.rule.window is not None:
+            self.emit_window(endpoint_state, endpoint_state.rule)
+
+    # Aggregator task
+    async def run(self):
+        while True:
+            await asyncio.sleep(WINDOW_CHECK_INTERVAL)
+            try:
+                self.emit_ended_windows()
+            except Exception:
+                LOG.exception("Aggregator window check failed")
@@ -0,0 +1,31 @@
+"""
+backoff provides the Backoff class, the delay between reconnection (or retry)
+attempts used for the deCONZ websocket and REST API.
+
+The delay doubles with each consecutive failure, from 'minimum' up to
+'maximum' seconds, with random jitter so that several deconz2acp processes
+(or gateways) restarting together do not retry in lockstep. 'reset()' after a
+success starts again from 'minimum'.
+"""
+
+import random
+
+class Backoff(object):
+    """ Jittered exponential backoff """
+    def __init__(self, minimum, maximum, factor=2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.failures = 0
+
+    # Return the delay before the next attempt, between half and all of the
+    # exponential delay for the number of failures so far
+    def next_delay(self):
+        delay = min(self.maximum, self.minimum * self.factor ** self.failures)
+        if delay < self.maximum:
+            # no further once at maximum, factor ** failures would overflow
+            self.failures += 1
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.failures = 0
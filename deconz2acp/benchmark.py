@@ -0,0 +1,540 @@
+"""
+benchmark replays the recorded deCONZ websocket captures in ../sensor_data
+through the same code path used live, i.e.
+
+    Deconz2acp.handle_input_message -> ZigBeeData.handle_ws_message -> EndPoint.handle_ws
+
+with a fake MQTT client in place of gmqtt and ZigBeeData primed with REST
+responses built from the captures (the REST API client itself is not
+exercised), and reports msgs/sec, p50/p99 per-message latency and
+memory allocated per message.
+
+Usage (from the deconz2acp directory):
+
+    python3 benchmark.py replay
+    python3 benchmark.py replay --endpoints 5000 --max-messages 200000
+    python3 benchmark.py replay --allocs ../sensor_data/2020-04-29.json
+    python3 benchmark.py snapshot
+    python3 benchmark.py memory --endpoints 10000
+    python3 benchmark.py codec
+    python3 benchmark.py spool
+    python3 benchmark.py shards --workers 4
+
+The '--endpoints N' scale mode multiplies the 'sensors' traffic in the captures
+across N synthetic "sensors/<id>" endpoints, to find the number of devices one
+gateway process can handle before it falls behind the websocket.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import simplejson as json
+
+import codec
+import logs
+from captures import load_capture, CaptureRestData
+from deconz2acp import Deconz2acp
+from publisher import Publisher
+from shards import Shards
+from zigbee_data import EndPoint, ZigBeeData
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_CAPTURES = [ os.path.join(SCRIPT_DIR, "..", "sensor_data", "2020-04-28.json"),
+                     os.path.join(SCRIPT_DIR, "..", "sensor_data", "2020-04-29.json") ]
+
+BENCH_SETTINGS = {
+    "DEBUG": False,
+    "deconz_api": { "url": "http://benchmark/api/BENCHMARK/" },
+    "input_ws": { "url": "ws://benchmark:443" },
+    "output_mqtt": { "user": "benchmark",
+                     "password": "benchmark",
+                     "host": "benchmark",
+                     "port": 1883,
+                     "topic_prefix": "benchmark/"
+                   }
+}
+
+# Used by 'replay --aggregation'
+BENCH_AGGREGATION = {
+    "dedup": True,
+    "rules": { "ZHALightLevel": { "fields": { "acp_lux": { "deadband": 10,
+                                                           "min_interval": 5,
+                                                           "max_interval": 300 } },
+                                  "window": 60 } }
+}
+
+# Placeholder substituted into pre-serialized frames for the synthetic endpoints
+ID_PLACEHOLDER = "__BENCHMARK_ID__"
+
+###################################################################
+# Fake MQTT broker
+###################################################################
+
+class FakeMQTTClient(object):
+    """ Stands in for the gmqtt Client, counting what would be published.
+    """
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+
+    def publish(self, topic, msg_bytes, qos=0):
+        self.count += 1
+        self.bytes += len(msg_bytes)
+
+###################################################################
+# Replay
+###################################################################
+
+# Build the pipeline under test, with ZigBeeData primed from the capture REST data
+def make_pipeline(rest_data, settings=BENCH_SETTINGS):
+    zigbee_data = ZigBeeData(settings)
+    for r in ["sensors","lights"]:
+        endpoints_dict = json.loads(rest_data.response_text(r))
+        zigbee_data.handle_rest_response(r, endpoints_dict)
+
+    deconz_2_acp = Deconz2acp(settings)
+    deconz_2_acp.zigbee_datas = [ zigbee_data ]
+    deconz_2_acp.output_client = FakeMQTTClient()
+    deconz_2_acp.publisher = Publisher(settings)
+    return deconz_2_acp
+
+# The replay runs without an event loop, so the Publisher.run() task is
+# replaced by a flush after each message.
+def handle_and_publish(deconz_2_acp):
+    handle_input_message = deconz_2_acp.handle_input_message
+    zigbee_data = deconz_2_acp.zigbee_datas[0]
+    flush = deconz_2_acp.publisher.flush
+    output_client = deconz_2_acp.output_client
+    def handle(frame):
+        handle_input_message(frame, zigbee_data)
+        flush(output_client)
+    return handle
+
+# Generate the websocket frames (as received on the wire) for the replay.
+# With synthetic endpoints, each recorded 'sensors' message is repeated for
+# every synthetic endpoint copied from that sensor.
+def generate_frames(messages, synthetic=None):
+    for msg_dict in messages:
+        if msg_dict.get("e") == "added":
+            continue
+        if synthetic is not None and msg_dict.get("r") == "sensors" and msg_dict["id"] in synthetic:
+            template = dict(msg_dict)
+            template["id"] = ID_PLACEHOLDER
+            template.pop("uniqueid", None)
+            frame = json.dumps(template)
+            for endpoint_id in synthetic[msg_dict["id"]]:
+                yield frame.replace(ID_PLACEHOLDER, endpoint_id)
+        else:
+            yield json.dumps(msg_dict)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[index]
+
+def replay(deconz_2_acp, frames, max_messages):
+    latencies = []
+    handle_input_message = handle_and_publish(deconz_2_acp)
+    perf_counter_ns = time.perf_counter_ns
+    for frame in frames:
+        t0 = perf_counter_ns()
+        handle_input_message(frame)
+        latencies.append(perf_counter_ns() - t0)
+        if len(latencies) >= max_messages:
+            break
+    return latencies
+
+# Separate (slower) pass under tracemalloc: mean peak bytes allocated while
+# handling a message, and mean bytes still held after it.
+def replay_allocs(deconz_2_acp, frames, max_messages):
+    count = 0
+    peak_total = 0
+    retained_total = 0
+    handle_input_message = handle_and_publish(deconz_2_acp)
+    tracemalloc.start()
+    for frame in frames:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        handle_input_message(frame)
+        after, peak = tracemalloc.get_traced_memory()
+        peak_total += peak - before
+        retained_total += after - before
+        count += 1
+        if count >= max_messages:
+            break
+    tracemalloc.stop()
+    return count, peak_total / max(count, 1), retained_total / max(count, 1)
+
+def run_replay(args):
+    codec.select(args.codec)
+    messages = []
+    for filename in args.captures:
+        messages += load_capture(filename)
+
+    rest_data = CaptureRestData(messages)
+    synthetic = rest_data.add_synthetic_sensors(args.endpoints) if args.endpoints else None
+    settings = BENCH_SETTINGS
+    if args.aggregation:
+        settings = dict(BENCH_SETTINGS, aggregation=BENCH_AGGREGATION)
+
+    # Logging is set up as by async_main, so its cost (the rate limit filter
+    # and the queue to the writer thread) is measured, but written to /dev/null.
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            logs.setup(settings)
+            deconz_2_acp = make_pipeline(rest_data, settings)
+            latencies = []
+            for i in range(args.repeat):
+                latencies += replay(deconz_2_acp, generate_frames(messages, synthetic), args.max_messages)
+            if args.allocs:
+                alloc_pipeline = make_pipeline(rest_data, settings)
+                alloc_count, alloc_peak, alloc_retained = replay_allocs(
+                    alloc_pipeline, generate_frames(messages, synthetic), args.max_messages)
+            logs.stop()
+
+    published = deconz_2_acp.output_client.count
+    total_ns = sum(latencies)
+    latencies.sort()
+    zigbee_data = deconz_2_acp.zigbee_datas[0]
+    endpoint_count = sum(len(zigbee_data.endpoints[r]) for r in zigbee_data.endpoints)
+
+    print("json_codec:       {}".format(codec.backend))
+    print("endpoints:        {}".format(endpoint_count))
+    print("messages:         {} ({} published)".format(len(latencies), published))
+    print("msgs/sec:         {:.0f}".format(len(latencies) / (total_ns / 1e9) if total_ns else 0))
+    print("latency p50:      {:.1f} us".format(percentile(latencies, 50) / 1000))
+    print("latency p99:      {:.1f} us".format(percentile(latencies, 99) / 1000))
+    if args.allocs:
+        print("alloc peak/msg:   {:.0f} bytes ({} messages traced)".format(alloc_peak, alloc_count))
+        print("retained/msg:     {:.0f} bytes".format(alloc_retained))
+
+###################################################################
+# EndPoint state snapshot vs the Json round-trip copy it replaced
+###################################################################
+
+# CPU seconds to run 'copy' over every message 'repeat' times
+def cpu_time(copy, messages, repeat):
+    t0 = time.process_time()
+    for i in range(repeat):
+        for msg_dict in messages:
+            copy(msg_dict)
+    return time.process_time() - t0
+
+def run_snapshot(args):
+    messages = []
+    for filename in args.captures:
+        messages += [ m for m in load_capture(filename) if m.get("e") != "added" ]
+
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            endpoint = EndPoint("benchmark", "sensors", "1")
+
+    def json_copy(msg_dict):
+        return json.loads(json.dumps(msg_dict))
+
+    count = len(messages) * args.repeat
+    json_copy_us = cpu_time(json_copy, messages, args.repeat) / count * 1e6
+    snapshot_us = cpu_time(endpoint.snapshot, messages, args.repeat) / count * 1e6
+
+    print("messages:         {}".format(count))
+    print("json round-trip:  {:.2f} us/msg CPU".format(json_copy_us))
+    print("state snapshot:   {:.2f} us/msg CPU".format(snapshot_us))
+    print("saved:            {:.2f} us/msg CPU".format(json_copy_us - snapshot_us))
+
+###################################################################
+# Memory held by ZigBeeData per endpoint
+###################################################################
+
+def run_memory(args):
+    messages = []
+    for filename in args.captures:
+        messages += load_capture(filename)
+
+    rest_data = CaptureRestData(messages)
+    synthetic = rest_data.add_synthetic_sensors(args.endpoints)
+    sensors_json = rest_data.response_text("sensors")
+    lights_json = rest_data.response_text("lights")
+
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            tracemalloc.start()
+            base, _ = tracemalloc.get_traced_memory()
+            zigbee_data = ZigBeeData(BENCH_SETTINGS)
+            zigbee_data.handle_rest_response("sensors", json.loads(sensors_json))
+            zigbee_data.handle_rest_response("lights", json.loads(lights_json))
+            after_rest, _ = tracemalloc.get_traced_memory()
+
+            # The most recent "state" and "config" message of each recorded
+            # endpoint, replayed so every endpoint holds websocket state
+            latest = {}
+            for msg_dict in messages:
+                for prop in ["state", "config"]:
+                    if prop in msg_dict and msg_dict.get("e") == "changed":
+                        latest[(msg_dict.get("r"), msg_dict["id"], prop)] = msg_dict
+            for frame in generate_frames(list(latest.values()), synthetic):
+                msg_dict = json.loads(frame)
+                zigbee_data.handle_ws_message(msg_dict)
+            after_ws, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    endpoint_count = sum(len(zigbee_data.endpoints[r]) for r in zigbee_data.endpoints)
+    print("endpoints:        {}".format(endpoint_count))
+    print("after REST:       {:.0f} bytes/endpoint".format((after_rest - base) / endpoint_count))
+    print("after websocket:  {:.0f} bytes/endpoint".format((after_ws - base) / endpoint_count))
+    print("total:            {:.1f} MiB".format((after_ws - base) / 1024 / 1024))
+
+###################################################################
+# Json codec backends
+###################################################################
+
+def run_codec(args):
+    messages = []
+    for filename in args.captures:
+        messages += [ m for m in load_capture(filename) if m.get("e") != "added" ]
+    frames = [ json.dumps(m) for m in messages ]
+    # Outbound messages carry the acp_* enrichment
+    enriched = []
+    for msg_dict in messages:
+        msg_dict = dict(msg_dict)
+        msg_dict["acp_ts"] = "1588156436.123456"
+        msg_dict["acp_id"] = "aqa-wd-5c91b3"
+        enriched.append(msg_dict)
+
+    count = len(messages) * args.repeat
+    print("{:12} {:>14} {:>14}".format("json_codec", "loads us/msg", "dumps us/msg"))
+    for name in codec.available_backends():
+        loads, dumps, dumps_pretty = codec.backend_functions(name)
+        loads_us = cpu_time(loads, frames, args.repeat) / count * 1e6
+        dumps_us = cpu_time(dumps, enriched, args.repeat) / count * 1e6
+        print("{:12} {:>14.2f} {:>14.2f}".format(name, loads_us, dumps_us))
+
+###################################################################
+# Disk spool for broker outages
+###################################################################
+
+# CPU seconds per message for Publisher.put() and flush() of every message
+def put_time(publisher, client, messages, repeat):
+    t0 = time.process_time()
+    for i in range(repeat):
+        for topic, msg_bytes in messages:
+            publisher.put(topic, msg_bytes)
+            if len(publisher.queue) >= publisher.batch_size:
+                publisher.flush(client)
+    publisher.flush(client)
+    return (time.process_time() - t0) / (len(messages) * repeat)
+
+def run_spool(args):
+    messages = []
+    for filename in args.captures:
+        for msg_dict in load_capture(filename):
+            msg_dict["acp_ts"] = "1588156436.123456"
+            msg_dict["acp_id"] = "aqa-wd-5c91b3"
+            messages.append(("benchmark/aqa-wd-5c91b3", codec.dumps(msg_dict)))
+    count = len(messages) * args.repeat
+    client = FakeMQTTClient()
+
+    spool_dir = tempfile.mkdtemp(prefix="deconz2acp_spool_")
+    try:
+        settings = dict(BENCH_SETTINGS)
+        publisher = Publisher(settings)
+        publisher.set_connected(True)
+        direct_us = put_time(publisher, client, messages, args.repeat) * 1e6
+
+        settings["output_mqtt"] = dict(settings["output_mqtt"], spool={ "directory": spool_dir })
+        publisher = Publisher(settings)
+        publisher.set_connected(True)
+        healthy_us = put_time(publisher, client, messages, args.repeat) * 1e6
+
+        # Broker down: every put() appends to the spool
+        publisher.set_connected(False)
+        t0 = time.perf_counter()
+        for i in range(args.repeat):
+            for topic, msg_bytes in messages:
+                publisher.put(topic, msg_bytes)
+        publisher.spool.sync()
+        spool_seconds = time.perf_counter() - t0
+        spool_bytes = publisher.spool.size()
+
+        # Broker back: read the spool without the drain_rate limit
+        t0 = time.perf_counter()
+        drained = 0
+        while len(publisher.spool):
+            batch = publisher.spool.read_batch(publisher.batch_size)
+            for topic, msg_bytes in batch:
+                client.publish(topic, msg_bytes)
+            drained += len(batch)
+        drain_seconds = time.perf_counter() - t0
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+    print("messages:         {}".format(count))
+    print("put connected:    {:.2f} us/msg (no spool), {:.2f} us/msg (spool configured)".format(
+        direct_us, healthy_us))
+    print("spool append:     {:.0f} msgs/sec, {:.1f} MB/sec (including fsync)".format(
+        count / spool_seconds, spool_bytes / spool_seconds / 1e6))
+    print("spool read:       {:.0f} msgs/sec ({} messages)".format(drained / drain_seconds, drained))
+
+###################################################################
+# Shard worker processes (see shards.py)
+###################################################################
+
+# The shard workers log warnings only, as the replay sends its output to /dev/null
+SHARD_LOGGING = { "level": "WARNING" }
+
+FEED_BATCH = 1000 # frames queued before yielding to the event loop, as reading a websocket does
+
+# Return the published count of each pass of 'frames' through the pipeline, and
+# the seconds the last pass took
+def in_process_replay(rest_data, frames, passes):
+    deconz_2_acp = make_pipeline(rest_data)
+    handle_input_message = handle_and_publish(deconz_2_acp)
+    counts = []
+    for i in range(passes):
+        published = deconz_2_acp.output_client.count
+        t0 = time.perf_counter()
+        for frame in frames:
+            handle_input_message(frame)
+        seconds = time.perf_counter() - t0
+        counts.append(deconz_2_acp.output_client.count - published)
+    return counts, seconds
+
+# Replay 'frames' through Shards with 'workers' processes, a pass to start
+# the workers then a timed one, return the seconds the timed pass took until
+# its last message was output
+async def shard_replay(workers, rest_data, frames, counts, ring_size):
+    settings = dict(BENCH_SETTINGS, logging=SHARD_LOGGING,
+                    shards={ "workers": workers, "ring_size": ring_size })
+    shards = Shards(settings)
+    published = 0
+    target = 0
+    done = asyncio.Event()
+    def output(output_topic, msg_bytes, fields):
+        nonlocal published
+        published += 1
+        if published == target:
+            done.set()
+    def lookup(gateway_number, r, endpoint_id):
+        raise RuntimeError("shard worker lookup of unknown endpoint {}/{}".format(r, endpoint_id))
+    shards.output = output
+    shards.lookup = lookup
+    shards.start()
+    try:
+        for r in ["sensors","lights"]:
+            await shards.put_rest(0, r, None, rest_data.response_text(r), False)
+        for count in counts:
+            target += count
+            done.clear()
+            t0 = time.perf_counter()
+            for n, frame in enumerate(frames):
+                await shards.put_frame(0, frame)
+                if n % FEED_BATCH == 0:
+                    await asyncio.sleep(0)
+            await done.wait()
+            seconds = time.perf_counter() - t0
+    finally:
+        shards.close()
+    return seconds
+
+def run_shards(args):
+    codec.select(args.codec)
+    messages = []
+    for filename in args.captures:
+        messages += load_capture(filename)
+    rest_data = CaptureRestData(messages)
+    synthetic = rest_data.add_synthetic_sensors(args.endpoints) if args.endpoints else None
+    frames = [ frame.encode('utf-8') for frame in generate_frames(messages, synthetic) ]
+
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            counts, seconds = in_process_replay(rest_data, frames, 2)
+
+    print("json_codec:       {}".format(codec.backend))
+    print("cpus:             {} ({} usable)".format(os.cpu_count(), len(os.sched_getaffinity(0))))
+    print("messages:         {} ({} published)".format(len(frames), counts[-1]))
+    print("in-process:       {:.0f} msgs/sec".format(len(frames) / seconds))
+    base_rate = len(frames) / seconds
+    workers = 1
+    while workers <= args.workers:
+        seconds = asyncio.run(shard_replay(workers, rest_data, frames, counts, args.ring_size))
+        rate = len(frames) / seconds
+        print("{:2d} workers:       {:.0f} msgs/sec ({:.2f}x in-process)".format(workers, rate, rate / base_rate))
+        workers *= 2
+
+###################################################################
+# Program main
+###################################################################
+def main():
+    parser = argparse.ArgumentParser(description="deconz2acp replay benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = subparsers.add_parser("replay", help="replay captures through Deconz2acp.handle_input_message")
+    replay_parser.add_argument("captures", nargs="*", default=DEFAULT_CAPTURES,
+                               help="capture files (default: the sensor_data captures)")
+    replay_parser.add_argument("--endpoints", type=int, default=0,
+                               help="scale mode: number of synthetic sensors/N endpoints")
+    replay_parser.add_argument("--repeat", type=int, default=1,
+                               help="number of passes over the captures")
+    replay_parser.add_argument("--max-messages", type=int, default=1000000,
+                               help="stop each pass after this many messages")
+    replay_parser.add_argument("--allocs", action="store_true",
+                               help="also measure memory allocated per message (tracemalloc)")
+    replay_parser.add_argument("--aggregation", action="store_true",
+                               help="with the aggregation stage (dedup, and a deadband on acp_lux)")
+    replay_parser.add_argument("--codec", default="auto", choices=["auto"] + codec.BACKENDS,
+                               help="json_codec backend (default: auto)")
+    replay_parser.set_defaults(func=run_replay)
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="EndPoint state snapshot vs Json round-trip copy")
+    snapshot_parser.add_argument("captures", nargs="*", default=DEFAULT_CAPTURES,
+                                 help="capture files (default: the sensor_data captures)")
+    snapshot_parser.add_argument("--repeat", type=int, default=20,
+                                 help="number of passes over the captures")
+    snapshot_parser.set_defaults(func=run_snapshot)
+
+    memory_parser = subparsers.add_parser("memory", help="memory held by ZigBeeData per endpoint")
+    memory_parser.add_argument("captures", nargs="*", default=DEFAULT_CAPTURES,
+                               help="capture files (default: the sensor_data captures)")
+    memory_parser.add_argument("--endpoints", type=int, default=10000,
+                               help="number of synthetic sensors/N endpoints")
+    memory_parser.set_defaults(func=run_memory)
+
+    codec_parser = subparsers.add_parser("codec", help="loads/dumps cost of each installed json_codec")
+    codec_parser.add_argument("captures", nargs="*", default=DEFAULT_CAPTURES,
+                              help="capture files (default: the sensor_data captures)")
+    codec_parser.add_argument("--repeat", type=int, default=20,
+                              help="number of passes over the captures")
+    codec_parser.set_defaults(func=run_codec)
+
+    spool_parser = subparsers.add_parser("spool", help="Publisher cost with a spool, spool append and read rates")
+    spool_parser.add_argument("captures", nargs="*", default=DEFAULT_CAPTURES,
+                              help="capture files (default: the sensor_data captures)")
+    spool_parser.add_argument("--repeat", type=int, default=50,
+                              help="number of passes over the captures")
+    spool_parser.set_defaults(func=run_spool)
+
+    shards_parser = subparsers.add_parser("shards", help="throughput with 1, 2, 4 .. shard worker processes")
+    shards_parser.add_argument("captures", nargs="*", default=DEFAULT_CAPTURES,
+                               help="capture files (default: the sensor_data captures)")
+    shards_parser.add_argument("--endpoints", type=int, default=1000,
+                               help="number of synthetic sensors/N endpoints")
+    shards_parser.add_argument("--workers", type=int, default=4,
+                               help="the most worker processes")
+    shards_parser.add_argument("--ring-size", type=int, default=4 * 1024 * 1024,
+                               help="bytes in each shared memory ring")
+    shards_parser.add_argument("--codec", default="auto", choices=["auto"] + codec.BACKENDS,
+                               help="json_codec backend (default: auto)")
+    shards_parser.set_defaults(func=run_shards)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+captures reads the deCONZ websocket captures in ../sensor_data, and builds
+the REST API responses deCONZ would have given for the endpoints seen in
+them. Used by benchmark.py and by 'replay.py import'.
+"""
+
+import simplejson as json
+
+# The sensor_data captures are a sequence of pretty-printed Json objects, one
+# per websocket message, *not* a Json list.
+def load_capture(filename):
+    decoder = json.JSONDecoder()
+    with open(filename, 'r') as f:
+        text = f.read()
+    messages = []
+    pos = 0
+    while True:
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        if pos >= len(text):
+            break
+        msg_dict, pos = decoder.raw_decode(text, pos)
+        messages.append(msg_dict)
+    return messages
+
+class CaptureRestData(object):
+    """ Builds the '/sensors' and '/lights' REST response Json for the endpoints
+    seen in the captures, so ZigBeeData can be primed with the same metadata it
+    would get from deCONZ (nothing is served over HTTP).
+    Endpoints announced with an "added" websocket message use the embedded
+    REST data, others are synthesized from the fields in their messages.
+    """
+    def __init__(self, messages):
+        self.endpoints = { "sensors": {}, "lights": {} }
+        for msg_dict in messages:
+            r = msg_dict.get("r")
+            if r not in self.endpoints:
+                continue
+            endpoint_id = msg_dict["id"]
+            if "sensor" in msg_dict:
+                self.endpoints[r][endpoint_id] = msg_dict["sensor"]
+            elif endpoint_id not in self.endpoints[r]:
+                self.endpoints[r][endpoint_id] = self.synthesize(r, msg_dict)
+
+    def synthesize(self, r, msg_dict):
+        state = msg_dict.get("state", {})
+        if "open" in state:
+            endpoint_type = "ZHAOpenClose"
+        elif "presence" in state:
+            endpoint_type = "ZHAPresence"
+        elif "lux" in state:
+            endpoint_type = "ZHALightLevel"
+        elif "daylight" in state:
+            endpoint_type = "Daylight"
+        elif r == "lights":
+            endpoint_type = "On/Off plug-in unit"
+        else:
+            endpoint_type = "Unknown"
+        return { "config": msg_dict.get("config", {}),
+                 "etag": "0"*32,
+                 "manufacturername": "benchmark",
+                 "modelid": "benchmark",
+                 "name": "{}-{}".format(r, msg_dict["id"]),
+                 "state": state,
+                 "type": endpoint_type,
+                 "uniqueid": msg_dict.get("uniqueid", "")
+               }
+
+    # Add 'count' synthetic sensors, each a copy of one of the recorded sensors.
+    # Returns { template_id: [ synthetic_id, ... ] }
+    def add_synthetic_sensors(self, count):
+        templates = sorted(self.endpoints["sensors"].keys(), key=int)
+        synthetic = { template_id: [] for template_id in templates }
+        for n in range(count):
+            template_id = templates[n % len(templates)]
+            endpoint_id = str(1000 + n)
+            endpoint_dict = dict(self.endpoints["sensors"][template_id])
+            endpoint_dict["name"] = "{}-{:05d}".format(endpoint_dict["name"], n)
+            endpoint_dict["uniqueid"] = "bench-{:05d}".format(n)
+            self.endpoints["sensors"][endpoint_id] = endpoint_dict
+            synthetic[template_id].append(endpoint_id)
+        return synthetic
+
+    # Return the REST response text for "sensors" or "lights"
+    def response_text(self, r):
+        return json.dumps(self.endpoints[r])
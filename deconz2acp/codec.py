@@ -0,0 +1,74 @@
+"""
+codec provides the Json parse/serialize functions used on the message path,
+backed by the fastest Json library available (orjson, ujson, rapidjson,
+simplejson, then the stdlib json).
+
+    codec.loads(str or bytes) -> object
+    codec.dumps(object) -> bytes, ready for MQTT publish
+    codec.dumps_pretty(object) -> str, indented for DEBUG output
+
+The backend is chosen once at startup by 'codec.select(name)', where name is
+"auto" (the default) or one of BACKENDS, e.g. from the settings.json
+"json_codec" property.
+"""
+
+import importlib
+import logging
+
+# In order of preference for "auto"
+BACKENDS = [ "orjson", "ujson", "rapidjson", "simplejson", "json" ]
+
+LOG = logging.getLogger("codec")
+
+# Return (loads, dumps, dumps_pretty) for the named backend, raises ImportError
+# if that library is not installed.
+def backend_functions(name):
+    if name not in BACKENDS:
+        raise ImportError("unknown json_codec {}".format(name))
+    module = importlib.import_module(name)
+    if name == "orjson":
+        def dumps_pretty(obj):
+            return module.dumps(obj, option=module.OPT_INDENT_2).decode('utf-8')
+        return module.loads, module.dumps, dumps_pretty
+
+    # The others serialize to str, and the stdlib-style ones accept bytes
+    # in loads() (ujson and rapidjson also do).
+    module_dumps = module.dumps
+    def dumps(obj):
+        return module_dumps(obj).encode('utf-8')
+    def dumps_pretty(obj):
+        return module_dumps(obj, indent=4)
+    return module.loads, dumps, dumps_pretty
+
+# Return the names of the installed backends, fastest first
+def available_backends():
+    available = []
+    for name in BACKENDS:
+        try:
+            backend_functions(name)
+            available.append(name)
+        except ImportError:
+            pass
+    return available
+
+# Set the module loads/dumps/dumps_pretty to those of the chosen backend
+def select(name="auto"):
+    global backend, loads, dumps, dumps_pretty
+    candidates = BACKENDS if name == "auto" else [ name, "json" ]
+    for candidate in candidates:
+        try:
+            loads, dumps, dumps_pretty = backend_functions(candidate)
+            backend = candidate
+            break
+        except ImportError:
+            if candidate == name:
+                LOG.warning("codec json_codec %s not available, using json", name)
+    return backend
+
+backend = None
+loads = None
+dumps = None
+dumps_pretty = None
+
+# Modules use the codec from import, async_main may select() another
+select("auto")
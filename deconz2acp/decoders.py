@@ -0,0 +1,111 @@
+"""
+decoders provides the table of Decoders which add ACP 'standard' properties
+(like "acp_temperature") and events (like "acp_event": "openclose") to the
+websocket messages of each type of ZigBee endpoint.
+
+Each EndPoint looks up its Decoder once, with 'lookup(modelid, type)', when
+its REST API data arrives, so a websocket message only runs the fields and
+event rules of its own device type. To support a new device type add a
+Decoder to MODEL_DECODERS (by deCONZ "modelid", for a particular product) or
+TYPE_DECODERS (by deCONZ "type", e.g. "ZHAOpenClose").
+
+Decoders are data (tuples) rather than code so the same rules can be applied
+column-wise to historical data.
+"""
+
+class Decoder(object):
+    """ The decoding for one type of endpoint:
+
+    fields: (section, prop, acp_prop, divisor) tuples, where section is
+            "state" or "config", e.g. ("config", "temperature", "acp_temperature", 100)
+            sets msg_dict["acp_temperature"] = msg_dict["config"]["temperature"] / 100.
+            A divisor of None copies the value unchanged.
+
+    events: (prop, event, true_value, false_value) tuples for boolean "state"
+            properties, e.g. ("open", "openclose", "open", "close") sets
+            "acp_event": "openclose", "acp_event_value": "open" when state.open
+            changes to true.
+    """
+    __slots__ = ("name", "fields", "events")
+
+    def __init__(self, name, fields=(), events=()):
+        self.name = name
+        self.fields = tuple(fields)
+        self.events = tuple(events)
+
+    # Add the acp_* properties decoded from the message
+    def decode(self, msg_dict):
+        for section, prop, acp_prop, divisor in self.fields:
+            try:
+                value = msg_dict[section][prop]
+            except KeyError:
+                continue
+            msg_dict[acp_prop] = value if divisor is None else value / divisor
+
+    # Compare msg_dict "state" with the previous state of the endpoint and if
+    # an event property has changed add "acp_event" and "acp_event_value".
+    # Returns the (event, value) added, or None.
+    def add_event(self, msg_dict, previous_state):
+        if not self.events or previous_state is None or "state" not in msg_dict:
+            return None
+        msg_state = msg_dict["state"]
+        added = None
+        for prop, event, true_value, false_value in self.events:
+            if prop in msg_state and prop in previous_state and msg_state[prop] != previous_state[prop]:
+                value = true_value if msg_state[prop] else false_value
+                msg_dict["acp_event"] = event
+                msg_dict["acp_event_value"] = value
+                added = (event, value)
+        return added
+
+# Device temperature reported in "config" by many battery devices (e.g. Aqara)
+CONFIG_TEMPERATURE = ("config", "temperature", "acp_temperature", 100)
+
+# Any endpoint reporting state.open (ZHAOpenClose, CLIPOpenClose, ...)
+OPEN_EVENT = ("open", "openclose", "open", "close")
+
+# For endpoints without a more specific decoder, or not yet looked up
+DEFAULT_DECODER = Decoder("default", fields=[ CONFIG_TEMPERATURE ], events=[ OPEN_EVENT ])
+
+# By deCONZ "type". Each keeps OPEN_EVENT, as every endpoint had before the
+# decoders were per type.
+TYPE_DECODERS = {
+    "ZHAOpenClose": Decoder("ZHAOpenClose",
+                            fields=[ CONFIG_TEMPERATURE ],
+                            events=[ OPEN_EVENT ]),
+
+    # Not in the original events, consumers of acp_event see these in addition
+    "ZHAPresence": Decoder("ZHAPresence",
+                           fields=[ CONFIG_TEMPERATURE ],
+                           events=[ OPEN_EVENT,
+                                    ("presence", "presence", "detected", "cleared") ]),
+
+    "ZHALightLevel": Decoder("ZHALightLevel",
+                             fields=[ CONFIG_TEMPERATURE,
+                                      ("state", "lux", "acp_lux", None) ],
+                             events=[ OPEN_EVENT ]),
+
+    # state.temperature is the measured (ambient) temperature, not the device
+    # temperature of config.temperature
+    "ZHATemperature": Decoder("ZHATemperature",
+                              fields=[ CONFIG_TEMPERATURE,
+                                       ("state", "temperature", "acp_ambient_temperature", 100) ],
+                              events=[ OPEN_EVENT ]),
+
+    "ZHAHumidity": Decoder("ZHAHumidity",
+                           fields=[ CONFIG_TEMPERATURE,
+                                    ("state", "humidity", "acp_humidity", 100) ],
+                           events=[ OPEN_EVENT ]),
+}
+
+# By deCONZ "modelid", these take precedence over TYPE_DECODERS, for products
+# that report differently from others of the same type.
+MODEL_DECODERS = {
+}
+
+# Return the Decoder for an endpoint from its REST API "modelid" and "type"
+def lookup(modelid, endpoint_type):
+    decoder = MODEL_DECODERS.get(modelid)
+    if decoder is None:
+        decoder = TYPE_DECODERS.get(endpoint_type, DEFAULT_DECODER)
+    return decoder
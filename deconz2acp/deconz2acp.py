@@ -6,11 +6,10 @@ in the MQTT message.
 
 This code tested with Conbee II controller/gateway.
 """
-import simplejson as json
-
 import asyncio
+import functools
+import logging
 import os
-import sys
 import signal
 import time
 import importlib
@@ -21,15 +20,39 @@ import websockets
 from gmqtt import Client as MQTTClient
 from gmqtt.mqtt.constants import MQTTv311
 
-from zigbee_data import ZigBeeData
+import codec
+import logs
+from aggregator import Aggregator
+from backoff import Backoff
+from recording import Recorder, KIND_WS, KIND_OUT, endpoint_key, frame_endpoint_key
+import metrics
+from local_http import LocalHttp
+from query import Query
+from stream import Stream
+from zigbee_data import ZigBeeData, gateway_settings
+from publisher import Publisher
+from ring_buffer import RingBuffer, shard_index
 
 # gmqtt compatible with uvloop
 import uvloop
 
 DEBUG = False
 
-#import logging
-#logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
+# Defaults for the settings "input_ws" worker properties
+WORKERS = 1 # number of coroutines processing websocket frames
+RING_SIZE = 1000 # capacity of the frame buffer between reader and each worker
+WORKER_BATCH = 50 # frames a worker processes before yielding to the event loop
+
+# Defaults for the settings "input_ws" reconnect properties (seconds)
+RECONNECT_MIN = 0.5 # first reconnect delay, doubling up to RECONNECT_MAX
+RECONNECT_MAX = 30
+PING_INTERVAL = 10 # websocket ping every PING_INTERVAL, closed if no pong within PING_TIMEOUT
+PING_TIMEOUT = 10
+STABLE_CONNECTION = 10 # a connection up this long resets the reconnect backoff
+
+LOG = logging.getLogger("deconz2acp")
+# Per-message logging, rate limited separately (see logs.py)
+MSG_LOG = logging.getLogger("deconz2acp.messages")
 
 
 ##################################################################
@@ -45,9 +68,21 @@ class Deconz2acp():
     ###################
     def __init__(self, settings):
         self.settings = settings
-        print("{} Deconz2acp __init__() DEBUG={}".format(
-            self.ts_string(),
-            DEBUG),file=sys.stderr,flush=True)
+        self.mqtt_connects = 0
+        # Optional dedup/deadband/window stage before publishing
+        self.aggregator = None
+        if "aggregation" in settings:
+            self.aggregator = Aggregator(settings)
+            self.aggregator.output = self.send_enriched_message
+        # Optional recording of websocket frames, REST responses and output
+        self.recorder = None
+        if "recorder" in settings:
+            self.recorder = Recorder(settings)
+        # Optional fan-out to local websocket clients, set up with local_http
+        self.stream = None
+        # Optional worker processes for the message path (see shards.py), set up by start()
+        self.shards = None
+        LOG.info("Deconz2acp __init__() DEBUG=%s", DEBUG)
 
     #####################################
     # Signal handler for SIGINT, SIGTERM
@@ -55,65 +90,162 @@ class Deconz2acp():
     def ask_exit(self,*args):
         self.STOP.set()
 
-    #####################################
-    # Return current timestamp as string
-    #####################################
-    def ts_string(self):
-        return '{:.6f}'.format(time.time())
-
     ###############################################################
     # Async initialization
     ###############################################################
-    async def start(self, zigbee_data):
-        print("{} Deconz2acp start()".format(
-            self.ts_string()),file=sys.stderr,flush=True)
+    # zigbee_datas is a list with a ZigBeeData for each deCONZ gateway
+    async def start(self, zigbee_datas):
+        LOG.info("Deconz2acp start()")
 
-        self.zigbee_data = zigbee_data
+        self.zigbee_datas = zigbee_datas
 
         # Define async events for exit and reload (will set via signals)
         self.STOP = asyncio.Event()
         self.RELOAD = asyncio.Event()
 
+        # Bounded queue between the websocket reader and the MQTT client
+        self.publisher = Publisher(self.settings)
+        for value in [ "depth", "max_depth", "published", "dropped" ]:
+            metrics.PUBLISH_QUEUE.set_function(lambda value=value: self.publisher.stats()[value], value)
+        if self.publisher.spool is not None:
+            for value in [ "messages", "bytes", "segments", "spooled", "drained", "evicted" ]:
+                metrics.SPOOL.set_function(lambda value=value: self.publisher.spool.stats()[value], value)
+
+        # Set before the first await, the ZigBeeData pollers are already running:
+        # messages held back for an endpoint lookup, and the resync messages of
+        # the first poll (queued by the publisher until MQTT connects)
+        for zigbee_data in self.zigbee_datas:
+            zigbee_data.output = self.send_enriched_message
+            zigbee_data.removed = self.endpoint_removed
+
+        if self.aggregator is not None:
+            asyncio.ensure_future(self.aggregator.run())
+        if self.recorder is not None:
+            asyncio.ensure_future(self.recorder.run())
+
+        # Started before the first REST poll, which the workers need too
+        if "shards" in self.settings:
+            # imported here, shards.py subclasses Deconz2acp for its workers
+            from shards import Shards
+            self.shards = Shards(self.settings)
+            self.shards.output = self.send_shard_output
+            self.shards.lookup = self.shard_lookup
+            self.shards.on_exit = self.ask_exit
+            self.shards.start()
+            for gateway_number, zigbee_data in enumerate(self.zigbee_datas):
+                zigbee_data.rest_output = functools.partial(self.shards.put_rest, gateway_number)
+
+        # Local HTTP server for /metrics and endpoint state queries
+        self.local_http = None
+        if "local_http" in self.settings:
+            self.local_http = LocalHttp(self.settings)
+            Query(self.zigbee_datas).add_routes(self.local_http.app)
+            if "stream" in self.settings["local_http"]:
+                self.stream = Stream(self.settings)
+                self.stream.add_routes(self.local_http.app)
+            await self.local_http.start()
+            asyncio.ensure_future(metrics.monitor_loop_lag())
+
         # connect output MQTT broker
         await self.connect_output_mqtt()
 
-        # Connect input WebSocket
-        asyncio.ensure_future(self.subscribe_input_ws())
+        # Start the publisher task (it waits for the MQTT connection)
+        asyncio.ensure_future(self.publisher.run(self.output_client))
 
-    # Connect to input websocket
-    async def subscribe_input_ws(self):
-        ws_url = self.settings["input_ws"]["url"]
+        # Connect input WebSocket of each gateway, these share the publisher
+        for zigbee_data in self.zigbee_datas:
+            asyncio.ensure_future(self.subscribe_input_ws(zigbee_data))
 
-        connected = False
+    # Connect to input websocket of the gateway of zigbee_data
+    async def subscribe_input_ws(self, zigbee_data):
+        ws_url = zigbee_data.ws_settings["url"]
+
+        # Websocket frames are passed from the reader to the processing
+        # worker(s) via ring buffers, sharded by endpoint id. With shards the
+        # workers are processes, each processing frames from every gateway.
+        shards = self.shards
+        if shards is not None:
+            gateway_number = self.zigbee_datas.index(zigbee_data)
+        else:
+            workers = zigbee_data.ws_settings.get("workers", WORKERS)
+            ring_size = zigbee_data.ws_settings.get("ring_size", RING_SIZE)
+            rings = [ RingBuffer(ring_size) for i in range(workers) ]
+            for ring in rings:
+                asyncio.ensure_future(self.process_frames(ring, zigbee_data))
+
+        # Reconnect with jittered exponential backoff, and detect a dead
+        # connection (e.g. gateway rebooted without closing it) by ping/pong
+        backoff = Backoff(zigbee_data.ws_settings.get("reconnect_min", RECONNECT_MIN),
+                          zigbee_data.ws_settings.get("reconnect_max", RECONNECT_MAX))
+        ping_interval = zigbee_data.ws_settings.get("ping_interval", PING_INTERVAL)
+        ping_timeout = zigbee_data.ws_settings.get("ping_timeout", PING_TIMEOUT)
+        connects = 0
 
         while True:
+            connected_at = None
             try:
-                async with websockets.connect(ws_url) as ws:
-                    connected = True
-                    print("{} Deconz2acp connected to {}".format(self.ts_string(),ws_url),flush=True)
-                    while connected:
-                        try:
-                            if DEBUG:
-                                print("{} Deconz2acp awaiting msg from {}".format(self.ts_string(),ws_url),flush=True)
-                            # Here we await & receive any websocket message
-                            msg = await ws.recv()
-                            if DEBUG:
-                                pretty_msg = json.dumps(json.loads(msg), indent=4)
-                                print("{} Deconz2acp msg received from {}:\n{}".format(
-                                    self.ts_string(),
-                                    ws_url,
-                                    pretty_msg),flush=True)
-                            #debug we're stuffing in a fake "zigbee" topic
-                            self.handle_input_message(msg)
-                        except websockets.exceptions.ConnectionClosedError:
-                            connected = False
-                            print("{} Deconz2acp disconnected from {}".format(self.ts_string(),ws_url),flush=True)
-                    print("{} Deconz2acp websocket read loop ended".format(self.ts_string()),flush=True)
-            except ConnectionRefusedError:
-                    print("{} Deconz2acp websocket connection refused from {}".format(self.ts_string(),ws_url),flush=True)
-                    await asyncio.sleep(2) # sleep 2 seconds and retry
-
-        print("{} Deconz2acp websocket connect loop ended".format(self.ts_string()),flush=True)
+                async with websockets.connect(ws_url,
+                                              ping_interval=ping_interval,
+                                              ping_timeout=ping_timeout) as ws:
+                    connected_at = time.monotonic()
+                    if connects:
+                        metrics.RECONNECTS.inc("websocket", zigbee_data.gateway_name)
+                        # Catch up on state changes missed while disconnected
+                        zigbee_data.request_resync()
+                    connects += 1
+                    LOG.info("Deconz2acp connected to %s", ws_url)
+                    while True:
+                        # With queue_policy "block" stop reading while the publisher catches up
+                        await self.publisher.wait_ready()
+                        MSG_LOG.debug("Deconz2acp awaiting msg from %s", ws_url)
+                        if shards is not None:
+                            # Not parsed here, the shard worker does that
+                            msg = await ws.recv(decode=False)
+                            if self.recorder is not None:
+                                self.recorder.record(KIND_WS, zigbee_data.gateway_name, frame_endpoint_key(msg), msg)
+                            try:
+                                await shards.put_frame(gateway_number, msg)
+                            except ValueError as e:
+                                # larger than half the ring, it can never be queued
+                                LOG.error("Deconz2acp frame from %s dropped: %s", ws_url, e)
+                            continue
+                        # Here we await & receive any websocket message
+                        msg = await ws.recv()
+                        MSG_LOG.debug("Deconz2acp msg received from %s:\n%s", ws_url, logs.LazyJson(msg))
+                        # Pass the frame (with its arrival time) to its worker, waiting if
+                        # that worker is behind
+                        ring = rings[shard_index(msg, workers)]
+                        frame = (time.perf_counter(), msg)
+                        while not ring.push(frame):
+                            await ring.wait_space()
+            except websockets.exceptions.ConnectionClosed as e:
+                LOG.warning("Deconz2acp disconnected from %s: %s", ws_url, e)
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                LOG.warning("Deconz2acp websocket %s connect failed: %r", ws_url, e)
+            # Only a connection that stayed up resets the backoff, so a gateway
+            # accepting then dropping connections is not hammered
+            if connected_at is not None and time.monotonic() - connected_at >= STABLE_CONNECTION:
+                backoff.reset()
+            delay = backoff.next_delay()
+            LOG.info("Deconz2acp reconnecting to %s in %.1fs", ws_url, delay)
+            await asyncio.sleep(delay)
+
+    # Worker: process the websocket frames arriving in 'ring' from the gateway of zigbee_data
+    async def process_frames(self, ring, zigbee_data):
+        observe = metrics.STAGE_SECONDS.observe
+        perf_counter = time.perf_counter
+        while True:
+            await ring.wait_frames()
+            for received, msg in ring.pop_batch(WORKER_BATCH):
+                try:
+                    t0 = perf_counter()
+                    observe(t0 - received, "ring")
+                    self.handle_input_message(msg, zigbee_data)
+                    observe(perf_counter() - t0, "process")
+                except Exception:
+                    LOG.exception("Deconz2acp exception processing %s", msg)
+            # Let the websocket reader and the publisher run between batches
+            await asyncio.sleep(0)
 
     async def connect_output_mqtt(self):
         self.output_client = MQTTClient(None) # auto-generate client id
@@ -134,13 +266,9 @@ class Deconz2acp():
             await self.output_client.connect(host, port, keepalive=60, version=MQTTv311)
         except Exception as e:
             if hasattr(e, 'args') and e.args[0] == 5:
-                print("{}\033[1;31m FAIL: Connect output_mqtt auth (as {} )\033[0;0m".format(
-                    self.ts_string(),
-                    user),file=sys.stderr,flush=True)
+                LOG.error("\033[1;31m FAIL: Connect output_mqtt auth (as %s )\033[0;0m", user)
             else:
-                print("{}\033[1;31m FAIL gmqtt connect exception\n{}\n{}\033[0;0m".format(
-                    self.ts_string(),
-                    e),file=sys.stderr,flush=True)
+                LOG.error("\033[1;31m FAIL gmqtt connect exception\n%s\033[0;0m", e)
             self.ask_exit()
 
 
@@ -148,64 +276,106 @@ class Deconz2acp():
     # Sensor data message handler
     ###############################################################
 
-    def handle_input_message(self, msg_bytes):
+    # 'ts' is the time.time() the message arrived, when it is not now (a replay)
+    def handle_input_message(self, msg_bytes, zigbee_data, ts=None):
 
-        msg_dict = json.loads(msg_bytes)
+        msg_dict = codec.loads(msg_bytes)
+        if ts is not None:
+            msg_dict["acp_ts"] = '{:.6f}'.format(ts)
+        if self.recorder is not None:
+            self.recorder.record(KIND_WS, zigbee_data.gateway_name,
+                                 endpoint_key(msg_dict.get("r"), msg_dict.get("id")), msg_bytes)
         # Add required zigbee properties by updating msg_dict
-        # send_data will be True if zigbee_data.decode decides this message should be sent via MQTT.
-        send_data = self.zigbee_data.handle_ws_message(msg_dict)
+        # send_data will be the EndPoint if zigbee_data decides this message should be sent via MQTT,
+        # or None if zigbee_data is holding the message until it has looked up the endpoint.
+        send_data = zigbee_data.handle_ws_message(msg_dict)
 
         if send_data:
-            topic = ""
-            if "acp_id" in msg_dict:
-                topic += msg_dict["acp_id"]
-            self.send_output_message(topic, msg_dict)
-        else:
-            print("{} Incoming message not sent to MQTT\n{}\n".format(
-                self.ts_string(),
-                msg_bytes), flush=True)
-
-    def send_output_message(self, topic, msg_dict):
-        msg_bytes = json.dumps(msg_dict)
+            self.send_enriched_message(msg_dict, send_data)
+        elif send_data is False:
+            MSG_LOG.debug("Incoming message not sent to MQTT\n%s\n", msg_bytes)
+
+    # Send a message enriched by ZigBeeData, with topic from its acp_id, via the
+    # aggregator if there is one (aggregates come back here without an endpoint)
+    def send_enriched_message(self, msg_dict, endpoint=None):
+        if endpoint is not None and self.aggregator is not None:
+            if not self.aggregator.filter(endpoint, msg_dict):
+                return
+        topic = ""
+        if "acp_id" in msg_dict:
+            topic += msg_dict["acp_id"]
+        self.send_output_message(topic, msg_dict, endpoint)
+
+    # An endpoint deCONZ no longer reports, from ZigBeeData.remove_endpoint
+    def endpoint_removed(self, endpoint):
+        if self.aggregator is not None:
+            self.aggregator.remove(endpoint)
+
+    def send_output_message(self, topic, msg_dict, endpoint=None):
+        msg_bytes = codec.dumps(msg_dict)
+        if self.recorder is not None:
+            self.recorder.record(KIND_OUT, msg_dict.get("acp_gateway", ""),
+                                 endpoint_key(msg_dict.get("r"), msg_dict.get("id")), msg_bytes)
+        if self.stream is not None and self.stream.clients:
+            self.stream.send(msg_bytes, msg_dict.get("acp_id"), msg_dict.get("r"),
+                             None if endpoint is None else endpoint.type)
         #print("publishing {}".format(msg_bytes), flush=True)
         output_topic = self.settings["output_mqtt"]["topic_prefix"] + topic
         if DEBUG:
-            pretty_msg = json.dumps(msg_dict, indent=4)
-            print("{} MQTT publish disabled by DEBUG setting:\n{}".format(
-                self.ts_string(),
-                pretty_msg),flush=True)
+            MSG_LOG.debug("MQTT publish disabled by DEBUG setting:\n%s", logs.LazyJson(msg_dict))
         else:
-            self.output_client.publish(output_topic, msg_bytes, qos=0)
+            self.publisher.put(output_topic, msg_bytes)
+
+    # A message from a shard worker, serialized, with the (bytes) acp_gateway,
+    # r, id, acp_id and endpoint type the recorder and stream need
+    def send_shard_output(self, output_topic, msg_bytes, fields):
+        if self.recorder is not None or (self.stream is not None and self.stream.clients):
+            acp_gateway, r, endpoint_id, acp_id, endpoint_type = [ field.decode('utf-8') or None
+                                                                   for field in fields ]
+            if self.recorder is not None:
+                self.recorder.record(KIND_OUT, acp_gateway or "", endpoint_key(r, endpoint_id), msg_bytes)
+            if self.stream is not None and self.stream.clients:
+                self.stream.send(msg_bytes, acp_id, r, endpoint_type)
+        if DEBUG:
+            MSG_LOG.debug("MQTT publish disabled by DEBUG setting:\n%s", logs.LazyJson(msg_bytes))
+        else:
+            self.publisher.put(output_topic, msg_bytes)
+
+    # A shard worker has messages from an endpoint it does not know yet
+    def shard_lookup(self, gateway_number, r, endpoint_id):
+        self.zigbee_datas[gateway_number].request_lookup(r, endpoint_id)
 
     ###############################################################
     # WS INPUT
     ###############################################################
 
     def input_ws_connected(self, uri):
-        print('{} INPUT Connected to {}'.format(
-            self.ts_string(),
-            uri), flush=True)
+        LOG.info("INPUT Connected to %s", uri)
 
     ###############################################################
     # MQTT OUTPUT
     ###############################################################
 
     def output_on_connect(self, client, flags, rc, properties):
-        print('{} OUTPUT Connected to {} as {}'.format(
-            self.ts_string(),
+        LOG.info("OUTPUT Connected to %s as %s",
             self.settings["output_mqtt"]["host"],
-            self.settings["output_mqtt"]["user"]), flush=True)
+            self.settings["output_mqtt"]["user"])
+        if self.mqtt_connects:
+            metrics.RECONNECTS.inc("mqtt", "")
+        self.mqtt_connects += 1
+        self.publisher.set_connected(True)
 
     def output_on_disconnect(self, client, packet, exc=None):
-        print("{} OUTPUT Disconnected\n".format(self.ts_string()),file=sys.stderr,flush=True)
+        self.publisher.set_connected(False)
+        LOG.warning("OUTPUT Disconnected (publish queue %s)", self.publisher.stats())
 
     # These GMQTT methods here for completeness although not used
 
     def output_on_message(self, client, topic, msg_bytes, qos, properties):
-        print('OUTPUT RECV MSG?:', msg_bytes, flush=True)
+        LOG.info("OUTPUT RECV MSG?: %s", msg_bytes)
 
     def output_on_subscribe(self, client, mid, qos, properties):
-        print('OUTPUT SUBSCRIBED? to {}', flush=True)
+        LOG.info("OUTPUT SUBSCRIBED?")
 
     ###############################################################
     # CLEANUP on EXIT SIGNAL (SIGINT or SIGTERM)
@@ -213,9 +383,20 @@ class Deconz2acp():
 
     async def finish(self):
         await self.STOP.wait()
-        print("\n{} Deconz2acp interrupted - disconnecting\n".format(
-            self.ts_string()),file=sys.stderr,flush=True)
+        LOG.info("Deconz2acp interrupted - disconnecting (publish queue %s)", self.publisher.stats())
+        for zigbee_data in self.zigbee_datas:
+            zigbee_data.save_snapshot()
+        if self.stream is not None:
+            await self.stream.close()
+        if self.shards is not None:
+            self.shards.close()
+        if self.local_http is not None:
+            await self.local_http.stop()
         await self.output_client.disconnect()
+        self.publisher.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        logs.stop()
 
 
 ###################################################################
@@ -227,31 +408,44 @@ async def async_main():
         settings_data = sf.read()
 
     # parse file
-    settings = json.loads(settings_data)
+    settings = codec.loads(settings_data)
 
     if "DEBUG" in settings:
         DEBUG = settings["DEBUG"]
 
-    print("{} deconz2acp settings.json loaded DEBUG={}".format(
-                '{:.6f}'.format(time.time()), # ts_string
-                DEBUG),file=sys.stderr,flush=True)
+    # Logging to stderr via a background writer thread
+    logs.setup(settings)
 
-    # Instantiate a ZigBeeData to interface with deCONZ REST API
-    zigbee_data = ZigBeeData(settings)
+    # Json backend for the message path, "auto" picks the fastest installed
+    codec.select(settings.get("json_codec", "auto"))
+
+    LOG.info("deconz2acp settings.json loaded DEBUG=%s json_codec=%s", DEBUG, codec.backend)
+
+    # The shard workers hold the endpoint state, so it is not in the snapshots
+    if "shards" in settings and "state_snapshot" in settings:
+        LOG.warning("deconz2acp state_snapshot is not supported with shards, disabled")
+        del settings["state_snapshot"]
+
+    # Instantiate a ZigBeeData for each gateway to interface with its deCONZ REST API
+    zigbee_datas = [ ZigBeeData(settings, gateway) for gateway in gateway_settings(settings) ]
 
     # Instantiate a Deconz2acp
     deconz_2_acp = Deconz2acp(settings)
 
+    # The REST responses are recorded from the first poll
+    for zigbee_data in zigbee_datas:
+        zigbee_data.recorder = deconz_2_acp.recorder
+
     # Add signal handlers for EXIT and RELOAD
     loop = asyncio.get_event_loop()
     loop.add_signal_handler(signal.SIGINT, deconz_2_acp.ask_exit)
     loop.add_signal_handler(signal.SIGTERM, deconz_2_acp.ask_exit)
 
     # Start the async coroutines.
-    # Note we give deconz_2_acp a reference to zigbee_data
+    # Note we give deconz_2_acp a reference to each zigbee_data
     done, pending = await asyncio.wait(
-        [ deconz_2_acp.start(zigbee_data),
-          zigbee_data.start()],
+        [ asyncio.ensure_future(deconz_2_acp.start(zigbee_datas)) ] +
+        [ asyncio.ensure_future(zigbee_data.start()) for zigbee_data in zigbee_datas ],
          return_when=asyncio.FIRST_COMPLETED)
 
     # This call to 'finish' awaits the 'STOP' event
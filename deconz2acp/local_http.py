@@ -0,0 +1,46 @@
+"""
+local_http provides the LocalHttp class, an aiohttp web server running in the
+deconz2acp event loop for local monitoring, e.g.
+
+    GET /metrics   - Prometheus text format metrics (see metrics.py)
+
+the endpoint state queries of query.py, and the /stream websocket of
+stream.py.
+
+Enabled by the settings.json "local_http" property:
+
+    "local_http": { "host": "127.0.0.1", "port": 8089 }
+"""
+
+import logging
+
+from aiohttp import web
+
+import metrics
+
+LOG = logging.getLogger("local_http")
+
+class LocalHttp(object):
+    """ Local HTTP server, other modules add routes via 'self.app.router'
+    before 'start()'.
+    """
+    def __init__(self, settings):
+        self.host = settings["local_http"].get("host", "127.0.0.1")
+        self.port = settings["local_http"]["port"]
+        self.app = web.Application()
+        self.app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = None
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        LOG.info("LocalHttp listening on http://%s:%s/", self.host, self.port)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def handle_metrics(self, request):
+        return web.Response(text=metrics.render(), content_type="text/plain")
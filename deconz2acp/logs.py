@@ -0,0 +1,155 @@
+"""
+logs configures Python logging for deconz2acp so that logging never blocks
+the event loop:
+
+  - records are passed through a bounded queue to a background thread which
+    does the (possibly slow) writes to stderr, and are dropped (and counted)
+    if that queue is full,
+  - each category (logger name, e.g. "deconz2acp.messages") is rate limited,
+    with the number of suppressed records reported on the next one let through,
+  - records are formatted by the background thread, not the caller, and
+    expensive debug output is wrapped in LazyJson, so it is only formatted if
+    the record is actually going to be written.
+
+Configured by the settings.json "logging" property, e.g.
+
+    "logging": { "level": "INFO",
+                 "rate_limit": 20,
+                 "rate_limits": { "deconz2acp.messages": 1 }
+               }
+
+where rate limits are records per second per category (with bursts of up to
+RATE_BURST seconds' worth). Without "logging", the level is DEBUG if the
+settings "DEBUG" is true, otherwise INFO.
+"""
+
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+import codec
+
+# Defaults for the settings "logging" properties
+LEVEL = "INFO"
+RATE_LIMIT = 20 # records per second per category
+RATE_BURST = 5 # seconds' worth of records allowed in a burst
+QUEUE_SIZE = 10000 # records waiting for the writer thread
+
+class LazyJson(object):
+    """ Json for a log message, only serialized (indented) if the record is
+    formatted. 'data' may be a Json str/bytes or an object.
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        data = self.data
+        if isinstance(data, (str, bytes)):
+            try:
+                data = codec.loads(data)
+            except ValueError:
+                return str(self.data)
+        return codec.dumps_pretty(data)
+
+    # A LazyJson of the data as it is now, for formatting in another thread
+    # (compact serialization is much cheaper than the indented output)
+    def frozen(self):
+        if isinstance(self.data, (str, bytes)):
+            return self
+        try:
+            return LazyJson(codec.dumps(self.data))
+        except (TypeError, ValueError):
+            return LazyJson(repr(self.data))
+
+class RateLimitFilter(logging.Filter):
+    """ Token bucket per category (logger name) """
+    def __init__(self, rate_limit, rate_limits):
+        super().__init__()
+        self.rate_limit = rate_limit
+        self.rate_limits = rate_limits
+        self.buckets = {} # category -> [ tokens, last time, suppressed count ]
+
+    def filter(self, record):
+        now = time.monotonic()
+        rate = self.rate_limits.get(record.name, self.rate_limit)
+        try:
+            bucket = self.buckets[record.name]
+        except KeyError:
+            bucket = self.buckets[record.name] = [ rate * RATE_BURST, now, 0 ]
+        bucket[0] = min(rate * RATE_BURST, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        record.suppressed = bucket[2]
+        bucket[2] = 0
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler which drops records when the queue is full rather than
+    blocking or raising, reporting the count with the next record queued.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # Queue the record itself, to be formatted by the writer thread (the
+    # QueueHandler prepare() formats it here, i.e. on the event loop)
+    def prepare(self, record):
+        if isinstance(record.args, tuple):
+            record.args = tuple(arg.frozen() if isinstance(arg, LazyJson) else arg for arg in record.args)
+        return record
+
+    def enqueue(self, record):
+        if self.dropped:
+            record.msg = "{} [{} log records dropped]".format(record.msg, self.dropped)
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except queue.Full:
+            self.dropped += 1
+
+class Formatter(logging.Formatter):
+    """ '<timestamp> <message>' as the previous print() output, noting suppressed records """
+    def format(self, record):
+        message = "{:.6f} {}".format(record.created, record.getMessage())
+        if getattr(record, "suppressed", 0):
+            message += " [{} similar suppressed]".format(record.suppressed)
+        if record.exc_info:
+            message += "\n" + self.formatException(record.exc_info)
+        return message
+
+listener = None
+
+# Configure the root logger from settings, and start the writer thread
+def setup(settings):
+    global listener
+    log_settings = settings.get("logging", {})
+    level = log_settings.get("level", "DEBUG" if settings.get("DEBUG") else LEVEL)
+
+    log_queue = queue.Queue(log_settings.get("queue_size", QUEUE_SIZE))
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(log_settings.get("rate_limit", RATE_LIMIT),
+                                            log_settings.get("rate_limits", {})))
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(Formatter())
+
+    root = logging.getLogger()
+    root.handlers = [ queue_handler ]
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+
+# Write any queued records and stop the writer thread
+def stop():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
@@ -0,0 +1,184 @@
+"""
+metrics provides Prometheus-style counters, gauges and histograms for the
+deconz2acp message path, and 'render()' which returns them in the Prometheus
+text exposition format (served as /metrics by local_http.LocalHttp).
+
+The metrics are module-level objects, updated in place with e.g.
+
+    metrics.WS_MESSAGES.inc(gateway_name, r, endpoint_id)
+    metrics.STAGE_SECONDS.observe(elapsed, "process")
+
+where the positional arguments after the value are the label values, in the
+order of the metric's 'labels'.
+"""
+
+import asyncio
+import bisect
+
+# Latency buckets (seconds), 10us .. 10s
+LATENCY_BUCKETS = ( 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05,
+                    0.1, 0.5, 1.0, 5.0, 10.0 )
+
+# All metrics, in the order they are rendered
+REGISTRY = []
+
+def format_labels(labels, values, extra=""):
+    pairs = [ '{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+              for label, value in zip(labels, values) ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter(object):
+    """ Monotonic count per combination of label values """
+    type_name = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name + format_labels(self.labels, label_values), value
+
+class Gauge(Counter):
+    """ Value that can go up and down. A gauge set_function() is read when rendered. """
+    type_name = "gauge"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self.functions = {}
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def set_function(self, function, *label_values):
+        self.functions[label_values] = function
+
+    def samples(self):
+        yield from super().samples()
+        for label_values, function in self.functions.items():
+            yield self.name + format_labels(self.labels, label_values), function()
+
+class Histogram(object):
+    """ Distribution of observed values over fixed buckets """
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [ bucket counts..., +Inf count, sum ]
+        self.values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, *label_values):
+        try:
+            counts = self.values[label_values]
+        except KeyError:
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for label_values, counts in self.values.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                extra = 'le="{}"'.format(bucket)
+                yield self.name + "_bucket" + format_labels(self.labels, label_values, extra), cumulative
+            yield self.name + "_sum" + format_labels(self.labels, label_values), counts[-1]
+            yield self.name + "_count" + format_labels(self.labels, label_values), cumulative
+
+# Return all metrics in the Prometheus text exposition format
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.append("# HELP {} {}".format(metric.name, metric.help_text))
+        lines.append("# TYPE {} {}".format(metric.name, metric.type_name))
+        for sample, value in metric.samples():
+            lines.append("{} {}".format(sample, value))
+    return "\n".join(lines) + "\n"
+
+# Measure how late the event loop wakes a sleeping task, i.e. how long
+# callbacks are blocking the loop.
+async def monitor_loop_lag(interval=1.0):
+    loop = asyncio.get_event_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - t0 - interval)
+        LOOP_LAG.set(lag)
+        LOOP_LAG_SECONDS.observe(lag)
+
+###################################################################
+# deconz2acp metrics
+###################################################################
+
+WS_MESSAGES = Counter("deconz2acp_ws_messages_total",
+                      "Websocket messages enriched, per endpoint",
+                      ["gateway", "r", "id"])
+
+UNRESOLVED_MESSAGES = Counter("deconz2acp_unresolved_messages_total",
+                              "Websocket messages not enriched on arrival: 'pending' (buffered for a REST lookup), "
+                              "'pending_full' (buffer full) or 'ignored' (not a sensor or light)",
+                              ["gateway", "reason"])
+
+STAGE_SECONDS = Histogram("deconz2acp_stage_seconds",
+                          "Per-message latency of each stage: 'ring' (websocket recv to worker), "
+                          "'process' (parse and enrich), 'publish' (publish queue to MQTT client)",
+                          ["stage"])
+
+REST_POLL_SECONDS = Histogram("deconz2acp_rest_poll_seconds",
+                              "Duration of each REST API poll of sensors and lights",
+                              ["gateway"])
+
+REST_ERRORS = Counter("deconz2acp_rest_errors_total",
+                      "Failed REST API polls (connection errors, timeouts, error statuses)",
+                      ["gateway"])
+
+RESYNC_MESSAGES = Counter("deconz2acp_resync_messages_total",
+                          "Messages sent for state changes found by a REST resync after a reconnect",
+                          ["gateway"])
+
+RECONNECTS = Counter("deconz2acp_reconnects_total",
+                     "Reconnections after the first connect",
+                     ["connection", "gateway"])
+
+PUBLISH_QUEUE = Gauge("deconz2acp_publish_queue",
+                      "Publish queue 'depth', 'max_depth', 'published' and 'dropped'",
+                      ["value"])
+
+AGGREGATION = Counter("deconz2acp_aggregation_total",
+                      "Messages through the aggregation stage: 'published', 'event' (always published), "
+                      "'duplicate' and 'suppressed' (dropped), 'aggregate' (window messages sent)",
+                      ["result"])
+
+SPOOL = Gauge("deconz2acp_spool",
+              "Disk spool 'messages', 'bytes', 'segments', 'spooled', 'drained' and 'evicted'",
+              ["value"])
+
+QUERIES = Counter("deconz2acp_queries_total",
+                  "Queries of the endpoint state (see query.py): 'device', 'endpoints' or 'websocket'",
+                  ["route"])
+
+STREAM_CLIENTS = Gauge("deconz2acp_stream_clients",
+                       "Websocket clients connected to /stream (see stream.py)")
+
+STREAM_MESSAGES = Counter("deconz2acp_stream_messages_total",
+                          "Messages queued for /stream clients ('queued'), and clients disconnected "
+                          "for falling queue_size messages behind ('slow_consumer')",
+                          ["result"])
+
+LOOP_LAG = Gauge("deconz2acp_event_loop_lag_last_seconds",
+                 "Most recent event loop lag")
+
+LOOP_LAG_SECONDS = Histogram("deconz2acp_event_loop_lag_seconds",
+                             "Event loop lag, sampled every second")
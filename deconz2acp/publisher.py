@@ -0,0 +1,185 @@
+"""
+publisher provides the Publisher class, a bounded queue between the websocket
+ingest (Deconz2acp.handle_input_message) and the MQTT output client.
+
+Messages are queued with 'put()' and published by the 'run()' task, which
+drains the queue in batches so a burst of messages costs a single wakeup. While
+the MQTT broker is disconnected messages are held in the queue (up to
+'queue_size') rather than being published into the void.
+
+When the queue is full the "queue_policy" setting decides what happens:
+    "drop_oldest" (default) - discard the oldest queued message
+    "drop_newest"           - discard the message being queued
+    "block"                 - 'wait_ready()' blocks the websocket reader until
+                              the publisher has caught up
+
+With the "spool" setting, messages produced while the broker is disconnected
+(and any still queued when it disconnects) are appended to an on-disk
+spool.Spool instead, and published at up to "drain_rate" messages per second
+after it reconnects, interleaved with the live messages. Live messages are not
+held back behind the spool (so a backlog larger than drain_rate allows cannot
+delay them indefinitely), which means that while the spool drains an
+endpoint's older spooled messages may be published after its newer live ones:
+consumers must order by "acp_ts", not by arrival.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+import metrics
+from spool import Spool
+
+# Defaults for the settings "output_mqtt" queue properties
+QUEUE_SIZE = 10000
+BATCH_SIZE = 100
+QUEUE_POLICY = "drop_oldest"
+DRAIN_RATE = 1000 # spooled messages published per second after a reconnect
+
+QUEUE_POLICIES = [ "drop_oldest", "drop_newest", "block" ]
+
+LOG = logging.getLogger("publisher")
+
+class Publisher(object):
+    """ Bounded, batching queue of (topic, msg_bytes) to be published via MQTT,
+    with counters for queue depth, drops and publish latency.
+    """
+    def __init__(self, settings):
+        mqtt_settings = settings["output_mqtt"]
+        self.queue_size = mqtt_settings.get("queue_size", QUEUE_SIZE)
+        self.batch_size = mqtt_settings.get("batch_size", BATCH_SIZE)
+        self.policy = mqtt_settings.get("queue_policy", QUEUE_POLICY)
+        if self.policy not in QUEUE_POLICIES:
+            LOG.warning("Publisher unknown queue_policy %s, using %s", self.policy, QUEUE_POLICY)
+            self.policy = QUEUE_POLICY
+
+        # Queue entries are (topic, msg_bytes, perf_counter() when queued)
+        self.queue = collections.deque()
+
+        # Disk spool for broker outages
+        self.spool = None
+        if "spool" in mqtt_settings:
+            self.spool = Spool(mqtt_settings["spool"])
+            self.drain_rate = mqtt_settings["spool"].get("drain_rate", DRAIN_RATE)
+        self.tasks = []
+
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+        self.connected = asyncio.Event()
+
+        # Counters
+        self.published = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.latency_total = 0.0 # seconds from put() to publish, summed over self.published
+        self.latency_max = 0.0
+
+    # Queue a message for publishing. Returns False if the message was dropped.
+    def put(self, topic, msg_bytes):
+        if self.spool is not None and not self.connected.is_set():
+            self.spool.append(topic, msg_bytes)
+            return True
+        if len(self.queue) >= self.queue_size:
+            if self.policy == "drop_newest":
+                self.dropped += 1
+                return False
+            if self.policy == "drop_oldest":
+                self.queue.popleft()
+                self.dropped += 1
+            # "block" accepts the message, the reader is held back by wait_ready()
+            self.not_full.clear()
+        self.queue.append((topic, msg_bytes, time.perf_counter()))
+        depth = len(self.queue)
+        if depth > self.max_depth:
+            self.max_depth = depth
+        self.not_empty.set()
+        return True
+
+    # With the "block" policy, wait until the queue has room
+    async def wait_ready(self):
+        if self.policy == "block":
+            while len(self.queue) >= self.queue_size:
+                self.not_full.clear()
+                await self.not_full.wait()
+
+    # Called from the MQTT client on_connect / on_disconnect callbacks
+    def set_connected(self, connected):
+        if connected:
+            self.connected.set()
+        else:
+            self.connected.clear()
+            if self.spool is not None and self.queue:
+                # Anything not yet published goes to the spool, ahead of later messages
+                for topic, msg_bytes, queued in self.queue:
+                    self.spool.append(topic, msg_bytes)
+                self.queue.clear()
+                self.not_empty.clear()
+                self.not_full.set()
+
+    # Publish up to batch_size queued messages via 'client', return number published
+    def flush(self, client):
+        count = 0
+        queue = self.queue
+        perf_counter = time.perf_counter
+        observe = metrics.STAGE_SECONDS.observe
+        while queue and count < self.batch_size:
+            topic, msg_bytes, queued = queue.popleft()
+            client.publish(topic, msg_bytes, qos=0)
+            latency = perf_counter() - queued
+            observe(latency, "publish")
+            self.latency_total += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+            count += 1
+        self.published += count
+        if len(queue) < self.queue_size:
+            self.not_full.set()
+        if not queue:
+            self.not_empty.clear()
+        return count
+
+    # Publisher task: publish batches while connected and there is anything queued
+    async def run(self, client):
+        if self.spool is not None:
+            self.tasks = [ asyncio.ensure_future(self.spool.run()),
+                           asyncio.ensure_future(self.drain(client)) ]
+        while True:
+            await self.not_empty.wait()
+            await self.connected.wait()
+            self.flush(client)
+            # Let the websocket reader run between batches
+            await asyncio.sleep(0)
+
+    # Spool drain task: publish spooled messages at up to drain_rate while
+    # connected, interleaved with (not ordered before) the live messages
+    async def drain(self, client):
+        spool = self.spool
+        while True:
+            await spool.not_empty.wait()
+            await self.connected.wait()
+            batch = spool.read_batch(self.batch_size)
+            for topic, msg_bytes in batch:
+                client.publish(topic, msg_bytes, qos=0)
+            self.published += len(batch)
+            await asyncio.sleep(len(batch) / self.drain_rate)
+
+    # Write out the spool before exit
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.spool is not None:
+            self.spool.close()
+
+    def stats(self):
+        stats = { "depth": len(self.queue),
+                  "max_depth": self.max_depth,
+                  "published": self.published,
+                  "dropped": self.dropped,
+                  "latency_avg": self.latency_total / self.published if self.published else 0.0,
+                  "latency_max": self.latency_max
+                }
+        if self.spool is not None:
+            stats["spooled"] = len(self.spool)
+        return stats
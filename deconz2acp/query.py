@@ -0,0 +1,114 @@
+"""
+query provides the Query class, routes on the LocalHttp server which answer
+queries for the latest state of the endpoints known to deconz2acp, from the
+ZigBeeData indexes (see ZigBeeData.find_endpoints), so a client need not
+subscribe to every message to rebuild it:
+
+    GET /devices/<key>     the endpoints of one device, by acp_id, uniqueid or
+                           MAC address, e.g. /devices/aqa-wd-5747f1
+    GET /endpoints?<filters>
+                           the endpoints matching all the filters, e.g.
+                           /endpoints?type=ZHAOpenClose&gateway=lab
+    GET /query             a websocket, each text message a Json object of
+                           filters, e.g. {"type": "ZHAOpenClose"}, answered
+                           with the matching endpoints
+
+Filters are "acp_id", "uniqueid", "mac", "type", "modelid", "r" and "gateway".
+Responses are Json { "endpoints": [ ... ] }, each endpoint with its "acp_id",
+"r", "id", "uniqueid", "type", "modelid", "state", "config" and (if the
+gateway is named) "acp_gateway".
+
+Served when the settings.json "local_http" property is set.
+"""
+
+import logging
+
+from aiohttp import web, WSMsgType
+
+import codec
+import metrics
+
+LOG = logging.getLogger("query")
+
+# Query filter -> ZigBeeData.find_endpoints argument
+FILTERS = { "acp_id": "acp_id",
+            "uniqueid": "uniqueid",
+            "mac": "mac",
+            "type": "endpoint_type",
+            "modelid": "modelid",
+            "r": "r" }
+
+class QueryError(Exception):
+    pass
+
+class Query(object):
+    """ Query routes over the ZigBeeData of each gateway """
+    def __init__(self, zigbee_datas):
+        self.zigbee_datas = zigbee_datas
+
+    def add_routes(self, app):
+        app.router.add_get("/devices/{key}", self.handle_device)
+        app.router.add_get("/endpoints", self.handle_endpoints)
+        app.router.add_get("/query", self.handle_query_ws)
+
+    # [ zigbee_data ] of the gateway named, or all of them
+    def gateways(self, gateway_name):
+        if gateway_name is None:
+            return self.zigbee_datas
+        return [ zigbee_data for zigbee_data in self.zigbee_datas if zigbee_data.gateway_name == gateway_name ]
+
+    # Return the endpoint dicts matching 'filters' (a dict of filter -> value)
+    def find(self, filters):
+        unknown = set(filters) - set(FILTERS) - set([ "gateway" ])
+        if unknown:
+            raise QueryError("unknown filters {}".format(", ".join(sorted(unknown))))
+        arguments = { FILTERS[name]: value for name, value in filters.items() if name in FILTERS }
+        results = []
+        for zigbee_data in self.gateways(filters.get("gateway")):
+            results += [ self.endpoint_dict(zigbee_data, endpoint)
+                         for endpoint in zigbee_data.find_endpoints(**arguments) ]
+        return results
+
+    def endpoint_dict(self, zigbee_data, endpoint):
+        endpoint_dict = endpoint.as_dict()
+        if zigbee_data.gateway_name:
+            endpoint_dict["acp_gateway"] = zigbee_data.gateway_name
+        return endpoint_dict
+
+    def json_response(self, body, status=200):
+        return web.Response(body=codec.dumps(body), status=status, content_type="application/json")
+
+    async def handle_device(self, request):
+        metrics.QUERIES.inc("device")
+        key = request.match_info["key"]
+        results = []
+        for zigbee_data in self.gateways(request.query.get("gateway")):
+            results += [ self.endpoint_dict(zigbee_data, endpoint) for endpoint in zigbee_data.find_device(key) ]
+        if not results:
+            return self.json_response({ "error": "no device {}".format(key) }, status=404)
+        return self.json_response({ "endpoints": results })
+
+    async def handle_endpoints(self, request):
+        metrics.QUERIES.inc("endpoints")
+        try:
+            return self.json_response({ "endpoints": self.find(dict(request.query)) })
+        except QueryError as e:
+            return self.json_response({ "error": str(e) }, status=400)
+
+    async def handle_query_ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        LOG.info("Query websocket from %s", request.remote)
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            metrics.QUERIES.inc("websocket")
+            try:
+                filters = codec.loads(msg.data)
+                if not isinstance(filters, dict):
+                    raise QueryError("a query is a Json object of filters")
+                response = { "query": filters, "endpoints": self.find(filters) }
+            except (QueryError, ValueError, TypeError) as e:
+                response = { "error": str(e) }
+            await ws.send_str(codec.dumps(response).decode('utf-8'))
+        return ws
@@ -0,0 +1,283 @@
+"""
+recording provides the Recorder class, which records the websocket frames
+received, the REST API responses and the enriched messages published by
+deconz2acp, and the Recording class which reads them back (see replay.py).
+
+A recording file is a sequence of independent chunks, each of up to
+'chunk_records' records stored column by column:
+
+    header   magic "DZRC", version, record count, min/max timestamp,
+             string table length, body length
+    strings  newline-separated gateway names and endpoint keys ("sensors/2",
+             or "sensors" for a full REST response) used in this chunk
+    body     zlib compressed columns:
+                 kind      uint8   KIND_WS, KIND_REST or KIND_OUT
+                 ts        float64 time.time() the record was made
+                 gateway   uint16  index into strings
+                 endpoint  uint32  index into strings
+                 length    uint32  payload length
+                 payloads  the frame/response/message bytes, concatenated
+
+The headers and string tables are uncompressed, so the index of a recording
+(which chunks cover which times and endpoints) is built by reading just those,
+and only the chunks selected are decompressed. A chunk is only written once
+complete, so a recording cut short by a crash is still readable.
+
+Enabled by the settings.json "recorder" property, e.g.
+
+    "recorder": { "file": "recordings/deconz2acp-%Y-%m-%d.dzr" }
+
+where the file name is formatted with time.strftime (UTC), so the pattern above
+starts a new file each day.
+"""
+
+import array
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import os
+import re
+import struct
+import sys
+import time
+import zlib
+
+LOG = logging.getLogger("recording")
+
+# Defaults for the settings "recorder" properties
+CHUNK_RECORDS = 4096 # records per chunk
+CHUNK_INTERVAL = 10 # seconds, a partly filled chunk is written after this long
+COMPRESS_LEVEL = 1
+
+KIND_WS = 0 # websocket frame received
+KIND_REST = 1 # REST API response
+KIND_OUT = 2 # enriched message published
+KIND_NAMES = [ "ws", "rest", "out" ]
+
+MAGIC = b"DZRC"
+VERSION = 1
+CHUNK_HEADER = struct.Struct("<4sB3xIddII")
+
+# Column types, in the order they are stored in the chunk body
+COLUMNS = ( ("kind", "B"), ("ts", "d"), ("gateway", "H"), ("endpoint", "I"), ("length", "I") )
+
+# Endpoint key of a record, e.g. "sensors/2", or "sensors" for a full REST response
+def endpoint_key(r, endpoint_id=None):
+    if r is None:
+        return ""
+    return r if endpoint_id is None else "{}/{}".format(r, endpoint_id)
+
+# The "r" and "id" of a websocket frame (bytes), without parsing it
+FRAME_R_RE = re.compile(rb'"r"\s*:\s*"([^"]*)"')
+FRAME_ID_RE = re.compile(rb'"id"\s*:\s*"([^"]*)"')
+
+# The endpoint key of a websocket frame (bytes) not otherwise parsed
+def frame_endpoint_key(frame):
+    r = FRAME_R_RE.search(frame)
+    endpoint_id = FRAME_ID_RE.search(frame)
+    return endpoint_key(r and r.group(1).decode('utf-8'), endpoint_id and endpoint_id.group(1).decode('utf-8'))
+
+# Return (r, endpoint_id) from an endpoint key, endpoint_id is None for "sensors"
+def parse_endpoint_key(key):
+    r, _, endpoint_id = key.partition("/")
+    return r, (endpoint_id or None)
+
+# Columns are stored little-endian
+def column_bytes(column):
+    if sys.byteorder == "big":
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+def column_from_bytes(typecode, data):
+    column = array.array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+# Return the bytes of a chunk from its columns
+def encode_chunk(kinds, timestamps, gateways, endpoints, payloads, strings):
+    lengths = array.array("I", [ len(payload) for payload in payloads ])
+    body = b"".join([ column_bytes(kinds),
+                      column_bytes(timestamps),
+                      column_bytes(gateways),
+                      column_bytes(endpoints),
+                      column_bytes(lengths) ] + payloads)
+    body = zlib.compress(body, COMPRESS_LEVEL)
+    strings_bytes = "\n".join(strings).encode('utf-8')
+    header = CHUNK_HEADER.pack(MAGIC, VERSION, len(kinds), min(timestamps), max(timestamps),
+                               len(strings_bytes), len(body))
+    return header + strings_bytes + body
+
+class Recorder(object):
+    """ Buffers records as columns and appends them to the recording file a
+    chunk at a time. Compression and writes run on a worker thread.
+    """
+    def __init__(self, settings):
+        recorder_settings = settings["recorder"]
+        self.file_pattern = recorder_settings["file"]
+        self.chunk_records = recorder_settings.get("chunk_records", CHUNK_RECORDS)
+        self.chunk_interval = recorder_settings.get("chunk_interval", CHUNK_INTERVAL)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.recorded = 0
+        self.new_chunk()
+
+    def new_chunk(self):
+        self.kinds = array.array("B")
+        self.timestamps = array.array("d")
+        self.gateways = array.array("H")
+        self.endpoints = array.array("I")
+        self.payloads = []
+        self.strings = {} # string -> index in the chunk string table
+
+    def string_index(self, string):
+        try:
+            return self.strings[string]
+        except KeyError:
+            index = self.strings[string] = len(self.strings)
+            return index
+
+    # Add a record, 'payload' is bytes or str
+    def record(self, kind, gateway_name, key, payload, ts=None):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.kinds.append(kind)
+        self.timestamps.append(time.time() if ts is None else ts)
+        self.gateways.append(self.string_index(gateway_name))
+        self.endpoints.append(self.string_index(key))
+        self.payloads.append(payload)
+        self.recorded += 1
+        if len(self.kinds) >= self.chunk_records:
+            self.flush()
+
+    # Write the buffered records as a chunk, in the background if called from
+    # the event loop
+    def flush(self):
+        if not self.kinds:
+            return
+        chunk = (self.kinds, self.timestamps, self.gateways, self.endpoints, self.payloads,
+                 list(self.strings))
+        filename = time.strftime(self.file_pattern, time.gmtime(self.timestamps[0]))
+        self.new_chunk()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.write_chunk(filename, chunk)
+        else:
+            loop.run_in_executor(self.executor, self.write_chunk, filename, chunk)
+
+    def write_chunk(self, filename, chunk):
+        try:
+            chunk_bytes = encode_chunk(*chunk)
+            directory = os.path.dirname(filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(filename, 'ab') as f:
+                f.write(chunk_bytes)
+        except (OSError, ValueError, OverflowError) as e:
+            LOG.error("Recorder chunk of %s records not written to %s: %r", len(chunk[0]), filename, e)
+
+    # Recorder task: write partly filled chunks every chunk_interval
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.chunk_interval)
+            self.flush()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+class ChunkIndex(object):
+    """ The header of one chunk of a Recording """
+    __slots__ = ("offset", "count", "ts_min", "ts_max", "strings", "body_offset", "body_length")
+
+    def __init__(self, offset, count, ts_min, ts_max, strings, body_offset, body_length):
+        self.offset = offset
+        self.count = count
+        self.ts_min = ts_min
+        self.ts_max = ts_max
+        self.strings = strings
+        self.body_offset = body_offset
+        self.body_length = body_length
+
+class Recording(object):
+    """ Reads a recording file, indexed by chunk time range and endpoints """
+    def __init__(self, filename):
+        self.filename = filename
+        self.chunks = []
+        with open(filename, 'rb') as f:
+            offset = 0
+            while True:
+                header = f.read(CHUNK_HEADER.size)
+                if len(header) < CHUNK_HEADER.size:
+                    break
+                magic, version, count, ts_min, ts_max, strings_length, body_length = CHUNK_HEADER.unpack(header)
+                if magic != MAGIC or version != VERSION:
+                    LOG.warning("Recording %s has an unknown chunk at %s, ignoring the rest", filename, offset)
+                    break
+                strings_bytes = f.read(strings_length)
+                body_offset = offset + CHUNK_HEADER.size + strings_length
+                f.seek(body_length, os.SEEK_CUR)
+                if len(strings_bytes) < strings_length or f.tell() > os.fstat(f.fileno()).st_size:
+                    break # incomplete chunk at the end
+                strings = strings_bytes.decode('utf-8').split("\n")
+                self.chunks.append(ChunkIndex(offset, count, ts_min, ts_max, strings, body_offset, body_length))
+                offset = body_offset + body_length
+
+    def __len__(self):
+        return sum(chunk.count for chunk in self.chunks)
+
+    # Return the chunks which may have records between start and end (time.time()
+    # values, None for unbounded) for any of 'keys' (None for all)
+    def select_chunks(self, start=None, end=None, keys=None):
+        selected = []
+        for chunk in self.chunks:
+            if start is not None and chunk.ts_max < start:
+                continue
+            if end is not None and chunk.ts_min > end:
+                continue
+            if keys is not None and not any(key in chunk.strings for key in keys):
+                continue
+            selected.append(chunk)
+        return selected
+
+    # Return the columns of a chunk as { name: array, "payloads": [ bytes ] }
+    def read_columns(self, chunk):
+        with open(self.filename, 'rb') as f:
+            f.seek(chunk.body_offset)
+            body = zlib.decompress(f.read(chunk.body_length))
+        columns = {}
+        offset = 0
+        for name, typecode in COLUMNS:
+            size = array.array(typecode).itemsize * chunk.count
+            columns[name] = column_from_bytes(typecode, body[offset:offset + size])
+            offset += size
+        ends = list(itertools.accumulate(columns["length"], initial=offset))
+        columns["payloads"] = [ body[ends[i]:ends[i + 1]] for i in range(chunk.count) ]
+        return columns
+
+    # Yield (kind, ts, gateway_name, key, payload) in recorded order, filtered
+    # by time range, endpoint keys and kinds (None for all)
+    def records(self, start=None, end=None, keys=None, kinds=None):
+        for chunk in self.select_chunks(start, end, keys):
+            columns = self.read_columns(chunk)
+            strings = chunk.strings
+            key_indexes = None if keys is None else set(i for i, s in enumerate(strings) if s in keys)
+            kind_column = columns["kind"]
+            ts_column = columns["ts"]
+            gateway_column = columns["gateway"]
+            endpoint_column = columns["endpoint"]
+            payloads = columns["payloads"]
+            for i in range(chunk.count):
+                ts = ts_column[i]
+                if start is not None and ts < start:
+                    continue
+                if end is not None and ts > end:
+                    continue
+                if key_indexes is not None and endpoint_column[i] not in key_indexes:
+                    continue
+                if kinds is not None and kind_column[i] not in kinds:
+                    continue
+                yield kind_column[i], ts, strings[gateway_column[i]], strings[endpoint_column[i]], payloads[i]
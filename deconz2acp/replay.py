@@ -0,0 +1,327 @@
+"""
+replay reads recordings made by deconz2acp with the "recorder" setting (see
+recording.py), and feeds them back through the deconz2acp pipeline, e.g. to
+reprocess a day of traffic after a decoder has changed.
+
+Usage (from the deconz2acp directory):
+
+    python3 replay.py import ../sensor_data/2020-04-28.json ../sensor_data/2020-04-29.json -o capture.dzr
+    python3 replay.py info capture.dzr
+    python3 replay.py dump capture.dzr --kind ws --endpoint sensors/2
+    python3 replay.py replay capture.dzr > published.txt
+    python3 replay.py replay capture.dzr --speed 1 --mqtt --settings settings.json
+    python3 replay.py replay capture.dzr --output reprocessed.dzr
+
+'replay' applies the recorded REST responses and websocket frames in order,
+at maximum speed (the default, '--speed 0'), in real time ('--speed 1') or
+N times real time ('--speed N'). Enriched messages keep the recorded arrival
+time as "acp_ts". They are written to stdout as '<topic> <message>' lines,
+to a new recording ('--output'), or published to the settings.json MQTT
+broker ('--mqtt').
+
+'import' converts the pretty-printed Json captures in ../sensor_data into a
+recording, with REST responses synthesized from the captured messages and
+timestamps from their "lastupdated".
+"""
+
+import argparse
+import asyncio
+import calendar
+import collections
+import os
+import sys
+import time
+
+import codec
+from captures import load_capture, CaptureRestData
+from deconz2acp import Deconz2acp
+from publisher import Publisher
+from recording import Recorder, Recording, KIND_WS, KIND_REST, KIND_OUT, KIND_NAMES, \
+                      endpoint_key, parse_endpoint_key
+from zigbee_data import ZigBeeData
+
+# Settings used without --settings
+REPLAY_SETTINGS = {
+    "DEBUG": False,
+    "output_mqtt": { "topic_prefix": "" }
+}
+
+# Settings not applied to a replay, which has no live gateway or local state
+IGNORED_SETTINGS = [ "recorder", "state_snapshot", "local_http", "gateways", "deconz_api", "input_ws" ]
+
+# Return time.time() from a float, or an ISO 8601 UTC time e.g. "2020-04-29T10:00:00"
+def parse_time(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return calendar.timegm(time.strptime(value, "%Y-%m-%dT%H:%M:%S"))
+
+# Return time.time() of the "lastupdated" of a captured message, or None
+def lastupdated_time(msg_dict):
+    lastupdated = msg_dict.get("state", {}).get("lastupdated")
+    if not lastupdated or lastupdated == "none":
+        return None
+    return calendar.timegm(time.strptime(lastupdated, "%Y-%m-%dT%H:%M:%S"))
+
+def format_time(ts):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ts)) + "{:.3f}".format(ts % 1)[1:]
+
+###################################################################
+# import
+###################################################################
+
+# Return the records (kind, ts, gateway_name, key, payload) of sensor_data
+# Json captures, as they would have been recorded
+def capture_records(filenames):
+    messages = []
+    for filename in filenames:
+        messages += load_capture(filename)
+    rest_data = CaptureRestData(messages)
+
+    # Captured messages carry no arrival time, use "lastupdated" where there
+    # is one, kept in order
+    timestamps = [ lastupdated_time(msg_dict) for msg_dict in messages ]
+    ts = next((msg_ts for msg_ts in timestamps if msg_ts is not None), time.time())
+    records = []
+    for r in [ "sensors", "lights" ]:
+        records.append((KIND_REST, ts, "", endpoint_key(r), codec.dumps(rest_data.endpoints[r])))
+    for msg_dict, msg_ts in zip(messages, timestamps):
+        if msg_ts is not None and msg_ts > ts:
+            ts = msg_ts
+        records.append((KIND_WS, ts, "", endpoint_key(msg_dict.get("r"), msg_dict.get("id")),
+                        codec.dumps(msg_dict)))
+    return records
+
+def run_import(args):
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    recorder = Recorder({ "recorder": { "file": args.output.replace("%", "%%") } })
+    for kind, ts, gateway_name, key, payload in capture_records(args.captures):
+        recorder.record(kind, gateway_name, key, payload, ts=ts)
+    recorder.close()
+    print("{} records written to {}".format(recorder.recorded, args.output))
+
+###################################################################
+# info and dump
+###################################################################
+
+def run_info(args):
+    t0 = time.perf_counter()
+    recording = Recording(args.recording)
+    index_seconds = time.perf_counter() - t0
+    size = os.path.getsize(args.recording)
+    count = len(recording)
+    print("file:             {} ({} bytes, {:.1f} bytes/record)".format(
+        args.recording, size, size / count if count else 0))
+    print("chunks:           {} (indexed in {:.1f} ms)".format(len(recording.chunks), index_seconds * 1000))
+    if not count:
+        return
+    print("time:             {} .. {}".format(format_time(min(c.ts_min for c in recording.chunks)),
+                                              format_time(max(c.ts_max for c in recording.chunks))))
+    kinds = collections.Counter()
+    endpoints = collections.Counter()
+    t0 = time.perf_counter()
+    for chunk in recording.chunks:
+        columns = recording.read_columns(chunk)
+        kinds.update(columns["kind"])
+        endpoints.update(chunk.strings[i] for i in columns["endpoint"])
+    read_seconds = time.perf_counter() - t0
+    print("records:          {} ({}) read at {:.0f} records/sec".format(
+        count, ", ".join("{} {}".format(KIND_NAMES[kind], kinds[kind]) for kind in sorted(kinds)),
+        count / read_seconds if read_seconds else 0))
+    print("endpoints:        {}".format(
+        ", ".join("{} {}".format(key or "-", n) for key, n in sorted(endpoints.items()))))
+
+def record_filters(args):
+    keys = args.endpoint
+    kinds = None if not args.kind else set(KIND_NAMES.index(kind) for kind in args.kind)
+    return parse_time(args.start), parse_time(args.end), keys, kinds
+
+def run_dump(args):
+    recording = Recording(args.recording)
+    start, end, keys, kinds = record_filters(args)
+    for kind, ts, gateway_name, key, payload in recording.records(start, end, keys, kinds):
+        print("{:.6f} {} {} {} {}".format(ts, KIND_NAMES[kind], gateway_name or "-", key or "-",
+                                          payload.decode('utf-8', 'replace')))
+
+###################################################################
+# replay
+###################################################################
+
+class ReplayOutput(object):
+    """ Stands in for the gmqtt Client, writing what would be published to
+    stdout, or to a new recording with the recorded time of the input.
+    """
+    def __init__(self, recorder=None):
+        self.recorder = recorder
+        self.ts = None # time of the record being replayed
+        self.count = 0
+
+    def publish(self, topic, msg_bytes, qos=0):
+        self.count += 1
+        if self.recorder is None:
+            sys.stdout.write("{} {}\n".format(topic, msg_bytes.decode('utf-8')))
+            return
+        msg_dict = codec.loads(msg_bytes)
+        self.recorder.record(KIND_OUT, msg_dict.get("acp_gateway", ""),
+                             endpoint_key(msg_dict.get("r"), msg_dict.get("id")), msg_bytes, ts=self.ts)
+
+class Replayer(object):
+    """ Applies recorded REST responses and websocket frames to a Deconz2acp
+    and the ZigBeeData of each recorded gateway.
+    """
+    def __init__(self, settings):
+        self.settings = { key: value for key, value in settings.items() if key not in IGNORED_SETTINGS }
+        self.deconz_2_acp = Deconz2acp(self.settings)
+        self.deconz_2_acp.publisher = Publisher(self.settings)
+        self.deconz_2_acp.zigbee_datas = []
+        self.zigbee_datas = {}
+
+    def zigbee_data(self, gateway_name):
+        try:
+            return self.zigbee_datas[gateway_name]
+        except KeyError:
+            gateway = { "name": gateway_name, "deconz_api": { "url": "" }, "input_ws": { "url": "" } }
+            zigbee_data = self.zigbee_datas[gateway_name] = ZigBeeData(self.settings, gateway)
+            zigbee_data.output = self.deconz_2_acp.send_enriched_message
+            zigbee_data.removed = self.deconz_2_acp.endpoint_removed
+            self.deconz_2_acp.zigbee_datas.append(zigbee_data)
+            return zigbee_data
+
+    # Apply one record, returns True if it was a websocket frame
+    def handle(self, kind, ts, gateway_name, key, payload):
+        zigbee_data = self.zigbee_data(gateway_name)
+        if kind == KIND_REST:
+            r, endpoint_id = parse_endpoint_key(key)
+            if endpoint_id is None:
+                zigbee_data.handle_rest_response(r, codec.loads(payload))
+            else:
+                zigbee_data.handle_endpoint_rest(r, endpoint_id, codec.loads(payload))
+        elif kind == KIND_WS:
+            self.deconz_2_acp.handle_input_message(payload, zigbee_data, ts)
+            return True
+        return False
+
+async def replay(args, settings):
+    replayer = Replayer(settings)
+    deconz_2_acp = replayer.deconz_2_acp
+    publisher = deconz_2_acp.publisher
+    recorder = None
+    if args.mqtt:
+        deconz_2_acp.STOP = asyncio.Event()
+        await deconz_2_acp.connect_output_mqtt()
+        await asyncio.wait_for(publisher.connected.wait(), 10)
+        client = deconz_2_acp.output_client
+    else:
+        if args.output:
+            if os.path.exists(args.output):
+                os.remove(args.output)
+            recorder = Recorder({ "recorder": { "file": args.output.replace("%", "%%") } })
+        client = ReplayOutput(recorder)
+        publisher.set_connected(True)
+
+    recording = Recording(args.recording)
+    start, end, keys, kinds = record_filters(args)
+    if keys is not None:
+        # The full REST responses for the endpoints selected
+        keys = set(keys) | set(parse_endpoint_key(key)[0] for key in keys)
+    kinds = set([ KIND_WS, KIND_REST ]) if kinds is None else kinds - set([ KIND_OUT ])
+
+    frames = 0
+    t0 = time.perf_counter()
+    first_ts = None
+    # Records from before 'start' are read for their REST responses, so the
+    # endpoints are known from the first frame replayed
+    for kind, ts, gateway_name, key, payload in recording.records(None, end, keys, kinds):
+        if start is not None and ts < start:
+            if kind == KIND_REST:
+                replayer.handle(kind, ts, gateway_name, key, payload)
+            continue
+        if args.speed > 0:
+            if first_ts is None:
+                first_ts = ts
+            delay = t0 + (ts - first_ts) / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if isinstance(client, ReplayOutput):
+            client.ts = ts
+        if replayer.handle(kind, ts, gateway_name, key, payload):
+            frames += 1
+        while publisher.flush(client):
+            pass
+        if args.mqtt and frames % 100 == 0:
+            # let gmqtt write
+            await asyncio.sleep(0)
+    elapsed = time.perf_counter() - t0
+
+    if deconz_2_acp.aggregator is not None:
+        # The windows still open at the end of the recording
+        deconz_2_acp.aggregator.emit_ended_windows(float("inf"))
+        while publisher.flush(client):
+            pass
+    if recorder is not None:
+        recorder.close()
+    if args.mqtt:
+        await asyncio.sleep(1)
+        await deconz_2_acp.output_client.disconnect()
+
+    sys.stderr.write("{} websocket frames replayed in {:.3f}s ({:.0f} frames/sec), {} published\n".format(
+        frames, elapsed, frames / elapsed if elapsed else 0, publisher.published))
+
+def run_replay(args):
+    settings = REPLAY_SETTINGS
+    if args.settings:
+        with open(args.settings, 'r') as f:
+            settings = codec.loads(f.read())
+        codec.select(settings.get("json_codec", "auto"))
+    elif args.mqtt:
+        sys.exit("--mqtt needs --settings for the output_mqtt broker")
+    asyncio.run(replay(args, settings))
+
+###################################################################
+# Program main
+###################################################################
+
+def add_filter_arguments(parser):
+    parser.add_argument("--start", help="from this time (time.time() value or UTC e.g. 2020-04-29T10:00:00)")
+    parser.add_argument("--end", help="up to this time")
+    parser.add_argument("--endpoint", action="append",
+                        help="only this endpoint, e.g. sensors/2 (may be repeated)")
+    parser.add_argument("--kind", action="append", choices=KIND_NAMES,
+                        help="only this kind of record (may be repeated)")
+
+def main():
+    parser = argparse.ArgumentParser(description="deconz2acp recording tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="convert sensor_data Json captures to a recording")
+    import_parser.add_argument("captures", nargs="+", help="capture files")
+    import_parser.add_argument("-o", "--output", required=True, help="recording file to write")
+    import_parser.set_defaults(func=run_import)
+
+    info_parser = subparsers.add_parser("info", help="summary of a recording")
+    info_parser.add_argument("recording")
+    info_parser.set_defaults(func=run_info)
+
+    dump_parser = subparsers.add_parser("dump", help="print the records of a recording")
+    dump_parser.add_argument("recording")
+    add_filter_arguments(dump_parser)
+    dump_parser.set_defaults(func=run_dump)
+
+    replay_parser = subparsers.add_parser("replay", help="feed a recording through the deconz2acp pipeline")
+    replay_parser.add_argument("recording")
+    add_filter_arguments(replay_parser)
+    replay_parser.add_argument("--speed", type=float, default=0,
+                               help="0 for maximum speed (default), 1 for real time, N for N times real time")
+    replay_parser.add_argument("--settings", help="settings.json, e.g. for aggregation or output_mqtt")
+    replay_parser.add_argument("--output", help="write the published messages to this recording")
+    replay_parser.add_argument("--mqtt", action="store_true", help="publish to the settings output_mqtt broker")
+    replay_parser.set_defaults(func=run_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+ring_buffer provides the RingBuffer class used to pass raw websocket frames
+(with their arrival time) from the websocket reader coroutine to the
+processing worker coroutines in Deconz2acp, and 'shard_index(frame, shards)' which picks the worker for a frame.
+
+Frames for the same endpoint always go to the same worker, so each endpoint's
+messages are processed in the order they were received (which EndPoint.add_event
+relies on to detect state changes).
+"""
+
+import asyncio
+import re
+
+# Matches the first "id" property of a deCONZ websocket frame, which is the
+# top-level endpoint id (e.g. {"e":"changed","id":"2","r":"sensors",...}).
+# Sharding on "id" alone is sufficient: "sensors/2" and "lights/2" sharing
+# a worker costs nothing, only that each endpoint stays on one worker.
+ID_RE = re.compile(r'"id"\s*:\s*"([^"]*)"')
+ID_BYTES_RE = re.compile(rb'"id"\s*:\s*"([^"]*)"')
+
+# Return the index (0..shards-1) of the worker that should process this frame
+def shard_index(frame, shards):
+    if shards == 1:
+        return 0
+    match = (ID_BYTES_RE if isinstance(frame, bytes) else ID_RE).search(frame)
+    if match is None:
+        return 0
+    return hash(match.group(1)) % shards
+
+class RingBuffer(object):
+    """ Fixed capacity FIFO of frames for a single consumer. The producer
+    awaits 'wait_space()' when the buffer is full, so frames are never lost
+    here, the websocket (i.e. TCP) provides the backpressure.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.head = 0 # next slot to read
+        self.count = 0
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+
+    def __len__(self):
+        return self.count
+
+    # Append a frame, returns False (frame not added) if the buffer is full
+    def push(self, frame):
+        if self.count == self.capacity:
+            self.not_full.clear()
+            return False
+        self.slots[(self.head + self.count) % self.capacity] = frame
+        self.count += 1
+        self.not_empty.set()
+        return True
+
+    async def wait_space(self):
+        while self.count == self.capacity:
+            self.not_full.clear()
+            await self.not_full.wait()
+
+    # Remove and return up to max_frames frames, oldest first
+    def pop_batch(self, max_frames):
+        frames = []
+        slots = self.slots
+        while self.count and len(frames) < max_frames:
+            frames.append(slots[self.head])
+            slots[self.head] = None
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+        if not self.count:
+            self.not_empty.clear()
+        self.not_full.set()
+        return frames
+
+    async def wait_frames(self):
+        await self.not_empty.wait()
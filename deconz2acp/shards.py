@@ -0,0 +1,470 @@
+"""
+shards provides the Shards class, an optional multi-process mode for hosts
+which aggregate several busy gateways and would otherwise be limited to one
+core: the main (front) process keeps the websocket connections, REST polling,
+publisher, recorder and local HTTP server, while the parsing, enrichment,
+aggregation and Json encoding of websocket frames run in 'workers' worker
+processes.
+
+Frames are sharded by endpoint id (see ring_buffer.shard_index), so each
+worker owns the EndPoint state of its shard and each endpoint's messages stay
+in order. Every worker gets the REST API responses (and resync requests) of
+every gateway, so it knows all the endpoint names and decoders. A worker
+which gets frames from an endpoint it does not know yet asks the front
+process to look the endpoint up.
+
+Records are passed through shared memory rings (ShmRing), one from the front
+process to each worker and one back, rather than pickled through queues:
+
+    front -> worker   FRAME   a websocket frame as received
+                      REST    a REST API response, "sensors" or "sensors/<id>"
+    worker -> front   OUTPUT  an enriched message, serialized, with the topic
+                              and the properties the recorder and /stream need
+                      LOOKUP  an endpoint to look up via the REST API
+
+Enabled by the settings.json "shards" property, e.g.
+
+    "shards": { "workers": 4, "ring_size": 4194304 }
+
+With shards, "state_snapshot" is not supported and the metrics of the
+worker processes are not included in /metrics. The query API of query.py
+returns endpoint metadata without "state" or "config".
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import struct
+import time
+from multiprocessing import shared_memory
+
+import codec
+import logs
+from aggregator import WINDOW_CHECK_INTERVAL
+from deconz2acp import Deconz2acp
+from recording import endpoint_key, parse_endpoint_key
+from ring_buffer import shard_index
+from zigbee_data import ZigBeeData, gateway_settings
+
+LOG = logging.getLogger("shards")
+
+# Defaults for the settings "shards" properties
+WORKERS = 2
+RING_SIZE = 4 * 1024 * 1024 # bytes, each direction for each worker
+
+# Settings the worker processes do not use, the front process handles these
+FRONT_SETTINGS = [ "recorder", "local_http", "state_snapshot", "shards" ]
+
+STOP_TIMEOUT = 5 # seconds to wait for the workers to exit
+
+# Record kinds (first byte of each record)
+FRAME = 0
+REST = 1
+OUTPUT = 2
+LOOKUP = 3
+
+FRAME_HEADER = struct.Struct("<BH") # kind, gateway number
+REST_HEADER = struct.Struct("<BHBd") # kind, gateway number, resync, requested; then key "\0" Json
+
+###################################################################
+# Shared memory ring
+###################################################################
+
+COUNTERS_SIZE = 64 # tail (bytes written) at 0, head (bytes read) at 8, then the data
+COUNTER = struct.Struct("<Q")
+TAIL = 0
+HEAD = 8
+RECORD_HEADER = struct.Struct("<I")
+WRAP = 0xFFFFFFFF # record length marking the rest of the ring unused
+
+# Write a byte to a doorbell pipe, unless it already has plenty unread
+def ring_doorbell(fd):
+    try:
+        os.write(fd, b"\0")
+    except BlockingIOError:
+        pass
+
+# Read everything in a doorbell pipe, returns False at end of file (the other
+# process has gone)
+def drain_doorbell(fd):
+    try:
+        while True:
+            data = os.read(fd, 4096)
+            if not data:
+                return False
+            if len(data) < 4096:
+                return True
+    except BlockingIOError:
+        return True
+
+class ShmRing(object):
+    """ Single producer, single consumer FIFO of byte records in a
+    multiprocessing.shared_memory block. Each record is its length (uint32)
+    and payload, written at 'tail' and read at 'head', which only increase.
+
+    The producer 'put()'s records and 'commit()'s them by publishing the tail
+    (under 'lock', which orders the memory writes on any CPU) and ringing
+    the 'data' doorbell pipe. The consumer 'get_all()' reads the records up
+    to the published tail, publishes the head and rings the 'space' doorbell.
+    The doorbell pipes are also how each side finds the other has exited.
+    """
+    def __init__(self, name, capacity, lock, data_pipe, space_pipe, create=False):
+        self.shm = shared_memory.SharedMemory(name=name, create=create,
+                                              size=COUNTERS_SIZE + capacity if create else 0)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.capacity = capacity
+        self.lock = lock
+        self.data_pipe = data_pipe # (reader, writer) Connections
+        self.space_pipe = space_pipe
+        self.tail = 0 # producer: written, and committed
+        self.committed = 0
+        self.head_seen = 0 # producer: the consumer's head when last read
+        self.head = 0 # consumer: read
+        self.closed = False # consumer: the producer has gone
+        self.space = None # producer: asyncio.Event, set when the consumer frees space
+
+    @classmethod
+    def create(cls, context, capacity):
+        return cls(None, capacity, context.Lock(), context.Pipe(duplex=False), context.Pipe(duplex=False),
+                   create=True)
+
+    # The arguments for ShmRing() in the other process
+    def spec(self):
+        return (self.name, self.capacity, self.lock, self.data_pipe, self.space_pipe)
+
+    # Keep the pipe ends used by this process, after the other has started
+    def use_as_producer(self):
+        self.data_pipe[0].close()
+        self.space_pipe[1].close()
+        self.data_fd = self.data_pipe[1].fileno()
+        self.space_fd = self.space_pipe[0].fileno()
+        os.set_blocking(self.data_fd, False)
+        os.set_blocking(self.space_fd, False)
+
+    def use_as_consumer(self):
+        self.data_pipe[1].close()
+        self.space_pipe[0].close()
+        self.data_fd = self.data_pipe[0].fileno()
+        self.space_fd = self.space_pipe[1].fileno()
+        os.set_blocking(self.data_fd, False)
+        os.set_blocking(self.space_fd, False)
+
+    # Producer: add a record of prefix + payload, returns False if the ring is full
+    def put(self, prefix, payload):
+        capacity = self.capacity
+        length = len(prefix) + len(payload)
+        size = RECORD_HEADER.size + length
+        if size > capacity // 2:
+            raise ValueError("record of {} bytes does not fit a ring of {}".format(length, capacity))
+        position = self.tail % capacity
+        skip = capacity - position if position + size > capacity else 0
+        if self.tail + skip + size - self.head_seen > capacity:
+            with self.lock:
+                self.head_seen = COUNTER.unpack_from(self.buf, HEAD)[0]
+            if self.tail + skip + size - self.head_seen > capacity:
+                return False
+        buf = self.buf
+        if skip:
+            if skip >= RECORD_HEADER.size:
+                RECORD_HEADER.pack_into(buf, COUNTERS_SIZE + position, WRAP)
+            position = 0
+        start = COUNTERS_SIZE + position
+        RECORD_HEADER.pack_into(buf, start, length)
+        start += RECORD_HEADER.size
+        buf[start:start + len(prefix)] = prefix
+        start += len(prefix)
+        buf[start:start + len(payload)] = payload
+        self.tail += skip + size
+        return True
+
+    # Producer: make the records put so far visible to the consumer
+    def commit(self):
+        if self.tail == self.committed:
+            return
+        with self.lock:
+            COUNTER.pack_into(self.buf, TAIL, self.tail)
+        self.committed = self.tail
+        ring_doorbell(self.data_fd)
+
+    # Producer, without an event loop: wait up to 'timeout' seconds for space
+    def wait_space(self, timeout):
+        select.select([ self.space_fd ], [], [], timeout)
+        if not drain_doorbell(self.space_fd):
+            raise EOFError("ring consumer has exited")
+
+    # Consumer: remove and return the committed records
+    def get_all(self):
+        if not drain_doorbell(self.data_fd):
+            self.closed = True
+        with self.lock:
+            tail = COUNTER.unpack_from(self.buf, TAIL)[0]
+        buf = self.buf
+        capacity = self.capacity
+        head = self.head
+        records = []
+        while head < tail:
+            position = head % capacity
+            if capacity - position < RECORD_HEADER.size:
+                head += capacity - position
+                continue
+            length = RECORD_HEADER.unpack_from(buf, COUNTERS_SIZE + position)[0]
+            if length == WRAP:
+                head += capacity - position
+                continue
+            start = COUNTERS_SIZE + position + RECORD_HEADER.size
+            records.append(bytes(buf[start:start + length]))
+            head += RECORD_HEADER.size + length
+        if head != self.head:
+            self.head = head
+            with self.lock:
+                COUNTER.pack_into(self.buf, HEAD, head)
+            ring_doorbell(self.space_fd)
+        return records
+
+    # The front process unlinks the block (the spawned workers share its
+    # resource tracker, which would otherwise unlink it at exit)
+    def close(self, unlink=False):
+        self.buf = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # a memoryview of it is still referenced
+            pass
+        if unlink:
+            self.shm.unlink()
+
+###################################################################
+# Worker process
+###################################################################
+
+class ShardZigBeeData(ZigBeeData):
+    """ The ZigBeeData of a gateway in a worker process, which asks the front
+    process to look up unknown endpoints rather than using the REST API.
+    """
+    def __init__(self, settings, gateway, worker, gateway_number):
+        super().__init__(settings, gateway)
+        self.worker = worker
+        self.gateway_number = gateway_number
+
+    def request_lookup(self, r, endpoint_id):
+        if (r, endpoint_id) not in self.lookups:
+            self.lookups.add((r, endpoint_id))
+            self.worker.send_lookup(self.gateway_number, r, endpoint_id)
+
+class ShardWorker(Deconz2acp):
+    """ The Deconz2acp pipeline of one worker process, with frames and REST
+    responses read from 'in_ring' and its output written to 'out_ring'.
+    """
+    def __init__(self, settings, in_ring, out_ring):
+        super().__init__(settings)
+        self.in_ring = in_ring
+        self.out_ring = out_ring
+        self.topic_prefix = settings["output_mqtt"]["topic_prefix"]
+        self.zigbee_datas = [ ShardZigBeeData(settings, gateway, self, gateway_number)
+                              for gateway_number, gateway in enumerate(gateway_settings(settings)) ]
+        for zigbee_data in self.zigbee_datas:
+            zigbee_data.output = self.send_enriched_message
+            zigbee_data.removed = self.endpoint_removed
+
+    def run(self):
+        in_ring = self.in_ring
+        next_window_check = time.monotonic() + WINDOW_CHECK_INTERVAL
+        while not in_ring.closed:
+            select.select([ in_ring.data_fd ], [], [], WINDOW_CHECK_INTERVAL)
+            for record in in_ring.get_all():
+                try:
+                    if record[0] == FRAME:
+                        gateway_number = FRAME_HEADER.unpack_from(record)[1]
+                        self.handle_input_message(record[FRAME_HEADER.size:], self.zigbee_datas[gateway_number])
+                    else:
+                        self.handle_rest_record(record)
+                except Exception:
+                    LOG.exception("Shard worker exception processing %s", record)
+            if self.aggregator is not None and time.monotonic() >= next_window_check:
+                self.aggregator.emit_ended_windows()
+                next_window_check = time.monotonic() + WINDOW_CHECK_INTERVAL
+            self.out_ring.commit()
+
+    # As ZigBeeData.poll and lookup_endpoint do with the REST responses
+    def handle_rest_record(self, record):
+        _, gateway_number, resync, requested = REST_HEADER.unpack_from(record)
+        key, _, text = record[REST_HEADER.size:].partition(b"\0")
+        zigbee_data = self.zigbee_datas[gateway_number]
+        r, endpoint_id = parse_endpoint_key(key.decode('utf-8'))
+        endpoints_dict = codec.loads(text)
+        if endpoint_id is None:
+            if resync:
+                zigbee_data.resync_state(r, endpoints_dict)
+            zigbee_data.handle_rest_response(r, endpoints_dict)
+            if zigbee_data.remove_deleted:
+                # time.monotonic() is the same clock in every process
+                zigbee_data.reconcile(r, endpoints_dict, requested)
+            zigbee_data.purge_pending()
+            zigbee_data.lookups.clear()
+        else:
+            if "name" in endpoints_dict:
+                zigbee_data.handle_endpoint_rest(r, endpoint_id, endpoints_dict)
+            zigbee_data.lookups.discard((r, endpoint_id))
+
+    # Pass the serialized message to the front process to publish
+    def send_output_message(self, topic, msg_dict, endpoint=None):
+        msg_bytes = codec.dumps(msg_dict)
+        fields = "\0".join([ self.topic_prefix + topic,
+                             msg_dict.get("acp_gateway", ""),
+                             msg_dict.get("r") or "",
+                             msg_dict.get("id") or "",
+                             msg_dict.get("acp_id") or "",
+                             (endpoint.type if endpoint is not None else None) or "",
+                             "" ])
+        self.put(bytes([ OUTPUT ]) + fields.encode('utf-8'), msg_bytes)
+
+    def send_lookup(self, gateway_number, r, endpoint_id):
+        self.put(FRAME_HEADER.pack(LOOKUP, gateway_number), "{}\0{}".format(r, endpoint_id).encode('utf-8'))
+
+    def put(self, prefix, payload):
+        while not self.out_ring.put(prefix, payload):
+            self.out_ring.commit()
+            self.out_ring.wait_space(1.0)
+
+# The worker process
+def run_worker(worker_number, settings, in_spec, out_spec):
+    # Stopped by the front process closing the input ring, not by ^C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logs.setup(settings)
+    codec.select(settings.get("json_codec", "auto"))
+    in_ring = ShmRing(*in_spec)
+    in_ring.use_as_consumer()
+    out_ring = ShmRing(*out_spec)
+    out_ring.use_as_producer()
+    LOG.info("Shard worker %s started (pid %s)", worker_number, os.getpid())
+    try:
+        ShardWorker(settings, in_ring, out_ring).run()
+    except EOFError:
+        pass
+    finally:
+        in_ring.close()
+        out_ring.close()
+        logs.stop()
+
+###################################################################
+# Front process
+###################################################################
+
+class Shards(object):
+    """ The worker processes and their rings, used by Deconz2acp in the front
+    process. The output of the workers is passed to 'self.output(topic,
+    msg_bytes, fields)', where fields are the (bytes) acp_gateway, r, id,
+    acp_id and endpoint type, and their lookup requests to
+    'self.lookup(gateway_number, r, endpoint_id)'. 'self.on_exit()' is
+    called if a worker exits.
+    """
+    def __init__(self, settings):
+        shard_settings = settings["shards"]
+        self.workers = shard_settings.get("workers", WORKERS)
+        self.ring_size = shard_settings.get("ring_size", RING_SIZE)
+        self.worker_settings = { key: value for key, value in settings.items() if key not in FRONT_SETTINGS }
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = []
+        self.in_rings = []
+        self.out_rings = []
+        self.commit_scheduled = False
+        self.output = None
+        self.lookup = None
+        self.on_exit = None
+        self.loop = None
+
+    # Start the worker processes, from the event loop
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        for worker_number in range(self.workers):
+            in_ring = ShmRing.create(self.context, self.ring_size)
+            out_ring = ShmRing.create(self.context, self.ring_size)
+            process = self.context.Process(target=run_worker, name="deconz2acp-shard-{}".format(worker_number),
+                                           args=(worker_number, self.worker_settings, in_ring.spec(),
+                                                 out_ring.spec()),
+                                           daemon=True)
+            process.start()
+            in_ring.use_as_producer()
+            out_ring.use_as_consumer()
+            in_ring.space = asyncio.Event()
+            self.loop.add_reader(in_ring.space_fd, self.space_available, in_ring)
+            self.loop.add_reader(out_ring.data_fd, self.read_output, worker_number)
+            self.processes.append(process)
+            self.in_rings.append(in_ring)
+            self.out_rings.append(out_ring)
+        LOG.info("Shards started %s worker processes", self.workers)
+
+    # Queue a websocket frame (bytes) for the worker of its endpoint
+    async def put_frame(self, gateway_number, frame):
+        ring = self.in_rings[shard_index(frame, self.workers)]
+        prefix = FRAME_HEADER.pack(FRAME, gateway_number)
+        while not ring.put(prefix, frame):
+            ring.commit()
+            ring.space.clear()
+            await ring.space.wait()
+        # Commit once the frames already received have been queued
+        if not self.commit_scheduled:
+            self.commit_scheduled = True
+            self.loop.call_soon(self.commit)
+
+    # Send a REST response (text) to every worker
+    async def put_rest(self, gateway_number, r, endpoint_id, text, resync, requested=0.0):
+        prefix = REST_HEADER.pack(REST, gateway_number, resync, requested) + endpoint_key(r, endpoint_id).encode('utf-8') + b"\0"
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+        for ring in self.in_rings:
+            while not ring.put(prefix, text):
+                ring.commit()
+                ring.space.clear()
+                await ring.space.wait()
+            ring.commit()
+
+    def commit(self):
+        self.commit_scheduled = False
+        for ring in self.in_rings:
+            ring.commit()
+
+    def space_available(self, ring):
+        if not drain_doorbell(ring.space_fd):
+            self.loop.remove_reader(ring.space_fd)
+        ring.space.set()
+
+    def read_output(self, worker_number):
+        out_ring = self.out_rings[worker_number]
+        for record in out_ring.get_all():
+            try:
+                if record[0] == OUTPUT:
+                    fields = record[1:].split(b"\0", 6)
+                    self.output(fields[0].decode('utf-8'), fields[6], fields[1:6])
+                else:
+                    gateway_number = FRAME_HEADER.unpack_from(record)[1]
+                    r, endpoint_id = record[FRAME_HEADER.size:].decode('utf-8').split("\0")
+                    self.lookup(gateway_number, r, endpoint_id)
+            except Exception:
+                LOG.exception("Shards exception handling worker %s output %s", worker_number, record)
+        if out_ring.closed:
+            self.loop.remove_reader(out_ring.data_fd)
+            LOG.error("Shard worker %s has exited (exit code %s)", worker_number,
+                      self.processes[worker_number].exitcode)
+            if self.on_exit is not None:
+                self.on_exit()
+
+    # Stop the workers: closing their input doorbells ends them
+    def close(self):
+        for ring in self.out_rings:
+            self.loop.remove_reader(ring.data_fd)
+        for ring in self.in_rings:
+            self.loop.remove_reader(ring.space_fd)
+            ring.commit()
+            ring.data_pipe[1].close()
+        for process in self.processes:
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                LOG.warning("Shard worker %s did not stop, terminating", process.name)
+                process.terminate()
+        for ring in self.in_rings + self.out_rings:
+            ring.close(unlink=True)
@@ -0,0 +1,270 @@
+"""
+spool provides the Spool class, an append-only on-disk store of (topic, msg_bytes)
+used by the Publisher to keep the messages produced while the MQTT broker is
+unreachable, and publish them once it is back.
+
+The spool directory holds numbered segment files (00000001.seg, ...), each a
+sequence of records
+
+    <topic length: uint32> <msg length: uint32> <topic utf-8> <msg bytes>
+
+Records are appended to the newest segment, a new segment is started when it
+reaches 'segment_size' bytes. Writes are buffered and fsync'ed together every
+'fsync_interval' seconds, so a crash loses at most that much of the spool.
+When the segments total more than 'max_size' bytes the oldest segment is
+deleted (its messages are counted as evicted).
+
+Records are read back oldest first, a segment file is deleted once it has been
+read. The read position is kept in the 'cursor' file so a restart mid-drain
+resumes from there (a few messages may be published twice).
+"""
+
+import asyncio
+import collections
+import logging
+import os
+import struct
+
+LOG = logging.getLogger("spool")
+
+# Defaults for the settings "output_mqtt" "spool" properties
+SEGMENT_SIZE = 4 * 1024 * 1024 # bytes
+MAX_SIZE = 256 * 1024 * 1024 # bytes, total of all segments
+FSYNC_INTERVAL = 1.0 # seconds
+
+WRITE_BUFFER = 64 * 1024 # bytes buffered before a write() to the segment file
+
+RECORD_HEADER = struct.Struct("<II")
+
+# Return the list of (topic, msg_bytes) of the complete records in 'data'
+# from 'offset', and the offset after the last complete record.
+def read_records(data, offset=0, max_records=None):
+    records = []
+    header_size = RECORD_HEADER.size
+    end = len(data)
+    while offset + header_size <= end and (max_records is None or len(records) < max_records):
+        topic_len, msg_len = RECORD_HEADER.unpack_from(data, offset)
+        record_end = offset + header_size + topic_len + msg_len
+        if record_end > end:
+            break # incomplete record, written when the process stopped
+        topic_end = offset + header_size + topic_len
+        records.append((data[offset + header_size:topic_end].decode('utf-8'),
+                        data[topic_end:record_end]))
+        offset = record_end
+    return records, offset
+
+class Spool(object):
+    """ Segmented append-only disk queue of (topic, msg_bytes) """
+    def __init__(self, spool_settings):
+        self.directory = spool_settings.get("directory", "spool")
+        self.segment_size = spool_settings.get("segment_size", SEGMENT_SIZE)
+        self.max_size = spool_settings.get("max_size", MAX_SIZE)
+        self.fsync_interval = spool_settings.get("fsync_interval", FSYNC_INTERVAL)
+        self.write_buffer = min(WRITE_BUFFER, self.segment_size // 4)
+        os.makedirs(self.directory, exist_ok=True)
+
+        # [ seq, bytes, records ] of each segment file, oldest first
+        self.segments = collections.deque()
+        self.next_seq = 1
+        self.file = None # newest segment, open for appending
+        self.buffer = bytearray() # appended records not yet written to self.file
+        self.buffer_records = 0
+        self.dirty = False # written but not fsync'ed
+
+        # Read position in the oldest segment
+        self.read_data = None
+        self.read_offset = 0
+
+        self.records = 0 # records spooled, not yet read
+        self.spooled = 0
+        self.drained = 0
+        self.evicted = 0
+        self.not_empty = asyncio.Event()
+
+        self.load()
+
+    def __len__(self):
+        return self.records
+
+    def segment_file(self, seq):
+        return os.path.join(self.directory, "{:08d}.seg".format(seq))
+
+    # Pick up the segments left by a previous run
+    def load(self):
+        seqs = sorted(int(filename[:-4]) for filename in os.listdir(self.directory)
+                      if filename.endswith(".seg") and filename[:-4].isdigit())
+        cursor_seq, cursor_offset = self.load_cursor()
+        for seq in seqs:
+            with open(self.segment_file(seq), 'rb') as f:
+                data = f.read()
+            records, end = read_records(data, cursor_offset if seq == cursor_seq else 0)
+            self.segments.append([ seq, len(data), len(records) ])
+            self.records += len(records)
+        # Never reuse the cursor's segment number
+        self.next_seq = max(seqs + [ cursor_seq or 0 ]) + 1
+        if seqs and seqs[0] == cursor_seq:
+            self.read_offset = cursor_offset
+        if self.records:
+            self.not_empty.set()
+            LOG.info("Spool %s has %s messages from a previous run", self.directory, self.records)
+
+    def load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, "cursor"), 'r') as f:
+                seq, offset = f.read().split()
+            return int(seq), int(offset)
+        except (OSError, ValueError):
+            return None, 0
+
+    def save_cursor(self, seq, offset):
+        filename = os.path.join(self.directory, "cursor")
+        try:
+            with open(filename + ".tmp", 'w') as f:
+                f.write("{} {}".format(seq, offset))
+            os.replace(filename + ".tmp", filename)
+        except OSError as e:
+            LOG.error("Spool cursor %s not saved: %r", filename, e)
+
+    # Append a message, written to disk by write()/sync()
+    def append(self, topic, msg_bytes):
+        topic_bytes = topic.encode('utf-8')
+        self.buffer += RECORD_HEADER.pack(len(topic_bytes), len(msg_bytes))
+        self.buffer += topic_bytes
+        self.buffer += msg_bytes
+        self.buffer_records += 1
+        self.records += 1
+        self.spooled += 1
+        self.not_empty.set()
+        if len(self.buffer) >= self.write_buffer:
+            self.write()
+
+    # Write the buffered records to the newest segment (without fsync)
+    def write(self):
+        if not self.buffer:
+            return
+        if self.file is None:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.file = open(self.segment_file(seq), 'ab')
+            self.segments.append([ seq, 0, 0 ])
+        segment = self.segments[-1]
+        try:
+            self.file.write(self.buffer)
+            self.file.flush()
+        except OSError as e:
+            LOG.error("Spool %s write failed, %s messages lost: %r",
+                      self.directory, self.buffer_records, e)
+            self.records -= self.buffer_records
+            self.buffer.clear()
+            self.buffer_records = 0
+            return
+        segment[1] += len(self.buffer)
+        segment[2] += self.buffer_records
+        self.buffer.clear()
+        self.buffer_records = 0
+        self.dirty = True
+        if segment[1] >= self.segment_size:
+            self.close_segment()
+        self.evict()
+
+    # Write and fsync the buffered records
+    def sync(self):
+        self.write()
+        if self.dirty and self.file is not None:
+            try:
+                os.fsync(self.file.fileno())
+            except OSError as e:
+                LOG.error("Spool %s fsync failed: %r", self.directory, e)
+        self.dirty = False
+
+    def close_segment(self):
+        if self.file is not None:
+            try:
+                os.fsync(self.file.fileno())
+            except OSError as e:
+                LOG.error("Spool %s fsync failed: %r", self.directory, e)
+            self.file.close()
+            self.file = None
+            self.dirty = False
+
+    # Delete the oldest segments while the spool is over max_size
+    def evict(self):
+        total = sum(segment[1] for segment in self.segments)
+        while total > self.max_size and len(self.segments) > 1:
+            seq, size, records = self.segments.popleft()
+            if self.read_data is not None or self.read_offset:
+                # Partly read, only count what was left
+                records = len(read_records(self.read_data or self.read_segment_data(seq),
+                                           self.read_offset)[0])
+                self.read_data = None
+                self.read_offset = 0
+            self.delete_segment(seq)
+            self.records -= records
+            self.evicted += records
+            total -= size
+            LOG.warning("Spool %s over max_size, evicted %s messages", self.directory, records)
+
+    def read_segment_data(self, seq):
+        with open(self.segment_file(seq), 'rb') as f:
+            return f.read()
+
+    def delete_segment(self, seq):
+        try:
+            os.remove(self.segment_file(seq))
+        except OSError as e:
+            LOG.error("Spool segment %s not deleted: %r", self.segment_file(seq), e)
+
+    # Remove and return up to max_records (topic, msg_bytes), oldest first
+    def read_batch(self, max_records):
+        batch = []
+        while (self.segments or self.buffer) and len(batch) < max_records:
+            if len(self.segments) <= 1 and (self.file is not None or self.buffer):
+                # Only the newest segment is left: finish it so it can be read
+                self.sync()
+                self.close_segment()
+            seq = self.segments[0][0]
+            if self.read_data is None:
+                try:
+                    self.read_data = self.read_segment_data(seq)
+                except OSError as e:
+                    LOG.error("Spool segment %s not read: %r", self.segment_file(seq), e)
+                    self.read_data = b""
+            records, self.read_offset = read_records(self.read_data, self.read_offset,
+                                                     max_records - len(batch))
+            batch += records
+            if self.read_offset >= len(self.read_data) or not records:
+                # Segment finished (ignoring any incomplete record at the end)
+                self.segments.popleft()
+                self.delete_segment(seq)
+                self.read_data = None
+                self.read_offset = 0
+            self.save_cursor(seq, self.read_offset)
+        self.records = max(0, self.records - len(batch))
+        self.drained += len(batch)
+        if not self.segments:
+            self.records = 0
+            self.not_empty.clear()
+        return batch
+
+    # Spool task: fsync appended records every fsync_interval
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            if self.buffer or self.dirty:
+                self.sync()
+
+    def close(self):
+        self.sync()
+        self.close_segment()
+
+    def size(self):
+        return sum(segment[1] for segment in self.segments) + len(self.buffer)
+
+    def stats(self):
+        return { "messages": self.records,
+                 "bytes": self.size(),
+                 "segments": len(self.segments),
+                 "spooled": self.spooled,
+                 "drained": self.drained,
+                 "evicted": self.evicted
+               }
@@ -0,0 +1,175 @@
+"""
+stream provides the Stream class, a websocket on the LocalHttp server which
+sends the enriched messages to local real-time clients (dashboards,
+websocket_test.html), so they need not each connect to the MQTT broker or the
+deCONZ gateway:
+
+    GET /stream?acp_id=aqa-wd-5c91b3,aqa-mot-6657d3&r=sensors&type=ZHAOpenClose
+
+The optional "acp_id", "r" and "type" (deCONZ endpoint type) filters are
+comma-separated lists, a message is sent if it matches all those given. A
+client can replace its filters by sending a Json object, e.g.
+{"type": ["ZHAPresence"]} ({} for everything), acknowledged with
+{"subscribed": <filters>}.
+
+Each message is serialized once (the same bytes as published via MQTT) and the
+text shared by all the clients it is sent to. Each client has a send queue of
+up to 'queue_size' messages, a client which falls that far behind is
+disconnected (close code 1013, "try again later") rather than slowing the
+others or holding messages in memory.
+
+Enabled by the settings.json "local_http" "stream" property, e.g.
+
+    "local_http": { "port": 8089, "stream": { "queue_size": 1000, "max_clients": 100 } }
+"""
+
+import asyncio
+import collections
+import logging
+
+from aiohttp import web, WSMsgType, WSCloseCode
+
+import codec
+import metrics
+
+LOG = logging.getLogger("stream")
+
+# Defaults for the settings "local_http" "stream" properties
+QUEUE_SIZE = 1000 # messages queued per client
+MAX_CLIENTS = 100
+HEARTBEAT = 30 # seconds between websocket pings
+
+FILTERS = [ "acp_id", "r", "type" ]
+
+class StreamError(Exception):
+    pass
+
+# Return { filter: frozenset of values } from a dict of filter -> list of values
+# (or comma-separated string)
+def parse_filters(filters):
+    if not isinstance(filters, dict):
+        raise StreamError("filters are a Json object")
+    unknown = set(filters) - set(FILTERS)
+    if unknown:
+        raise StreamError("unknown filters {}".format(", ".join(sorted(unknown))))
+    parsed = {}
+    for name, values in filters.items():
+        if isinstance(values, str):
+            values = values.split(",")
+        if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+            raise StreamError("filter {} is not a list of strings".format(name))
+        parsed[name] = frozenset(values)
+    return parsed
+
+class StreamClient(object):
+    """ One websocket client, its filters and send queue """
+    __slots__ = ("ws", "remote", "acp_ids", "rs", "types", "queue", "not_empty", "sent")
+
+    def __init__(self, ws, remote, filters):
+        self.ws = ws
+        self.remote = remote
+        self.set_filters(filters)
+        self.queue = collections.deque()
+        self.not_empty = asyncio.Event()
+        self.sent = 0
+
+    def set_filters(self, filters):
+        self.acp_ids = filters.get("acp_id")
+        self.rs = filters.get("r")
+        self.types = filters.get("type")
+
+    def matches(self, acp_id, r, endpoint_type):
+        return ((self.acp_ids is None or acp_id in self.acp_ids) and
+                (self.rs is None or r in self.rs) and
+                (self.types is None or endpoint_type in self.types))
+
+class Stream(object):
+    """ Fan-out of the enriched messages to the /stream websocket clients.
+    'send()' is called by Deconz2acp for each message published.
+    """
+    def __init__(self, settings):
+        stream_settings = settings["local_http"]["stream"]
+        self.queue_size = stream_settings.get("queue_size", QUEUE_SIZE)
+        self.max_clients = stream_settings.get("max_clients", MAX_CLIENTS)
+        self.clients = set()
+        metrics.STREAM_CLIENTS.set_function(lambda: len(self.clients))
+
+    def add_routes(self, app):
+        app.router.add_get("/stream", self.handle_stream)
+
+    # Queue msg_bytes (a serialized message, with its "acp_id", "r" and
+    # endpoint type) for the clients whose filters match
+    def send(self, msg_bytes, acp_id, r, endpoint_type=None):
+        text = None
+        for client in list(self.clients):
+            if not client.matches(acp_id, r, endpoint_type):
+                continue
+            if len(client.queue) >= self.queue_size:
+                self.disconnect_slow(client)
+                continue
+            if text is None:
+                # decoded once, shared by all the clients
+                text = msg_bytes.decode('utf-8')
+            client.queue.append(text)
+            client.not_empty.set()
+            metrics.STREAM_MESSAGES.inc("queued")
+
+    def disconnect_slow(self, client):
+        self.clients.discard(client)
+        client.queue.clear()
+        metrics.STREAM_MESSAGES.inc("slow_consumer")
+        LOG.warning("Stream client %s disconnected, %s messages behind", client.remote, self.queue_size)
+        asyncio.ensure_future(client.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b"slow consumer"))
+
+    async def handle_stream(self, request):
+        if len(self.clients) >= self.max_clients:
+            return web.Response(status=503, text="too many stream clients\n")
+        try:
+            filters = parse_filters(dict(request.query))
+        except StreamError as e:
+            return web.Response(status=400, text="{}\n".format(e))
+        ws = web.WebSocketResponse(heartbeat=HEARTBEAT)
+        await ws.prepare(request)
+        client = StreamClient(ws, request.remote, filters)
+        self.clients.add(client)
+        LOG.info("Stream client %s connected, %s clients", client.remote, len(self.clients))
+        writer = asyncio.ensure_future(self.write(client))
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT:
+                    self.subscribe(client, msg.data)
+        finally:
+            self.clients.discard(client)
+            writer.cancel()
+            LOG.info("Stream client %s disconnected after %s messages", client.remote, client.sent)
+        return ws
+
+    # Replace the client's filters from a Json message, and acknowledge it
+    def subscribe(self, client, data):
+        try:
+            filters = parse_filters(codec.loads(data))
+            client.set_filters(filters)
+            response = { "subscribed": { name: sorted(values) for name, values in filters.items() } }
+        except (StreamError, ValueError) as e:
+            response = { "error": str(e) }
+        client.queue.append(codec.dumps(response).decode('utf-8'))
+        client.not_empty.set()
+
+    # Client writer task: send the queued messages
+    async def write(self, client):
+        ws = client.ws
+        queue = client.queue
+        try:
+            while True:
+                await client.not_empty.wait()
+                client.not_empty.clear()
+                while queue:
+                    await ws.send_str(queue.popleft())
+                    client.sent += 1
+        except (ConnectionResetError, RuntimeError) as e:
+            # closed while sending
+            LOG.debug("Stream client %s send failed: %r", client.remote, e)
+
+    async def close(self):
+        for client in list(self.clients):
+            await client.ws.close(code=WSCloseCode.GOING_AWAY, message=b"deconz2acp stopping")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The deconz2acp modules are imported by name, as when run from the deconz2acp directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
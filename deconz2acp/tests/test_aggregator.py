@@ -0,0 +1,115 @@
+from aggregator import Aggregator
+
+RULES = { "ZHALightLevel": { "fields": { "acp_lux": { "deadband": 10,
+                                                      "min_interval": 5,
+                                                      "max_interval": 300 } } },
+          "windowed": { "fields": { "acp_lux": {} },
+                        "window": 60 } }
+
+class Endpoint(object):
+    def __init__(self, endpoint_type="ZHALightLevel", modelid="model"):
+        self.type = endpoint_type
+        self.modelid = modelid
+
+def make_aggregator(dedup=True):
+    aggregator = Aggregator({ "aggregation": { "dedup": dedup, "rules": RULES } })
+    aggregator.aggregates = []
+    aggregator.output = aggregator.aggregates.append
+    return aggregator
+
+def message(ts, lux, acp_id="sensor", lastupdated=None, **properties):
+    msg_dict = { "r": "sensors", "id": "1", "acp_id": acp_id, "acp_ts": '{:.6f}'.format(ts),
+                 "acp_lux": lux,
+                 "state": { "lux": lux, "lastupdated": lastupdated or str(ts) } }
+    msg_dict.update(properties)
+    return msg_dict
+
+def test_duplicate_dropped():
+    aggregator = make_aggregator()
+    endpoint = Endpoint("ZHAOpenClose")
+    assert aggregator.filter(endpoint, message(0, 1, lastupdated="t"))
+    assert not aggregator.filter(endpoint, message(1, 1, lastupdated="t"))
+    assert aggregator.filter(endpoint, message(2, 1, lastupdated="t2"))
+
+def test_duplicate_kept_without_dedup():
+    aggregator = make_aggregator(dedup=False)
+    endpoint = Endpoint("ZHAOpenClose")
+    assert aggregator.filter(endpoint, message(0, 1, lastupdated="t"))
+    assert aggregator.filter(endpoint, message(1, 1, lastupdated="t"))
+
+def test_deadband():
+    aggregator = make_aggregator()
+    endpoint = Endpoint()
+    assert aggregator.filter(endpoint, message(0, 100))
+    assert not aggregator.filter(endpoint, message(10, 109))
+    assert aggregator.filter(endpoint, message(20, 110))
+    # measured from the last value published, not the last received
+    assert not aggregator.filter(endpoint, message(30, 101))
+
+def test_min_interval():
+    aggregator = make_aggregator()
+    endpoint = Endpoint()
+    assert aggregator.filter(endpoint, message(0, 100))
+    assert not aggregator.filter(endpoint, message(4, 200))
+    assert aggregator.filter(endpoint, message(5, 200))
+
+def test_max_interval():
+    aggregator = make_aggregator()
+    endpoint = Endpoint()
+    assert aggregator.filter(endpoint, message(0, 100))
+    assert not aggregator.filter(endpoint, message(299, 101))
+    assert aggregator.filter(endpoint, message(300, 101))
+
+def test_event_always_published():
+    aggregator = make_aggregator()
+    endpoint = Endpoint()
+    assert aggregator.filter(endpoint, message(0, 100))
+    assert aggregator.filter(endpoint, message(1, 100, lastupdated="0", acp_event="dark"))
+
+def test_rule_by_modelid_before_type():
+    aggregator = make_aggregator()
+    endpoint = Endpoint("ZHAOpenClose", modelid="ZHALightLevel")
+    assert aggregator.filter(endpoint, message(0, 100))
+    assert not aggregator.filter(endpoint, message(10, 101))
+
+def test_window_aggregate_sent_by_next_window():
+    aggregator = make_aggregator()
+    endpoint = Endpoint("windowed")
+    for ts, lux in [ (60, 1), (70, 5), (119, 3) ]:
+        aggregator.filter(endpoint, message(ts, lux))
+    assert aggregator.aggregates == []
+    aggregator.filter(endpoint, message(120, 7))
+    [ aggregate ] = aggregator.aggregates
+    assert aggregate["e"] == "aggregate"
+    assert aggregate["acp_ts"] == "120.000000"
+    assert aggregate["acp_aggregate"] == { "start": "60.000000", "end": "120.000000", "count": 3,
+                                           "acp_lux": { "min": 1, "max": 5, "mean": 3 } }
+
+def test_window_header_follows_rename():
+    aggregator = make_aggregator()
+    endpoint = Endpoint("windowed")
+    aggregator.filter(endpoint, message(60, 1, acp_id="old-name"))
+    aggregator.filter(endpoint, message(70, 2, acp_id="new-name"))
+    aggregator.emit_ended_windows(120)
+    assert aggregator.aggregates[0]["acp_id"] == "new-name"
+
+def test_ended_windows_by_message_time():
+    aggregator = make_aggregator()
+    endpoint = Endpoint("windowed")
+    aggregator.filter(endpoint, message(60, 1))
+    # message time is 60 plus the (tiny) time since, the window is still open
+    aggregator.emit_ended_windows()
+    assert aggregator.aggregates == []
+    aggregator.emit_ended_windows(120)
+    assert len(aggregator.aggregates) == 1
+    aggregator.emit_ended_windows(1000)
+    assert len(aggregator.aggregates) == 1
+
+def test_removed_endpoint_forgotten():
+    aggregator = make_aggregator()
+    endpoint = Endpoint("windowed")
+    aggregator.filter(endpoint, message(60, 1))
+    aggregator.remove(endpoint)
+    assert endpoint not in aggregator.endpoints
+    assert len(aggregator.aggregates) == 1
+    aggregator.remove(endpoint)
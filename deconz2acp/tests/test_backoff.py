@@ -0,0 +1,19 @@
+from backoff import Backoff
+
+def test_doubles_up_to_maximum():
+    backoff = Backoff(1, 10)
+    for delay in [ 1, 2, 4, 8, 10, 10 ]:
+        assert delay / 2 <= backoff.next_delay() <= delay
+
+def test_reset_starts_from_minimum():
+    backoff = Backoff(1, 10)
+    for _ in range(5):
+        backoff.next_delay()
+    backoff.reset()
+    assert 0.5 <= backoff.next_delay() <= 1
+    assert 1 <= backoff.next_delay() <= 2
+
+def test_many_failures():
+    backoff = Backoff(0.5, 30)
+    for _ in range(5000):
+        assert backoff.next_delay() <= 30
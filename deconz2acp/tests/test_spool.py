@@ -0,0 +1,95 @@
+import os
+
+from spool import Spool
+
+def make_spool(tmp_path, **settings):
+    settings.setdefault("directory", str(tmp_path))
+    return Spool(settings)
+
+def messages(count, start=0):
+    return [ ("topic/{}".format(n), "message {}".format(n).encode('utf-8')) for n in range(start, start + count) ]
+
+def append_all(spool, records):
+    for topic, msg_bytes in records:
+        spool.append(topic, msg_bytes)
+
+def test_reopen_after_close(tmp_path):
+    spool = make_spool(tmp_path, segment_size=200)
+    append_all(spool, messages(20))
+    spool.close()
+    assert len(spool.segments) > 1
+
+    spool = make_spool(tmp_path, segment_size=200)
+    assert len(spool) == 20
+    assert spool.read_batch(100) == messages(20)
+    assert len(spool) == 0
+    assert not [ f for f in os.listdir(tmp_path) if f.endswith(".seg") ]
+
+def test_restart_mid_drain_resumes_at_cursor(tmp_path):
+    spool = make_spool(tmp_path, segment_size=200)
+    append_all(spool, messages(20))
+    spool.close()
+    assert spool.read_batch(3) == messages(3)
+    # no close(), as if the process had been killed
+
+    spool = make_spool(tmp_path, segment_size=200)
+    assert len(spool) == 17
+    assert spool.read_batch(100) == messages(17, start=3)
+
+def test_restart_after_segment_drained(tmp_path):
+    spool = make_spool(tmp_path, segment_size=200)
+    append_all(spool, messages(20))
+    spool.close()
+    first_segment = spool.segments[0][2]
+    assert spool.read_batch(first_segment) == messages(first_segment)
+
+    spool = make_spool(tmp_path, segment_size=200)
+    assert spool.read_batch(100) == messages(20 - first_segment, start=first_segment)
+
+def test_incomplete_record_ignored(tmp_path):
+    spool = make_spool(tmp_path)
+    append_all(spool, messages(5))
+    spool.close()
+    # a crash part way through writing a record
+    with open(spool.segment_file(spool.segments[-1][0]), 'ab') as f:
+        f.write(b"\x07\x00\x00\x00\x40\x00\x00\x00topic/5mess")
+
+    spool = make_spool(tmp_path)
+    assert len(spool) == 5
+    assert spool.read_batch(100) == messages(5)
+
+def test_segment_numbers_not_reused(tmp_path):
+    spool = make_spool(tmp_path)
+    append_all(spool, messages(5))
+    spool.close()
+    drained_seq = spool.segments[0][0]
+    spool.read_batch(100)
+
+    spool = make_spool(tmp_path)
+    append_all(spool, messages(2, start=5))
+    spool.close()
+    assert spool.segments[0][0] > drained_seq
+    spool = make_spool(tmp_path)
+    assert spool.read_batch(100) == messages(2, start=5)
+
+def test_evicts_oldest_segments_over_max_size(tmp_path):
+    spool = make_spool(tmp_path, segment_size=200, max_size=600)
+    append_all(spool, messages(100))
+    spool.close()
+    assert spool.evicted > 0
+    assert spool.size() <= 600 + 200
+    remaining = spool.read_batch(1000)
+    assert len(remaining) == 100 - spool.evicted
+    assert remaining == messages(len(remaining), start=spool.evicted)
+
+def test_evicting_partly_read_segment_counts_unread(tmp_path):
+    spool = make_spool(tmp_path, segment_size=200, max_size=600)
+    append_all(spool, messages(10))
+    spool.close()
+    first_segment = spool.segments[0][2]
+    assert spool.read_batch(3) == messages(3)
+    append_all(spool, messages(50, start=10))
+    spool.close()
+    assert spool.evicted >= first_segment - 3
+    assert len(spool) == 60 - 3 - spool.evicted
+    assert len(spool.read_batch(1000)) == 60 - 3 - spool.evicted
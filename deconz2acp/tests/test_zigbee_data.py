@@ -0,0 +1,183 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from zigbee_data import ZigBeeData
+
+class Clock(object):
+    """ Stands in for time.time() and time.monotonic() """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock)
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+def make_zigbee_data(**api_settings):
+    api_settings["url"] = "http://deconz/api/key/"
+    zigbee_data = ZigBeeData({ "deconz_api": api_settings, "input_ws": { "url": "ws://deconz" } })
+    zigbee_data.sent = []
+    zigbee_data.output = lambda msg_dict, endpoint: zigbee_data.sent.append(msg_dict)
+    return zigbee_data
+
+def endpoint_dict(endpoint_id):
+    return { "name": "sensor-{}".format(endpoint_id),
+             "type": "ZHATemperature",
+             "modelid": "model",
+             "uniqueid": "00:00:00:00:00:00:00:{:02x}-01".format(int(endpoint_id)),
+             "etag": "etag-{}".format(endpoint_id),
+             "state": {},
+             "config": {} }
+
+def message(endpoint_id, n):
+    return { "e": "changed", "r": "sensors", "id": endpoint_id, "t": "event",
+             "state": { "temperature": n, "lastupdated": str(n) } }
+
+def test_buffered_until_known(clock):
+    zigbee_data = make_zigbee_data()
+    assert zigbee_data.handle_ws_message(message("1", 1)) is None
+    clock.now += 2
+    assert zigbee_data.handle_ws_message(message("1", 2)) is None
+    assert zigbee_data.sent == []
+    zigbee_data.handle_endpoint_rest("sensors", "1", endpoint_dict("1"))
+    assert [ msg_dict["state"]["temperature"] for msg_dict in zigbee_data.sent ] == [ 1, 2 ]
+    # the arrival time, not when the endpoint became known
+    assert [ msg_dict["acp_ts"] for msg_dict in zigbee_data.sent ] == [ "1000.000000", "1002.000000" ]
+    assert all(msg_dict["acp_id"] == "sensor-1" for msg_dict in zigbee_data.sent)
+    assert zigbee_data.pending == {}
+
+def test_pending_size_keeps_newest(clock):
+    zigbee_data = make_zigbee_data(pending_size=2)
+    for n in range(5):
+        zigbee_data.handle_ws_message(message("1", n))
+    zigbee_data.handle_endpoint_rest("sensors", "1", endpoint_dict("1"))
+    assert [ msg_dict["state"]["temperature"] for msg_dict in zigbee_data.sent ] == [ 3, 4 ]
+
+def test_pending_endpoints_limit(clock):
+    zigbee_data = make_zigbee_data(pending_endpoints=2)
+    assert zigbee_data.handle_ws_message(message("1", 1)) is None
+    assert zigbee_data.handle_ws_message(message("2", 1)) is None
+    assert zigbee_data.handle_ws_message(message("3", 1)) is False
+    # endpoints already buffered still are
+    assert zigbee_data.handle_ws_message(message("1", 2)) is None
+    assert set(zigbee_data.pending) == set([ ("sensors", "1"), ("sensors", "2") ])
+
+def test_expired_not_sent(clock):
+    zigbee_data = make_zigbee_data(pending_ttl=60)
+    zigbee_data.handle_ws_message(message("1", 1))
+    clock.now += 50
+    zigbee_data.handle_ws_message(message("1", 2))
+    clock.now += 20
+    zigbee_data.handle_endpoint_rest("sensors", "1", endpoint_dict("1"))
+    assert [ msg_dict["state"]["temperature"] for msg_dict in zigbee_data.sent ] == [ 2 ]
+
+def test_purge_pending(clock):
+    zigbee_data = make_zigbee_data(pending_ttl=60)
+    zigbee_data.handle_ws_message(message("1", 1))
+    clock.now += 50
+    zigbee_data.handle_ws_message(message("1", 2))
+    zigbee_data.handle_ws_message(message("2", 1))
+    clock.now += 20
+    zigbee_data.purge_pending()
+    assert [ msg_dict["state"]["temperature"] for _, msg_dict in zigbee_data.pending[("sensors", "1")] ] == [ 2 ]
+    clock.now += 60
+    zigbee_data.purge_pending()
+    assert zigbee_data.pending == {}
+
+def test_failed_lookup_not_repeated(clock):
+    zigbee_data = make_zigbee_data(lookup_retry=60)
+    zigbee_data.session = object() # no request is made while the lookup is failed
+    zigbee_data.failed_lookups[("sensors", "1")] = clock.now + 60
+    zigbee_data.handle_ws_message(message("1", 1))
+    assert zigbee_data.lookups == set()
+    clock.now += 60
+    zigbee_data.purge_pending()
+    assert zigbee_data.failed_lookups == {}
+
+def test_endpoint_missing_from_rest_kept(clock):
+    zigbee_data = make_zigbee_data()
+    zigbee_data.handle_rest_response("sensors", { "1": endpoint_dict("1"), "2": endpoint_dict("2") })
+    zigbee_data.handle_rest_response("sensors", { "1": endpoint_dict("1") })
+    assert list(zigbee_data.endpoints["sensors"]) == [ "1", "2" ]
+
+def test_reconcile_removes_missing(clock):
+    zigbee_data = make_zigbee_data()
+    removed = []
+    zigbee_data.removed = removed.append
+    zigbee_data.handle_rest_response("sensors", { "1": endpoint_dict("1"), "2": endpoint_dict("2") })
+    endpoint = zigbee_data.endpoints["sensors"]["2"]
+    zigbee_data.reconcile("sensors", { "1": endpoint_dict("1") })
+    assert list(zigbee_data.endpoints["sensors"]) == [ "1" ]
+    assert removed == [ endpoint ]
+    assert zigbee_data.find_device("sensor-2") == []
+
+def test_not_reconciled_without_output(clock):
+    zigbee_data = make_zigbee_data()
+    output = zigbee_data.output
+    zigbee_data.output = None
+    zigbee_data.handle_rest_response("sensors", { "1": endpoint_dict("1") })
+    zigbee_data.endpoints["sensors"]["1"].state = { "temperature": 1, "lastupdated": "1" }
+    # as after loading a snapshot
+    zigbee_data.unreconciled = set([ "sensors", "lights" ])
+    rest_dict = endpoint_dict("1")
+    rest_dict["state"] = { "temperature": 2, "lastupdated": "2" }
+    responses = { "sensors": { "1": rest_dict }, "lights": {} }
+
+    async def http_get_conditional(session, url, etag=None):
+        r = url.rsplit("/", 1)[1]
+        return 200, "etag-" + r, json.dumps(responses[r])
+    zigbee_data.http_get_conditional = http_get_conditional
+
+    asyncio.run(zigbee_data.poll(None, zigbee_data.api_settings["url"]))
+    assert zigbee_data.unreconciled == set([ "sensors", "lights" ])
+    assert zigbee_data.response_etags == {}
+
+    zigbee_data.output = output
+    asyncio.run(zigbee_data.poll(None, zigbee_data.api_settings["url"]))
+    assert zigbee_data.unreconciled == set()
+    assert [ (msg_dict["acp_resync"], msg_dict["state"]["temperature"]) for msg_dict in zigbee_data.sent ] == [ (True, 2) ]
+
+def test_renamed_by_rest(clock):
+    zigbee_data = make_zigbee_data()
+    zigbee_data.handle_rest_response("sensors", { "1": endpoint_dict("1") })
+    endpoint = zigbee_data.endpoints["sensors"]["1"]
+    renamed = endpoint_dict("1")
+    renamed["name"] = "aqa-wd-1a2b3c"
+    renamed["etag"] = "etag-renamed"
+    # a metadata change, so the poll interval starts again from poll_interval
+    assert zigbee_data.handle_endpoint_rest("sensors", "1", renamed)
+    assert endpoint.name == "aqa-wd-1a2b3c"
+    assert zigbee_data.find_device("aqa-wd-1a2b3c") == [ endpoint ]
+    assert zigbee_data.find_device("sensor-1") == []
+    assert zigbee_data.find_endpoints(acp_id="aqa-wd-1a2b3c") == [ endpoint ]
+    msg_dict = message("1", 1)
+    assert zigbee_data.handle_ws_message(msg_dict) is endpoint
+    assert msg_dict["acp_id"] == "aqa-wd-1a2b3c"
+
+def test_remove_deleted(clock):
+    zigbee_data = make_zigbee_data(remove_deleted=True)
+    zigbee_data.output = None
+    zigbee_data.handle_rest_response("sensors", { "1": endpoint_dict("1"), "2": endpoint_dict("2") })
+    clock.now += 10
+    responses = { "sensors": { "1": endpoint_dict("1") }, "lights": {} }
+
+    async def http_get_conditional(session, url, etag=None):
+        r = url.rsplit("/", 1)[1]
+        if r == "sensors":
+            # an "added" websocket message while the request is in flight
+            clock.now += 1
+            zigbee_data.handle_ws_message({ "e": "added", "r": "sensors", "id": "3", "t": "event",
+                                            "sensor": endpoint_dict("3") })
+        return 200, "etag-" + r, json.dumps(responses[r])
+    zigbee_data.http_get_conditional = http_get_conditional
+
+    assert asyncio.run(zigbee_data.poll(None, zigbee_data.api_settings["url"]))
+    assert sorted(zigbee_data.endpoints["sensors"]) == [ "1", "3" ]
@@ -11,11 +11,45 @@ messages, see sensor_data/README.md.
 
 import aiohttp
 import asyncio
+import collections
+import marshal
+import os
+import logging
+import threading
 import time
-import simplejson as json
 import sys
 
-DEBUG = True
+import codec
+import decoders
+import metrics
+from backoff import Backoff
+from recording import KIND_REST, endpoint_key
+
+LOG = logging.getLogger("zigbee_data")
+# State change events, can be rate limited separately, see logs.py
+ENDPOINT_LOG = logging.getLogger("zigbee_data.endpoint")
+
+# Default REST API poll intervals (seconds), see settings "deconz_api"
+POLL_INTERVAL = 15
+POLL_INTERVAL_MAX = 60
+# Retry delay (seconds) after a failed poll, doubling up to RETRY_MAX, and the
+# timeout for each REST API request
+RETRY_MIN = 1
+RETRY_MAX = 30
+REST_TIMEOUT = 10
+
+# Defaults for buffering websocket messages from endpoints not yet known via
+# the REST API, see settings "deconz_api"
+PENDING_SIZE = 20 # messages buffered per unknown endpoint
+PENDING_TTL = 60 # seconds a buffered message is kept
+PENDING_ENDPOINTS = 100 # unknown endpoints buffered at once
+LOOKUP_RETRY = 60 # seconds before a failed endpoint lookup is tried again
+REMOVE_DELETED = False # remove endpoints missing from every full REST response, not only after a snapshot
+
+# Default interval (seconds) between state snapshots, see settings "state_snapshot"
+SNAPSHOT_INTERVAL = 60
+# Bumped if the snapshot record layout changes, older snapshots are ignored
+SNAPSHOT_VERSION = 1
 
 #####################################
 # Return current timestamp as string
@@ -23,6 +57,34 @@ DEBUG = True
 def ts_string():
     return '{:.6f}'.format(time.time())
 
+# Return the list of gateway settings, each { "name", "deconz_api", "input_ws" }.
+# settings.json either lists several deCONZ gateways in "gateways", or for a
+# single gateway has "deconz_api" and "input_ws" at the top level.
+def gateway_settings(settings):
+    if "gateways" in settings:
+        return settings["gateways"]
+    return [ { "name": "",
+               "deconz_api": settings["deconz_api"],
+               "input_ws": settings["input_ws"] } ]
+
+# Snapshot file for a gateway, e.g. "state.snapshot" for gateway "gw-west" is
+# "state-gw-west.snapshot" (unchanged for the unnamed single gateway)
+def snapshot_filename(filename, gateway_name):
+    if not gateway_name:
+        return filename
+    base, ext = os.path.splitext(filename)
+    return "{}-{}{}".format(base, gateway_name, ext)
+
+# Names and ids are repeated across endpoints, nodes and every message, so
+# share a single copy of each string.
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+# The device MAC address from an endpoint "uniqueid", e.g. "00:15:8d:00:04:5c:91:b3"
+# from "00:15:8d:00:04:5c:91:b3-01-0006"
+def mac_address(uniqueid):
+    return intern(uniqueid.split("-", 1)[0]) if uniqueid else None
+
 class EndPoint(object):
     """ Represents an 'endpoint' in the ZigBee network, i.e. a sensor or
     actuator within a ZigBee device. A single device (which we call a Node)
@@ -32,44 +94,48 @@ class EndPoint(object):
     the state of the sensor so *events* (like a switch change from closed to
     open) can be marked as such.
     """
+    # Only the properties used for enrichment and event detection are kept,
+    # and __slots__ avoids a per-instance __dict__, as a gateway may have
+    # thousands of endpoints.
+    __slots__ = ("name", "r", "id", "uniqueid", "type", "modelid", "etag", "state", "config", "decoder",
+                 "added")
+
     def __init__(self, name, r, endpoint_id):
-        print("{} EndPoint __init__() {} {}/{}".format(ts_string(),name,r,endpoint_id))
-        self.rest_dict = {} # most recent REST API data for this endpoint
-        self.rest_state = {} # some sensor data in the "state" property,
-        self.rest_config = {} # other sensor data in the "config" property
-        self.ws_dict = {} # most recent websocket message for this endpoint
-        self.ws_state = {}
-        self.ws_config = {}
-        self.name = name # we are adding name, r, id to the endpoint_dict properties
-        self.r = r
-        self.id = endpoint_id
+        LOG.debug("EndPoint __init__() %s %s/%s", name, r, endpoint_id)
+        self.name = intern(name) # we are adding name, r, id to the endpoint_dict properties
+        self.r = intern(r)
+        self.id = intern(endpoint_id)
+        self.uniqueid = None # from the REST API data, e.g. "00:15:8d:00:04:5c:91:b3-01-0006"
+        self.type = None # from the REST API data, e.g. "ZHAOpenClose"
+        self.modelid = None # from the REST API data, e.g. "lumi.sensor_magnet.aq2"
+        self.etag = None # deCONZ "etag" of the REST data, changes when the endpoint does
+        self.state = None # "state" from the most recent websocket message containing one
+        self.config = None # "config" from the most recent websocket message containing one
+        self.decoder = decoders.DEFAULT_DECODER # by modelid/type, see decoders.py
+        self.added = time.monotonic() # when created, see ZigBeeData.reconcile
 
     # Store the latest data from the deCONZ REST API
     def handle_rest(self, endpoint_dict):
-        self.rest_dict = endpoint_dict
-        if "config" in endpoint_dict:
-            self.rest_config = endpoint_dict["config"]
-            # Handle name change (happens on install "Door/Window" to "aqa-wd-1a2b3c")
-            if "name" in self.rest_config and self.rest_config["name"] != self.name:
-                print("{} rest config sensor name change {} to {}".format(
-                    ts_string(),
-                    self.name,
-                    self.rest_config["name"]), file=sys.stderr, flush=True)
-                self.name = self.rest_config["name"]
-        if "state" in endpoint_dict:
-            self.rest_state = endpoint_dict["state"]
+        self.etag = endpoint_dict.get("etag")
+        self.uniqueid = intern(endpoint_dict.get("uniqueid"))
+        self.type = intern(endpoint_dict.get("type"))
+        self.modelid = intern(endpoint_dict.get("modelid"))
+        self.decoder = decoders.lookup(self.modelid, self.type)
+        # Handle name change (happens on install "Door/Window" to "aqa-wd-1a2b3c")
+        if "name" in endpoint_dict and endpoint_dict["name"] != self.name:
+            LOG.info("rest sensor name change %s to %s", self.name, endpoint_dict["name"])
+            self.name = intern(endpoint_dict["name"])
+
+    # The REST properties that change rarely, compared to adapt the poll interval
+    def metadata(self):
+        return (self.name, self.uniqueid, self.type, self.modelid)
 
     # Store the latest incoming message from the deCONZ websocket
     def handle_ws(self, msg_dict):
-        # Make a *copy* of the message
-        msg_copy = json.loads(json.dumps(msg_dict))
         # Handle name change (happens on install "Door/Window" to "aqa-wd-1a2b3c")
         if "name" in msg_dict and msg_dict["name"] != self.name:
-            print("{} ws sensor name change {} to {}".format(
-                ts_string(),
-                self.name,
-                msg_dict["name"]), file=sys.stderr, flush=True)
-            self.name = msg_dict["name"]
+            LOG.info("ws sensor name change %s to %s", self.name, msg_dict["name"])
+            self.name = intern(msg_dict["name"])
 
         # These calls will add properties to msg_dict
         # add "acp_id" and "acp_ts"
@@ -81,69 +147,113 @@ class EndPoint(object):
 
         # We explictly store the most recent "state" and "config", because
         # alternate websocket messages from the same endpoint may contain
-        # one or the other (e.g. see Xiaomi Door/Window)
-        self.ws_dict = msg_copy
-        if "config" in self.ws_dict:
-            self.ws_config = self.ws_dict["config"]
-        if "state" in self.ws_dict:
-            self.ws_state = self.ws_dict["state"]
+        # one or the other (e.g. see Xiaomi Door/Window).
+        # The enrichment above only adds top-level "acp_*" properties, so a
+        # shallow copy of each sub-dict is a complete snapshot for add_event.
+        self.snapshot(msg_dict)
+
+    # Keep the "state" and "config" of this message for comparison with the next
+    def snapshot(self, msg_dict):
+        if "config" in msg_dict:
+            self.config = dict(msg_dict["config"])
+        if "state" in msg_dict:
+            self.state = dict(msg_dict["state"])
+
+    # The EndPoint as plain data for the state snapshot
+    def snapshot_record(self):
+        return (self.name, self.r, self.id, self.uniqueid, self.type, self.modelid,
+                self.etag, self.state, self.config)
+
+    def restore_record(self, record):
+        (name, r, endpoint_id, uniqueid, endpoint_type, modelid, self.etag,
+         self.state, self.config) = record
+        self.uniqueid = intern(uniqueid)
+        self.type = intern(endpoint_type)
+        self.modelid = intern(modelid)
+        self.decoder = decoders.lookup(self.modelid, self.type)
 
     # Add "acp_id" and "acp_ts" properties to the message
     def add_core_properties(self, msg_dict):
-        # timestamp
-        msg_dict["acp_ts"] = ts_string()
+        # timestamp, unless the message already has one (when replayed, see replay.py)
+        if "acp_ts" not in msg_dict:
+            msg_dict["acp_ts"] = ts_string()
         # sensor identifier
         msg_dict["acp_id"] = self.name
 
-    def decode_event(self, prop, prop_value):
-        if prop == "open":
-            return "openclose", "open" if prop_value else "close"
-        return None,None
-
     # Try and work out if the websocket message implies an EVENT, e.g.
     # a message with state.open=True can be compared with the previous
     # state and if changed then we mark this as an event.
     def add_event(self, msg_dict):
-        if "state" in msg_dict:
-            msg_state = msg_dict["state"]
-            for prop in msg_state:
-                if prop in ["open"]:
-                    if prop in self.ws_state and msg_state[prop] != self.ws_state[prop]:
-                        event, value = self.decode_event(prop, msg_state[prop])
-                        if event is not None:
-                            msg_dict["acp_event"] = event
-                            msg_dict["acp_event_value"] = value
-                            if DEBUG:
-                                print("{} state change {} to {}".format(
-                                    ts_string(),
-                                    event,
-                                    value), flush=True)
+        event = self.decoder.add_event(msg_dict, self.state)
+        if event is not None:
+            ENDPOINT_LOG.debug("state change %s to %s", event[0], event[1])
 
     # decode(msg) interprets data fields to possible add ACP 'standard' versions
     def decode(self,msg_dict):
-        # temperature
-        temperature = self.acp_temperature(msg_dict)
-        if temperature is not None:
-            msg_dict["acp_temperature"] = temperature
+        self.decoder.decode(msg_dict)
 
-    # If there is a "temperature" property, return value as degrees C
-    def acp_temperature(self, msg_dict):
-        try:
-            #debug is this 'standard' or just Aqara / deCONZ ?
-            return msg_dict["config"]["temperature"] / 100
-        except KeyError:
-            return None
+    # The EndPoint and its latest state, for the query API (see query.py)
+    def as_dict(self):
+        return { "acp_id": self.name,
+                 "r": self.r,
+                 "id": self.id,
+                 "uniqueid": self.uniqueid,
+                 "type": self.type,
+                 "modelid": self.modelid,
+                 "state": self.state,
+                 "config": self.config
+               }
 
 class Node(object):
     """ Represents a ZigBee device which may contain multiple endpoints.
     """
+    __slots__ = ("name", "endpoints")
+
     def __init__(self, name):
         self.name = name
-        self.endpoints = {}
+        self.endpoints = {} # (r, endpoint_id) -> EndPoint
 
     def update(self, endpoint):
-        endpoint_id = endpoint.id
-        self.endpoints[endpoint_id] = endpoint
+        self.endpoints[(endpoint.r, endpoint.id)] = endpoint
+
+    # Returns True if the Node has no endpoints left
+    def remove(self, endpoint):
+        key = (endpoint.r, endpoint.id)
+        if self.endpoints.get(key) is endpoint:
+            del self.endpoints[key]
+        return not self.endpoints
+
+# Add/remove an endpoint in an index of { key: Node }
+def add_to_nodes(nodes, key, endpoint):
+    try:
+        node = nodes[key]
+    except KeyError:
+        node = nodes[key] = Node(key)
+    node.update(endpoint)
+
+def remove_from_nodes(nodes, key, endpoint):
+    node = nodes.get(key)
+    if node is not None and node.remove(endpoint):
+        del nodes[key]
+
+# Add/remove an endpoint in an index of { key: { (r, endpoint_id): EndPoint } }
+def add_to_index(index, key, endpoint):
+    if key is None:
+        return
+    try:
+        endpoints = index[key]
+    except KeyError:
+        endpoints = index[key] = {}
+    endpoints[(endpoint.r, endpoint.id)] = endpoint
+
+def remove_from_index(index, key, endpoint):
+    endpoints = index.get(key)
+    if endpoints is None:
+        return
+    if endpoints.get((endpoint.r, endpoint.id)) is endpoint:
+        del endpoints[(endpoint.r, endpoint.id)]
+    if not endpoints:
+        del index[key]
 
 class ZigBeeData(object):
     """ Contains the collected state and metadata of all the Zigbee devices
@@ -152,60 +262,338 @@ class ZigBeeData(object):
     sensor data from the deCONZ websocket *only* contains the
     "endpoint_type:endpoint_id" identifier and this needs enriching with a
     definitive sensor identifier ('acp_id').
+
+    There is one ZigBeeData per deCONZ gateway, so the endpoint ids (which
+    are only unique within a gateway) are namespaced by gateway.
     """
-    def __init__(self, settings):
-        global DEBUG
+    def __init__(self, settings, gateway=None):
         self.settings = settings
-        if "DEBUG" in settings:
-            DEBUG = settings["DEBUG"]
-        print("{} ZigBeeData __init__() DEBUG={}".format(
-            ts_string(),
-            DEBUG),file=sys.stderr,flush=True)
+        if gateway is None:
+            gateway = gateway_settings(settings)[0]
+        self.gateway_name = gateway.get("name", "")
+        self.api_settings = gateway["deconz_api"]
+        self.ws_settings = gateway["input_ws"]
+        LOG.info("ZigBeeData __init__() gateway '%s'", self.gateway_name)
 
-        # endpoints will be referenced by self.nodes[name].endpoints[endpoint_id]
+        # endpoints will be referenced by self.nodes[name].endpoints[(r, endpoint_id)]
         self.nodes = {}
         # endpoints also referenced self.endpoints[endpoint_type][endpoint_id]
         self.endpoints = {}
         self.endpoints["sensors"] = {} # ZigBee devices (battery powered)
         self.endpoints["lights"] = {} # ZigBee devices (mains powered)
 
+        # Secondary indexes for queries (see find_endpoints), kept up to date by
+        # index_endpoint() when an endpoint is added, removed or renamed, or its
+        # REST data changes.
+        self.uniqueids = {} # uniqueid -> EndPoint
+        self.macs = {} # MAC address -> Node with all the endpoints of the device
+        self.types = {} # type -> { (r, endpoint_id): EndPoint }
+        self.modelids = {} # modelid -> { (r, endpoint_id): EndPoint }
+        self.indexed = {} # EndPoint -> (name, uniqueid, type, modelid) it is indexed by
+
+        # HTTP ETag of the most recent REST API response for each of the above,
+        # sent as If-None-Match so an unchanged list costs a '304 Not Modified'.
+        self.response_etags = {}
+
+        # The poll interval starts at poll_interval and doubles (up to
+        # poll_interval_max) each time a poll finds no endpoint metadata has
+        # changed. deCONZ changes an endpoint's etag with every state update,
+        # so the etags alone would keep the interval short on a busy network.
+        self.poll_interval = self.api_settings.get("poll_interval", POLL_INTERVAL)
+        self.poll_interval_max = self.api_settings.get("poll_interval_max", POLL_INTERVAL_MAX)
+        self.rest_timeout = self.api_settings.get("timeout", REST_TIMEOUT)
+        self.rest_backoff = Backoff(self.api_settings.get("retry_min", RETRY_MIN),
+                                    self.api_settings.get("retry_max", RETRY_MAX))
+
+        # After a websocket reconnect request_resync() wakes the poller for an
+        # immediate full poll, and state changes missed while disconnected are
+        # sent as messages (see resync_state). resync_pending stays set until
+        # that poll succeeds.
+        self.resync = asyncio.Event()
+        self.resync_pending = False
+
+        # Websocket messages from endpoints we don't know yet (e.g. a newly
+        # paired device) are buffered in self.pending[(r, endpoint_id)] as
+        # (time.time(), msg_dict) while the endpoint is looked up via the REST
+        # API, then enriched and passed to self.output(msg_dict, endpoint)
+        # (set by Deconz2acp).
+        self.pending = {}
+        self.pending_size = self.api_settings.get("pending_size", PENDING_SIZE)
+        self.pending_ttl = self.api_settings.get("pending_ttl", PENDING_TTL)
+        self.pending_endpoints = self.api_settings.get("pending_endpoints", PENDING_ENDPOINTS)
+        self.lookups = set() # (r, endpoint_id) with a REST lookup in progress
+        # (r, endpoint_id) -> time.monotonic() after which a failed lookup (e.g.
+        # 404 for a deleted endpoint still sending messages) may be retried
+        self.failed_lookups = {}
+        self.lookup_retry = self.api_settings.get("lookup_retry", LOOKUP_RETRY)
+        self.remove_deleted = self.api_settings.get("remove_deleted", REMOVE_DELETED)
+        self.session = None # aiohttp session, while start() is running
+        self.output = None
+        self.removed = None # removed(endpoint) when an endpoint is removed, set by Deconz2acp
+        self.recorder = None # recording.Recorder for the REST responses, set by Deconz2acp
+        # With shards, async rest_output(r, endpoint_id, text, resync, requested)
+        # passes the REST responses on to the worker processes, set by Deconz2acp
+        self.rest_output = None
+
+        # Warm restart: load the endpoints and their last known state from the
+        # snapshot file, these are reconciled with the first full REST response
+        # for each of "sensors" and "lights" (the set below).
+        self.snapshot_file = None
+        self.unreconciled = set()
+        if "state_snapshot" in settings:
+            self.snapshot_file = snapshot_filename(settings["state_snapshot"]["file"], self.gateway_name)
+            self.snapshot_interval = settings["state_snapshot"].get("interval", SNAPSHOT_INTERVAL)
+            self.snapshot_lock = threading.Lock()
+            self.load_snapshot()
+
     #####################################
     # Async start()
     #####################################
     async def start(self):
-        print("{} ZigBeeData start()".format(ts_string()))
-        api_url = self.settings["deconz_api"]["url"]
-        async with aiohttp.ClientSession() as session:
+        LOG.info("ZigBeeData start() gateway '%s'", self.gateway_name)
+        api_url = self.api_settings["url"]
+        interval = self.poll_interval
+        if self.snapshot_file is not None:
+            asyncio.ensure_future(self.save_snapshots())
+        timeout = aiohttp.ClientTimeout(total=self.rest_timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            self.session = session
             while True:
-                for r in ["sensors","lights"]:
-                    #print("{} Getting {}".format(ts_string(), r))
-                    json_response = await self.http_get(session, api_url+r)
-                    if DEBUG:
-                        print("{} REST API /{} response:\n{}".format(
-                            ts_string(),
-                            r,
-                            json_response), flush=True)
-                    endpoints_dict = json.loads(json_response)
-                    self.handle_rest_response(r, endpoints_dict)
-                #debug should put this refresh time in a constant
-                await asyncio.sleep(15)
+                if self.resync.is_set():
+                    self.resync.clear()
+                    self.resync_pending = True
+                    # Full responses rather than '304 Not Modified'
+                    self.response_etags = {}
+                try:
+                    changed = await self.poll(session, api_url)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    metrics.REST_ERRORS.inc(self.gateway_name)
+                    delay = self.rest_backoff.next_delay()
+                    LOG.warning("ZigBeeData REST API %s poll failed: %s %s, retry in %.1fs",
+                                api_url, type(e).__name__, e, delay)
+                    interval = self.poll_interval
+                    await self.sleep_unless_resync(delay)
+                    continue
+                self.rest_backoff.reset()
+                self.resync_pending = False
+                self.purge_pending()
+                # Poll quickly while things are changing, back off while they are not
+                if changed:
+                    interval = self.poll_interval
+                else:
+                    interval = min(interval * 2, self.poll_interval_max)
+                await self.sleep_unless_resync(interval)
+
+    # GET "sensors" and "lights" from the REST API, return True if anything changed
+    async def poll(self, session, api_url):
+        changed = False
+        poll_start = time.perf_counter()
+        for r in ["sensors","lights"]:
+            #print("{} Getting {}".format(ts_string(), r))
+            requested = time.monotonic()
+            status, etag, json_response = await self.http_get_conditional(session, api_url+r,
+                                                                          self.response_etags.get(r))
+            if status == 304:
+                continue
+            LOG.debug("REST API /%s response:\n%s", r, json_response)
+            if self.recorder is not None:
+                self.recorder.record(KIND_REST, self.gateway_name, endpoint_key(r), json_response)
+            if self.rest_output is not None:
+                await self.rest_output(r, None, json_response, self.resync_pending, requested)
+            endpoints_dict = codec.loads(json_response)
+            resync = self.resync_pending or r in self.unreconciled
+            if resync:
+                # Compare with the state before handle_rest_response adds any new endpoints
+                self.resync_state(r, endpoints_dict)
+            if self.handle_rest_response(r, endpoints_dict):
+                changed = True
+            if r in self.unreconciled or self.remove_deleted:
+                if self.reconcile(r, endpoints_dict, requested):
+                    changed = True
+            if resync and self.output is None:
+                # resync_state had nowhere to send its messages, again next poll
+                continue
+            self.unreconciled.discard(r)
+            self.response_etags[r] = etag
+        metrics.REST_POLL_SECONDS.observe(time.perf_counter() - poll_start, self.gateway_name)
+        return changed
+
+    # Sleep for 'delay' seconds, or until request_resync()
+    async def sleep_unless_resync(self, delay):
+        try:
+            await asyncio.wait_for(self.resync.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    # Called by Deconz2acp when the websocket has reconnected
+    def request_resync(self):
+        self.resync.set()
+
+    # Send a message for each endpoint whose REST API "state" is newer than the
+    # last websocket state, i.e. an update missed while disconnected (or, after
+    # a warm restart, while deconz2acp was stopped). These are enriched like
+    # websocket messages, so a changed event property adds "acp_event".
+    def resync_state(self, r, endpoints_dict):
+        if self.output is None:
+            return
+        endpoints = self.endpoints[r]
+        for endpoint_id, endpoint_dict in endpoints_dict.items():
+            endpoint = endpoints.get(endpoint_id)
+            rest_state = endpoint_dict.get("state")
+            if endpoint is None or endpoint.state is None or not rest_state or rest_state == endpoint.state:
+                continue
+            # Lights have no "lastupdated", for sensors skip a REST state older
+            # than the websocket state
+            lastupdated = rest_state.get("lastupdated")
+            if lastupdated is not None and lastupdated <= endpoint.state.get("lastupdated", ""):
+                continue
+            msg_dict = { "e": "changed",
+                         "id": endpoint_id,
+                         "r": r,
+                         "t": "event",
+                         "state": dict(rest_state),
+                         "acp_resync": True }
+            if "uniqueid" in endpoint_dict:
+                msg_dict["uniqueid"] = endpoint_dict["uniqueid"]
+            self.enrich(endpoint, msg_dict)
+            metrics.RESYNC_MESSAGES.inc(self.gateway_name)
+            LOG.info("ZigBeeData resync %s/%s %s", r, endpoint_id, endpoint.name)
+            self.output(msg_dict, endpoint)
 
     # Deconz2mqqt has received websocket message and passed it to us
+    # Returns the EndPoint if msg_dict has been enriched and should be sent,
+    # False if not, or None if it has been buffered pending a REST lookup of the
+    # endpoint (it will be enriched and sent via self.output later).
     def handle_ws_message(self, msg_dict):
         try:
-            endpoint = self.endpoints[msg_dict["r"]][msg_dict["id"]]
-            endpoint.handle_ws(msg_dict)
-            return True # status
+            r = msg_dict["r"]
+            endpoint_id = msg_dict["id"]
+            endpoints = self.endpoints[r]
         except KeyError:
+            metrics.UNRESOLVED_MESSAGES.inc(self.gateway_name, "ignored")
             return False
+        try:
+            endpoint = endpoints[endpoint_id]
+        except KeyError:
+            # An "added" message carries the REST data of the new endpoint
+            singular = r[:-1] # "sensor" or "light"
+            if singular in msg_dict and "name" in msg_dict[singular]:
+                self.handle_endpoint_rest(r, endpoint_id, msg_dict[singular])
+                endpoint = endpoints[endpoint_id]
+            else:
+                return self.add_pending(r, endpoint_id, msg_dict)
+        self.enrich(endpoint, msg_dict)
+        metrics.WS_MESSAGES.inc(self.gateway_name, r, endpoint_id)
+        return endpoint
+
+    def enrich(self, endpoint, msg_dict):
+        name = endpoint.name
+        endpoint.handle_ws(msg_dict)
+        if endpoint.name is not name:
+            # renamed by the message
+            self.index_endpoint(endpoint)
+        # With multiple gateways, say which one the message came from
+        if self.gateway_name:
+            msg_dict["acp_gateway"] = self.gateway_name
+
+    #####################################
+    # Messages from unknown endpoints
+    #####################################
+
+    # Buffer msg_dict until the endpoint is known, returns None (buffered)
+    # or False (buffer full)
+    def add_pending(self, r, endpoint_id, msg_dict):
+        key = (r, endpoint_id)
+        if key not in self.pending:
+            if len(self.pending) >= self.pending_endpoints:
+                metrics.UNRESOLVED_MESSAGES.inc(self.gateway_name, "pending_full")
+                return False
+            self.pending[key] = collections.deque(maxlen=self.pending_size)
+        metrics.UNRESOLVED_MESSAGES.inc(self.gateway_name, "pending")
+        self.pending[key].append((time.time(), msg_dict))
+        self.request_lookup(r, endpoint_id)
+        return None
+
+    # Look up the endpoint via the REST API, unless that is already in progress
+    # (also called by Deconz2acp for the shard workers' unknown endpoints)
+    def request_lookup(self, r, endpoint_id):
+        key = (r, endpoint_id)
+        if key not in self.lookups and self.session is not None:
+            retry = self.failed_lookups.get(key)
+            if retry is not None:
+                if time.monotonic() < retry:
+                    return
+                del self.failed_lookups[key]
+            self.lookups.add(key)
+            asyncio.ensure_future(self.lookup_endpoint(r, endpoint_id))
+
+    # GET the REST data for a single endpoint rather than wait for the next poll
+    async def lookup_endpoint(self, r, endpoint_id):
+        url = "{}{}/{}".format(self.api_settings["url"], r, endpoint_id)
+        found = False
+        try:
+            async with self.session.get(url) as response:
+                if response.status == 200:
+                    text = await response.text()
+                    if self.recorder is not None:
+                        self.recorder.record(KIND_REST, self.gateway_name, endpoint_key(r, endpoint_id), text)
+                    if self.rest_output is not None:
+                        await self.rest_output(r, endpoint_id, text, False)
+                    endpoint_dict = codec.loads(text)
+                    if "name" in endpoint_dict:
+                        self.handle_endpoint_rest(r, endpoint_id, endpoint_dict)
+                        found = True
+                else:
+                    LOG.warning("ZigBeeData lookup %s status %s", url, response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            LOG.warning("ZigBeeData lookup %s failed: %r", url, e)
+        finally:
+            self.lookups.discard((r, endpoint_id))
+            if not found:
+                # not asked again for every message from the endpoint
+                self.failed_lookups[(r, endpoint_id)] = time.monotonic() + self.lookup_retry
+
+    # The endpoint is now known: enrich and output its buffered messages in order
+    def flush_pending(self, r, endpoint_id):
+        buffered = self.pending.pop((r, endpoint_id), None)
+        if buffered is None:
+            return
+        endpoint = self.endpoints[r][endpoint_id]
+        expired = time.time() - self.pending_ttl
+        for received, msg_dict in buffered:
+            if received < expired:
+                continue
+            # the time the message arrived, not when it was enriched
+            if "acp_ts" not in msg_dict:
+                msg_dict["acp_ts"] = '{:.6f}'.format(received)
+            self.enrich(endpoint, msg_dict)
+            if self.output is not None:
+                self.output(msg_dict, endpoint)
+
+    # Discard buffered messages older than pending_ttl, and expired failed lookups
+    def purge_pending(self):
+        now = time.monotonic()
+        for key in [ key for key, retry in self.failed_lookups.items() if retry <= now ]:
+            del self.failed_lookups[key]
+        expired = time.time() - self.pending_ttl
+        for key in list(self.pending.keys()):
+            buffered = self.pending[key]
+            while buffered and buffered[0][0] < expired:
+                buffered.popleft()
+            if not buffered:
+                del self.pending[key]
 
     # Update the Nodes data given a dictionary containing entries for multiple endpoints
     # r is "lights" or "sensors"
     # endpoints_dict is { "1": {...}, "2": {...} ...} with the info for each actual endpoint
+    # Returns True if any endpoint was added or removed, or its metadata changed.
     def handle_rest_response(self, r, endpoints_dict):
+        changed = len(endpoints_dict) != len(self.endpoints[r])
         for endpoint_id in endpoints_dict:
             endpoint_dict = endpoints_dict[endpoint_id]
-            self.handle_endpoint_rest(r, endpoint_id, endpoint_dict)
+            if self.handle_endpoint_rest(r, endpoint_id, endpoint_dict):
+                changed = True
+        return changed
 
     # Update the Nodes data with info for a single endpoint.
     """
@@ -238,24 +626,199 @@ class ZigBeeData(object):
           "uniqueid": "00:21:2e:ff:ff:05:03:60-01"
          }
     """
+    # Returns True if the endpoint is new or its metadata changed (not only its state)
     def handle_endpoint_rest(self, r, endpoint_id, endpoint_dict):
         name = endpoint_dict["name"]
         try:
             endpoint = self.endpoints[r][endpoint_id]
+            # deCONZ changes the etag whenever the endpoint data changes
+            if endpoint.etag is not None and endpoint.etag == endpoint_dict.get("etag"):
+                return False
+            metadata = endpoint.metadata()
         except KeyError:
-            endpoint = EndPoint(name, r, endpoint_id)
-            # Update reference in self.endpoints to this data
-            self.endpoints[r][endpoint_id] = endpoint
-        if not name in self.nodes:
-            self.nodes[name] = Node(name)
-            # Update reference in self.nodes to same endpoint object
-            self.nodes[name].update(endpoint)
+            endpoint = self.add_endpoint(name, r, endpoint_id)
+            metadata = None
         # OK now update the Endpoint with the new data
         endpoint.handle_rest(endpoint_dict)
+        self.index_endpoint(endpoint)
+        if self.pending:
+            self.flush_pending(r, endpoint_id)
+        return endpoint.metadata() != metadata
+
+    # Create an EndPoint and add it to self.endpoints and self.nodes
+    def add_endpoint(self, name, r, endpoint_id):
+        endpoint = EndPoint(name, r, endpoint_id)
+        # Update reference in self.endpoints to this data
+        self.endpoints[r][endpoint_id] = endpoint
+        # and in self.nodes and the other indexes
+        self.index_endpoint(endpoint)
+        return endpoint
+
+    # Remove an endpoint deCONZ no longer reports
+    def remove_endpoint(self, r, endpoint_id):
+        endpoint = self.endpoints[r].pop(endpoint_id)
+        LOG.info("ZigBeeData removed %s/%s %s", r, endpoint_id, endpoint.name)
+        self.unindex_endpoint(endpoint)
+        if self.removed is not None:
+            self.removed(endpoint)
+
+    #####################################
+    # Indexes and queries
+    #####################################
+
+    # Bring the indexes up to date with the endpoint's name, uniqueid, type
+    # and modelid
+    def index_endpoint(self, endpoint):
+        keys = (endpoint.name, endpoint.uniqueid, endpoint.type, endpoint.modelid)
+        old_keys = self.indexed.get(endpoint)
+        if keys == old_keys:
+            return
+        if old_keys is not None:
+            self.unindex_endpoint(endpoint)
+        self.indexed[endpoint] = keys
+        name, uniqueid, endpoint_type, modelid = keys
+        add_to_nodes(self.nodes, name, endpoint)
+        if uniqueid is not None:
+            self.uniqueids[uniqueid] = endpoint
+            add_to_nodes(self.macs, mac_address(uniqueid), endpoint)
+        add_to_index(self.types, endpoint_type, endpoint)
+        add_to_index(self.modelids, modelid, endpoint)
+
+    def unindex_endpoint(self, endpoint):
+        keys = self.indexed.pop(endpoint, None)
+        if keys is None:
+            return
+        name, uniqueid, endpoint_type, modelid = keys
+        remove_from_nodes(self.nodes, name, endpoint)
+        if uniqueid is not None:
+            if self.uniqueids.get(uniqueid) is endpoint:
+                del self.uniqueids[uniqueid]
+            remove_from_nodes(self.macs, mac_address(uniqueid), endpoint)
+        remove_from_index(self.types, endpoint_type, endpoint)
+        remove_from_index(self.modelids, modelid, endpoint)
+
+    # Return the endpoints of a device, by name (acp_id), uniqueid or MAC address
+    def find_device(self, key):
+        node = self.nodes.get(key) or self.macs.get(key)
+        if node is not None:
+            return list(node.endpoints.values())
+        endpoint = self.uniqueids.get(key)
+        return [] if endpoint is None else [ endpoint ]
+
+    # Return the endpoints matching all the given properties (None matches
+    # any). The candidates come from the smallest of the indexes given, so
+    # the cost is proportional to the endpoints of that index entry.
+    def find_endpoints(self, acp_id=None, uniqueid=None, mac=None, endpoint_type=None, modelid=None, r=None):
+        candidates = []
+        if acp_id is not None:
+            candidates.append(self.nodes[acp_id].endpoints.values() if acp_id in self.nodes else ())
+        if uniqueid is not None:
+            candidates.append((self.uniqueids[uniqueid],) if uniqueid in self.uniqueids else ())
+        if mac is not None:
+            candidates.append(self.macs[mac].endpoints.values() if mac in self.macs else ())
+        if endpoint_type is not None:
+            candidates.append(self.types.get(endpoint_type, {}).values())
+        if modelid is not None:
+            candidates.append(self.modelids.get(modelid, {}).values())
+        if r is not None:
+            candidates.append(self.endpoints.get(r, {}).values())
+        if not candidates:
+            return [ endpoint for endpoints in self.endpoints.values() for endpoint in endpoints.values() ]
+        return [ endpoint for endpoint in min(candidates, key=len)
+                 if (acp_id is None or endpoint.name == acp_id) and
+                    (uniqueid is None or endpoint.uniqueid == uniqueid) and
+                    (mac is None or mac_address(endpoint.uniqueid) == mac) and
+                    (endpoint_type is None or endpoint.type == endpoint_type) and
+                    (modelid is None or endpoint.modelid == modelid) and
+                    (r is None or endpoint.r == r) ]
+
+    #####################################
+    # State snapshot (warm restart)
+    #####################################
+
+    # Restore the endpoints from the snapshot file, if there is one
+    def load_snapshot(self):
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                version, records = marshal.load(f)
+        except FileNotFoundError:
+            return
+        except (EOFError, ValueError, TypeError, OSError) as e:
+            LOG.warning("ZigBeeData snapshot %s not loaded: %r", self.snapshot_file, e)
+            return
+        if version != SNAPSHOT_VERSION:
+            return
+        for record in records:
+            name, r, endpoint_id = record[0:3]
+            if r in self.endpoints:
+                endpoint = self.add_endpoint(name, r, endpoint_id)
+                endpoint.restore_record(record)
+                self.index_endpoint(endpoint)
+        self.unreconciled = set(self.endpoints.keys())
+        LOG.info("ZigBeeData snapshot %s loaded %s endpoints", self.snapshot_file, len(records))
+
+    # Drop the endpoints missing from a full REST response, after loading a
+    # snapshot or with remove_deleted. Endpoints added after 'requested'
+    # (time.monotonic() the request was sent, e.g. by an "added" websocket
+    # message or a lookup) are kept. Returns True if any were removed.
+    def reconcile(self, r, endpoints_dict, requested=None):
+        missing = [ endpoint_id for endpoint_id, endpoint in self.endpoints[r].items()
+                    if endpoint_id not in endpoints_dict and (requested is None or endpoint.added < requested) ]
+        for endpoint_id in missing:
+            self.remove_endpoint(r, endpoint_id)
+        return bool(missing)
+
+    # Atomically replace the snapshot file with the current endpoints (at exit)
+    def save_snapshot(self):
+        if self.snapshot_file is None:
+            return
+        snapshot_bytes = self.snapshot_bytes()
+        if snapshot_bytes is not None:
+            self.write_snapshot(snapshot_bytes)
+
+    # The current endpoints serialized, or None if they cannot be
+    def snapshot_bytes(self):
+        records = [ endpoint.snapshot_record()
+                    for r in self.endpoints
+                    for endpoint in self.endpoints[r].values() ]
+        try:
+            return marshal.dumps((SNAPSHOT_VERSION, records))
+        except ValueError as e:
+            LOG.error("ZigBeeData snapshot %s not saved: %r", self.snapshot_file, e)
+            return None
+
+    # Called in a thread by save_snapshots(), and at exit
+    def write_snapshot(self, snapshot_bytes):
+        tmp_file = self.snapshot_file + ".tmp"
+        with self.snapshot_lock:
+            try:
+                with open(tmp_file, 'wb') as f:
+                    f.write(snapshot_bytes)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.snapshot_file)
+            except OSError as e:
+                LOG.error("ZigBeeData snapshot %s not saved: %r", self.snapshot_file, e)
+
+    # Serialized on the event loop (the endpoints change there), written and
+    # fsync'ed in a thread so a large snapshot does not stall the websocket
+    async def save_snapshots(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            snapshot_bytes = self.snapshot_bytes()
+            if snapshot_bytes is not None:
+                await loop.run_in_executor(None, self.write_snapshot, snapshot_bytes)
 
     #####################################
     # GET http from REST API
     #####################################
-    async def http_get(self, session, url):
-        async with session.get(url) as response:
-            return await response.text()
+    # GET with If-None-Match: returns (status, etag, text), where
+    # status 304 means unchanged since 'etag' and text is None.
+    async def http_get_conditional(self, session, url, etag=None):
+        headers = { "If-None-Match": etag } if etag else {}
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304:
+                return 304, etag, None
+            response.raise_for_status()
+            return response.status, response.headers.get("ETag"), await response.text()